@@ -0,0 +1,272 @@
+"""
+Accumulators: values aggregated across the jobs of a workflow, such as counters and sums, see
+Job.FileStore.accumulator.
+
+The additions made by a job to the accumulators it is passed are merged in its worker and,
+once the job has succeeded, sent to the leader in the stats and logging record the worker
+writes with writeStatsAndLogging. The leader's stats and logging aggregator merges the
+additions as the records arrive and writes the values to a shared file in the jobStore. The
+leader has the aggregator merge all outstanding records before it issues successor jobs, so a
+job sees the additions of the jobs that finished before it was issued. The leader only waits for
+this once a worker has recorded that the workflow uses accumulators, see markUsed.
+"""
+import base64
+import cPickle
+import errno
+import logging
+import threading
+import time
+import xml.etree.cElementTree as ET
+
+from toil.jobStores.abstractJobStore import NoSuchFileException
+
+logger = logging.getLogger( __name__ )
+
+sharedFileName = "accumulators.pickle"
+
+usedFileName = "accumulators.used"
+
+# The leader rechecks that the workflow doesn't use accumulators at most this often, in seconds,
+# see UsedCheck
+usedCheckInterval = 2
+
+class Accumulator( object ):
+    """
+    A value aggregated across jobs, created by Job.FileStore.accumulator. Accumulators can be
+    passed to jobs like any other argument.
+    """
+    def __init__( self, name, initialValue, mergeFn ):
+        self.name = name
+        self.initialValue = initialValue
+        self.mergeFn = mergeFn
+
+    def add( self, value ):
+        """
+        Adds the given value to the accumulator. The addition is discarded if the job fails.
+        """
+        _updates.job.add( self, value )
+
+class AccumulatorUpdates( object ):
+    """
+    The additions to accumulators made by one or more jobs, merged by accumulator.
+    """
+    def __init__( self ):
+        # Map of accumulator names to lists of the initial value, the merge function, whether
+        # a value was added and the merged value added
+        self.updates = { }
+
+    def declare( self, accumulator ):
+        """
+        Records the accumulator, so that it is known to the leader even if nothing is added to
+        it.
+        """
+        if accumulator.name not in self.updates:
+            self.updates[ accumulator.name ] = [ accumulator.initialValue, accumulator.mergeFn,
+                                                 False, None ]
+
+    def add( self, accumulator, value ):
+        self.declare( accumulator )
+        self._addValue( self.updates[ accumulator.name ], value )
+
+    def merge( self, other ):
+        """
+        Merges the additions of the given AccumulatorUpdates into these.
+        """
+        for name, ( initialValue, mergeFn, hasValue, value ) in other.updates.iteritems( ):
+            if name not in self.updates:
+                self.updates[ name ] = [ initialValue, mergeFn, False, None ]
+            if hasValue:
+                self._addValue( self.updates[ name ], value )
+
+    def mergeInto( self, accumulator, value ):
+        """
+        Returns the given value of the accumulator merged with the additions to it.
+        """
+        update = self.updates.get( accumulator.name )
+        if update is not None and update[ 2 ]:
+            value = accumulator.mergeFn( value, update[ 3 ] )
+        return value
+
+    def __len__( self ):
+        return len( self.updates )
+
+    @staticmethod
+    def _addValue( update, value ):
+        if update[ 2 ]:
+            update[ 3 ] = update[ 1 ]( update[ 3 ], value )
+        else:
+            update[ 2 ] = True
+            update[ 3 ] = value
+
+class _WorkerUpdates( threading.local ):
+    """
+    The additions of the job running in the worker, and those of the jobs that have succeeded
+    in the worker and are yet to be sent to the leader. Workers run in threads of the leader's
+    process, see Job.Runner.runLocal, each have their own.
+    """
+    def __init__( self ):
+        self.job = AccumulatorUpdates( )
+        self.worker = AccumulatorUpdates( )
+
+_updates = _WorkerUpdates( )
+
+def declare( accumulator ):
+    """
+    Records the creation of the given accumulator by the running job. Raises a PicklingError if
+    the accumulator's initial value or merge function can't be sent to the leader.
+    """
+    cPickle.dumps( ( accumulator.initialValue, accumulator.mergeFn ), cPickle.HIGHEST_PROTOCOL )
+    _updates.job.declare( accumulator )
+
+def discardJobUpdates( ):
+    """
+    Discards the additions of the running job, called when a job starts to drop any additions
+    left by a failed job.
+    """
+    _updates.job = AccumulatorUpdates( )
+
+def commitJobUpdates( ):
+    """
+    Keeps the additions of the running job, which has succeeded, to be sent to the leader.
+    """
+    _updates.worker.merge( _updates.job )
+    discardJobUpdates( )
+
+def hasUpdates( ):
+    """
+    :rtype: True if there are additions of succeeded jobs to send to the leader
+    """
+    return len( _updates.worker ) > 0
+
+def addUpdatesToStats( stats, jobStore ):
+    """
+    Adds the additions of the succeeded jobs to the given stats and logging element, which is
+    to be written with writeStatsAndLogging, and forgets them.
+    """
+    if hasUpdates( ):
+        markUsed( jobStore )
+        element = ET.SubElement( stats, "accumulators" )
+        element.text = base64.b64encode( cPickle.dumps( _updates.worker,
+                                                        cPickle.HIGHEST_PROTOCOL ) )
+        _updates.worker = AccumulatorUpdates( )
+
+def markUsed( jobStore ):
+    """
+    Records in the jobStore that the workflow uses accumulators, before the first additions are
+    sent to the leader, see isUsed.
+    """
+    if not isUsed( jobStore ):
+        with jobStore.writeSharedFileStream( usedFileName ) as fileHandle:
+            fileHandle.write( "1" )
+        # The leader only learns that the jobs of this worker have finished once it has exited,
+        # by which time a negative result the leader cached before the file was written expired
+        time.sleep( usedCheckInterval )
+
+def isUsed( jobStore ):
+    """
+    :rtype: True if a worker of the workflow has sent additions to accumulators, in which case
+    the leader must collate the records written before it issues successor jobs
+    """
+    try:
+        with jobStore.readSharedFileStream( usedFileName ):
+            return True
+    except NoSuchFileException:
+        return False
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
+
+class UsedCheck( object ):
+    """
+    Checks for the leader whether the workflow uses accumulators, see isUsed. A negative result
+    is cached for usedCheckInterval seconds, so that the shared file isn't read on every pass of
+    the leader's loop, see markUsed.
+    """
+    def __init__( self, jobStore ):
+        self.jobStore = jobStore
+        self.used = False
+        self.lastCheck = None
+
+    def __call__( self ):
+        if not self.used:
+            now = time.time( )
+            if self.lastCheck is None or now - self.lastCheck >= usedCheckInterval:
+                # The time is taken before the check, see markUsed
+                self.lastCheck = now
+                self.used = isUsed( self.jobStore )
+        return self.used
+
+def getValue( accumulator, jobStore ):
+    """
+    Returns the value of the given accumulator as seen by the running job: the value last
+    written by the leader merged with the additions not yet sent to it.
+    """
+    value = readValues( jobStore ).get( accumulator.name, accumulator.initialValue )
+    for updates in ( _updates.worker, _updates.job ):
+        value = updates.mergeInto( accumulator, value )
+    return value
+
+def readValues( jobStore ):
+    """
+    :rtype: dict, mapping the names of the accumulators of the workflow to their values, as
+    last written by the leader
+    """
+    attempts = 3
+    for attempt in xrange( attempts ):
+        try:
+            with jobStore.readSharedFileStream( sharedFileName ) as fileHandle:
+                return cPickle.load( fileHandle )
+        except NoSuchFileException:
+            return { }
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return { }
+            raise
+        except Exception:
+            # The file may be read while the leader rewrites it
+            if attempt == attempts - 1:
+                raise
+            logger.debug( "Failed to read the accumulator values, retrying", exc_info=True )
+            time.sleep( 0.5 )
+
+class AccumulatorMerger( object ):
+    """
+    Merges the additions to accumulators in the stats and logging records of workers. Used by
+    the leader's stats and logging aggregator process.
+    """
+    def __init__( self, jobStore ):
+        # Start from the values written by an earlier run of the workflow, if it is restarted
+        self.values = readValues( jobStore )
+        self.changed = False
+
+    def addStats( self, stats ):
+        for element in stats.findall( "accumulators" ):
+            try:
+                updates = cPickle.loads( base64.b64decode( element.text ) )
+            except Exception:
+                # The merge functions of the accumulators must be importable by the leader
+                logger.error( "Failed to load the additions to accumulators of a worker",
+                              exc_info=True )
+                continue
+            for name, ( initialValue, mergeFn, hasValue, value ) in updates.updates.iteritems( ):
+                if name not in self.values:
+                    self.values[ name ] = initialValue
+                    self.changed = True
+                if hasValue:
+                    try:
+                        self.values[ name ] = mergeFn( self.values[ name ], value )
+                    except Exception:
+                        logger.error( "Failed to merge a value into the accumulator %s", name,
+                                      exc_info=True )
+                    else:
+                        self.changed = True
+
+    def writeValues( self, jobStore ):
+        """
+        Writes the values of the accumulators, if they changed since they were last written.
+        """
+        if self.changed:
+            with jobStore.writeSharedFileStream( sharedFileName ) as fileHandle:
+                cPickle.dump( self.values, fileHandle, cPickle.HIGHEST_PROTOCOL )
+            self.changed = False
@@ -1,16 +1,31 @@
 import logging
+import marshal
+import signal
+import struct
 
 logger = logging.getLogger( __name__ )
 
+#The exit statuses of a process, or of a shell running it, killed by SIGKILL.
+#On Linux this is most likely the work of the out-of-memory killer.
+killedExitStatuses = (-signal.SIGKILL, 128 + signal.SIGKILL)
+
 class BatchJob( object ):
     """
     A class encapsulating the state of a toil batchjob.
     """
+    #The attributes of a batchjob, in the order of the arguments of __init__,
+    #which is the order they are serialised in by toBytes. The leader holds
+    #many batchjobs, which without a __dict__ each take less memory.
+    __slots__ = ( 'command', 'memory', 'cpu', 'disk', 'jobStoreID', 'remainingRetryCount',
+                  'updateID', 'predecessorNumber', 'jobsToDelete', 'predecessorsFinished',
+                  'stack', 'logJobStoreFileID', 'gangs', 'checkpointJobStoreFileID' )
+
     def __init__( self, command, memory, cpu, disk,
                   jobStoreID, remainingRetryCount, 
                   updateID, predecessorNumber,
                   jobsToDelete=None, predecessorsFinished=None, 
-                  stack=None, logJobStoreFileID=None): 
+                  stack=None, logJobStoreFileID=None, gangs=None,
+                  checkpointJobStoreFileID=None): 
         #The command to be executed and its memory and cpu requirements.
         self.command = command
         self.memory = memory #Max number of bytes used by the batchjob
@@ -54,20 +69,46 @@ class BatchJob( object ):
         #Successor jobs are run in reverse order from the stack.
         self.stack = stack or []
         
+        #Services and the jobs that use them are scheduled as a gang, see
+        #leader.JobBatcher.issueGang. A gang is a set of the successors in one
+        #entry of the stack, and is recorded here as a 3-tuple of the
+        #jobStoreID of the job wrapping the clients of the services, the
+        #jobStoreFileIDs of the files the services delete once started and
+        #the jobStoreIDs of the services. The leader holds back the clients
+        #until those files have been deleted. The producers of pipes and
+        #their consumer are scheduled in the same way, see Job.addPipe.
+        self.gangs = gangs or []
+        
         #A jobStoreFileID of the log file for a batchjob.
         #This will be none unless the batchjob failed and the logging
         #has been captured to be reported on the leader.
         self.logJobStoreFileID = logJobStoreFileID 
+        
+        #A jobStoreFileID of the last checkpoint saved by the job running in the
+        #batchjob, see Job.FileStore.checkpoint. Kept across retries of the
+        #batchjob and removed once the job has succeeded.
+        self.checkpointJobStoreFileID = checkpointJobStoreFileID
 
-    def setupJobAfterFailure(self, config):
+    #The factor by which the memory of a batchjob is multiplied each time it
+    #runs out of memory
+    memoryEscalationFactor = 2
+
+    def setupJobAfterFailure(self, config, outOfMemory=False):
         """
         Reduce the remainingRetryCount if greater than zero and set the memory
         to be at least as big as the default memory (in case of exhaustion of memory,
-        which is common).
+        which is common). If the failure is known to be caused by running out of
+        memory, the memory is also multiplied by memoryEscalationFactor, up to the
+        maximum memory.
         """
         self.remainingRetryCount = max(0, self.remainingRetryCount - 1)
         logger.warn("Due to failure we are reducing the remaining retry count of batchjob %s to %s",
                     self.jobStoreID, self.remainingRetryCount)
+        if outOfMemory:
+            self.memory = min(self.memory * self.memoryEscalationFactor,
+                              float(config.attrib["max_memory"]))
+            logger.warn("The batchjob ran out of memory, we have increased its memory to %s bytes",
+                        self.memory)
         # Set the default memory to be at least as large as the default, in
         # case this was a malloc failure (we do this because of the combined
         # batch system)
@@ -102,17 +143,49 @@ class BatchJob( object ):
     # Serialization support methods
 
     def toDict( self ):
-        return self.__dict__.copy( )
+        return dict( ( name, getattr( self, name ) ) for name in BatchJob.__slots__ )
 
     @classmethod
     def fromDict( cls, d ):
         return cls( **d )
 
+    #The version of the serialisation of batchjobs by toBytes, which is
+    #incremented whenever the attributes change
+    serialisationVersion = 1
+    #The header of a serialised batchjob, a magic string that marshal never
+    #starts its output with, and the version
+    _magic = '\x89TJB'
+    _header = struct.Struct( '<4sB' )
+
+    def toBytes( self ):
+        """
+        Returns the batchjob serialised as a string, see fromBytes. Used by
+        the jobStores that store batchjobs as a whole. The attributes are 
+        marshalled as a tuple, so unlike marshalling toDict the names of the 
+        attributes aren't repeated in every batchjob.
+        """
+        return ( self._header.pack( self._magic, self.serialisationVersion ) +
+                 marshal.dumps( tuple( [ getattr( self, name ) for name in BatchJob.__slots__ ] ) ) )
+
+    @classmethod
+    def fromBytes( cls, data ):
+        """
+        Returns the batchjob serialised by toBytes. The marshalled dictionary
+        stored by earlier versions of toil is read too.
+        """
+        if not data.startswith( cls._magic ):
+            return cls.fromDict( marshal.loads( data ) )
+        magic, version = cls._header.unpack_from( data )
+        if version != cls.serialisationVersion:
+            raise RuntimeError( "The batchjob was serialised with the unsupported version %i"
+                                % version )
+        return cls( *marshal.loads( buffer( data, cls._header.size ) ) )
+
     def copy(self):
         """
         :rtype: BatchJob
         """
-        return self.__class__( **self.__dict__ )
+        return self.__class__( **self.toDict( ) )
     
     def __hash__( self ):
         return hash( self.jobStoreID )
@@ -125,15 +198,17 @@ class BatchJob( object ):
             and self.updateID == other.updateID
             and self.jobsToDelete == other.jobsToDelete
             and self.stack == other.stack
+            and self.gangs == other.gangs
             and self.predecessorNumber == other.predecessorNumber
             and self.predecessorsFinished == other.predecessorsFinished
-            and self.logJobStoreFileID == other.logJobStoreFileID )
+            and self.logJobStoreFileID == other.logJobStoreFileID
+            and self.checkpointJobStoreFileID == other.checkpointJobStoreFileID )
 
     def __ne__( self, other ):
         return not self.__eq__( other )
 
     def __repr__( self ):
-        return '%s( **%r )' % ( self.__class__.__name__, self.__dict__ )
+        return '%s( **%r )' % ( self.__class__.__name__, self.toDict( ) )
     
     def __str__(self):
         return str(self.toDict())
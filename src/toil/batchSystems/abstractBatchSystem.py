@@ -73,10 +73,18 @@ class AbstractBatchSystem:
 
     
     def killBatchJobs(self, jobIDs):
-        """Kills the given batchjob IDs.
+        """Kills the given batchjob IDs. Where the batch system kills the jobs itself, 
+        they should be sent SIGTERM, so that they can checkpoint, and SIGKILL once 
+        getKillGracePeriod seconds have passed.
         """
         raise NotImplementedError('Abstract method: killBatchJobs')
 
+    def getKillGracePeriod(self):
+        """Returns the number of seconds a batchjob is given to exit after being sent 
+        SIGTERM by killBatchJobs, see the --killGracePeriod option.
+        """
+        return float(self.config.attrib.get("kill_grace_period", 30))
+
     # FIXME: Return value should be a set (then also fix the tests)
 
     def getIssuedBatchJobIDs(self):
@@ -100,6 +108,15 @@ class AbstractBatchSystem:
         """
         raise NotImplementedError('Abstract method: getUpdatedBatchJob')
 
+    def getAvailableResources(self):
+        """Gets the resources not yet claimed by issued jobs, as a tuple of
+        (cpu, memory, disk). The leader uses this to only issue a gang of jobs
+        (see leader.JobBatcher.issueGang) once all of its members can run
+        at the same time. Batch systems that can not tell return None, in which
+        case gangs are issued immediately.
+        """
+        return None
+
     def shutdown(self):
         """Called at the completion of a toil invocation.
         Should cleanly terminate all worker threads.
@@ -0,0 +1,157 @@
+import ctypes
+import logging
+import time
+from collections import deque
+from threading import Thread, Lock
+from Queue import Queue, Empty
+
+from toil.batchSystems.abstractBatchSystem import AbstractBatchSystem
+
+logger = logging.getLogger(__name__)
+
+
+class InProcessBatchSystem(AbstractBatchSystem):
+    """
+    Runs the workers of the jobs in threads of the leader's process, rather than in processes of
+    their own, see Job.Runner.runLocal. The jobs can therefore use a jobStore that is kept in the
+    memory of the process. Only worker commands issued by the leader can be run.
+
+    The maxCpus give the number of threads. A batchjob occupies as many threads as the cpus it
+    requests, but at most all of them, and always at least a fraction of one, as for the single
+    machine batch system. Memory and disk are not limited.
+    """
+
+    def __init__(self, config, maxCpus, maxMemory, maxDisk):
+        AbstractBatchSystem.__init__(self, config, maxCpus, maxMemory, maxDisk)
+        assert self.maxCpus >= 1
+        # The minimal fractional CPU, smaller requirements are rounded up to it
+        self.minCpu = 0.1
+        # A counter to generate batchjob IDs
+        self.jobIndex = 0
+        # A lock guarding the state below, which is changed by the leader and the threads
+        self.lock = Lock()
+        # A dictionary mapping IDs of issued jobs to their (jobStoreString, jobStoreID, cpu)
+        self.jobs = {}
+        # The IDs of the jobs waiting for enough cpu to run, in the order they were issued
+        self.queuedJobs = deque()
+        # A dictionary mapping IDs of running jobs to their threads and start times
+        self.runningJobs = {}
+        # The cpu of the running jobs
+        self.cpuUsed = 0
+        # A queue of finished jobs and their exit statuses
+        self.outputQueue = Queue()
+
+    def issueBatchJob(self, command, memory, cpu, disk):
+        """
+        Queues the worker command to be run in a thread once enough cpu is available.
+        """
+        # The command runs the worker with the jobStore and the jobStoreID as its last arguments,
+        # see leader.JobBatcher.issueJob
+        commandTokens = command.split()
+        assert len(commandTokens) >= 3 and commandTokens[-3].endswith("worker.py"), \
+            "Only worker commands can be run in process: %s" % command
+        jobStoreString, jobStoreID = commandTokens[-2:]
+        cpu = max(min(cpu, self.maxCpus), self.minCpu)
+        with self.lock:
+            jobID = self.jobIndex
+            self.jobIndex += 1
+            self.jobs[jobID] = (jobStoreString, jobStoreID, cpu)
+            self.queuedJobs.append(jobID)
+            logger.debug("Issuing the batchjob %s with cpu: %s", jobStoreID, cpu)
+            self._startJobs()
+        return jobID
+
+    def _startJobs(self):
+        """
+        Starts threads for the queued jobs, in order, while enough cpu is available. Called
+        holding the lock.
+        """
+        while self.queuedJobs:
+            jobID = self.queuedJobs[0]
+            cpu = self.jobs[jobID][2]
+            if self.cpuUsed + cpu > self.maxCpus + 1e-9:
+                break
+            self.queuedJobs.popleft()
+            self.cpuUsed += cpu
+            thread = Thread(target=self._runJob, args=(jobID,))
+            # A job that ignored being killed doesn't stop the leader from exiting
+            thread.daemon = True
+            self.runningJobs[jobID] = (thread, time.time())
+            thread.start()
+
+    def _runJob(self, jobID):
+        from toil.worker import runInProcess
+        from toil.common import loadJobStore
+        jobStoreString, jobStoreID, cpu = self.jobs[jobID]
+        try:
+            exitValue = runInProcess(loadJobStore(jobStoreString), jobStoreID)
+        except BaseException:
+            logger.error("The worker of the batchjob %s failed", jobStoreID, exc_info=True)
+            exitValue = 1
+        with self.lock:
+            self.runningJobs.pop(jobID)
+            self.cpuUsed -= cpu
+            self.outputQueue.put((jobID, exitValue))
+            self._startJobs()
+
+    def killBatchJobs(self, jobIDs):
+        """
+        Removes the given jobs that are still queued. Running jobs are interrupted by raising
+        JobTerminatedException in their threads, so that they can checkpoint. The exception is
+        only raised while the job runs Python code, a job blocked in a system call or in a
+        subprocess is interrupted once it returns. A thread can't be killed, so a running job
+        stays issued until its thread has exited and it is returned by getUpdatedBatchJob.
+        """
+        from toil.job import JobTerminatedException
+        logger.debug('Killing jobs: {}'.format(jobIDs))
+        with self.lock:
+            for jobID in jobIDs:
+                if jobID in self.runningJobs:
+                    thread = self.runningJobs[jobID][0]
+                    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(thread.ident),
+                                                               ctypes.py_object(JobTerminatedException))
+                elif jobID in self.jobs:
+                    self.queuedJobs.remove(jobID)
+                    self.jobs.pop(jobID)
+
+    def getIssuedBatchJobIDs(self):
+        return self.jobs.keys()
+
+    def getRunningBatchJobIDs(self):
+        now = time.time()
+        return dict((jobID, now - startTime) for jobID, (thread, startTime) in self.runningJobs.items())
+
+    def getAvailableResources(self):
+        """
+        Returns the cpu not yet claimed by the issued jobs, memory and disk are unlimited.
+        """
+        with self.lock:
+            cpu = self.maxCpus - sum(cpu for jobStoreString, jobStoreID, cpu in self.jobs.itervalues())
+        return cpu, self.maxMemory, self.maxDisk
+
+    def getUpdatedBatchJob(self, maxWait):
+        try:
+            jobID, exitValue = self.outputQueue.get(timeout=maxWait)
+        except Empty:
+            return None
+        with self.lock:
+            self.jobs.pop(jobID)
+        logger.debug("Ran jobID: %s with exit value: %i", jobID, exitValue)
+        return jobID, exitValue
+
+    def shutdown(self):
+        """
+        Waits for the running jobs to finish, the jobs that are still queued are not run.
+        """
+        with self.lock:
+            self.queuedJobs.clear()
+            threads = [ thread for thread, startTime in self.runningJobs.values() ]
+        for thread in threads:
+            thread.join()
+
+    @classmethod
+    def getRescueBatchJobFrequency(cls):
+        """
+        Jobs can't go missing, as for the single machine batch system.
+        """
+        return 5400
@@ -19,10 +19,12 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
+import errno
 import logging
 import multiprocessing
 import os
 import random
+import signal
 import subprocess
 import time
 import math
@@ -34,6 +36,9 @@ from toil.batchSystems.abstractBatchSystem import AbstractBatchSystem
 
 logger = logging.getLogger(__name__)
 
+# The exit statuses of jobs killed by killBatchJobs, whether or not they were run by a shell
+killedStatusCodes = (-signal.SIGTERM, -signal.SIGKILL, 128 + signal.SIGTERM, 128 + signal.SIGKILL)
+
 
 class SingleMachineBatchSystem(AbstractBatchSystem):
     """
@@ -66,6 +71,8 @@ class SingleMachineBatchSystem(AbstractBatchSystem):
         self.jobIndexLock = Lock()
         # A dictionary mapping IDs of submitted jobs to those jobs
         self.jobs = {}
+        # A dictionary mapping IDs of submitted jobs to their (cpu, memory, disk) requirements
+        self.jobResources = {}
         # A queue of jobs waiting to be executed. Consumed by the workers.
         self.inputQueue = Queue()
         # A queue of finished jobs. Produced by the workers.
@@ -137,13 +144,13 @@ class SingleMachineBatchSystem(AbstractBatchSystem):
 
                         logger.info("Executing command: '%s'.", jobCommand)
                         with self.popenLock:
-                            popen = subprocess.Popen(jobCommand, shell=True)
+                            popen = subprocess.Popen(self._execCommand(jobCommand), shell=True)
                         info = Info(time.time(), popen, kill_intended=False)
                         self.runningJobs[jobID] = info
                         try:
                             statusCode = popen.wait()
                             if 0 != statusCode:
-                                if statusCode != -9 or not info.kill_intended:
+                                if statusCode not in killedStatusCodes or not info.kill_intended:
                                     logger.error("Got exit code %i (indicating failure) from command '%s'.", statusCode, jobCommand )
                         finally:
                             self.runningJobs.pop(jobID)
@@ -218,21 +225,62 @@ class SingleMachineBatchSystem(AbstractBatchSystem):
             jobID = self.jobIndex
             self.jobIndex += 1
         self.jobs[jobID] = command
+        self.jobResources[jobID] = (cpu, memory, disk)
         self.inputQueue.put((command, jobID, cpu, memory, disk))
         return jobID
 
+    @staticmethod
+    def _execCommand(jobCommand):
+        """
+        Returns the command for the shell running the given batchjob command. A simple command is
+        exec'd, as the shell does not necessarily replace itself with the command, so that the
+        signals sent by killBatchJobs reach the command itself.
+        """
+        if any(c in jobCommand for c in ';&|()\n'):
+            return jobCommand
+        return 'exec ' + jobCommand
+
     def killBatchJobs(self, jobIDs):
         """
-        As jobs are already run, this method has no effect.
+        Kills the running jobs among the given ones, first with SIGTERM, so that they can
+        checkpoint, and then with SIGKILL if they are still running after the grace period. The
+        jobs are sent SIGKILL by a thread, rather than blocking the caller for the grace period.
+        A killed batchjob stays issued, and its resources in use, until it has exited and is
+        returned by getUpdatedBatchJob.
         """
         logger.debug('Killing jobs: {}'.format(jobIDs))
+        killed = []
         for id in jobIDs:
             if id in self.runningJobs:
                 info = self.runningJobs[id]
                 info.kill_intended = True
-                os.kill(info.popen.pid, 9)
-                while id in self.runningJobs:
-                    pass
+                self._signal(info.popen, signal.SIGTERM)
+                killed.append((id, info))
+        if len(killed) > 0:
+            killer = Thread(target=self._killAfterGracePeriod, args=(killed,))
+            killer.daemon = True
+            killer.start()
+
+    def _killAfterGracePeriod(self, killed):
+        """
+        Sends SIGKILL to the given jobs sent SIGTERM by killBatchJobs that are still running once
+        the grace period has passed.
+        """
+        deadline = time.time() + self.getKillGracePeriod()
+        for id, info in killed:
+            while id in self.runningJobs and time.time() < deadline:
+                time.sleep(0.1)
+            if id in self.runningJobs:
+                self._signal(info.popen, signal.SIGKILL)
+
+    @staticmethod
+    def _signal(popen, signalNumber):
+        try:
+            os.kill(popen.pid, signalNumber)
+        except OSError as e:
+            # The process may have exited in the meantime
+            if e.errno != errno.ESRCH:
+                raise
 
     def getIssuedBatchJobIDs(self):
         """
@@ -250,6 +298,18 @@ class SingleMachineBatchSystem(AbstractBatchSystem):
             currentJobs[jobID] = time.time() - startTime
         return currentJobs
 
+    def getAvailableResources(self):
+        """
+        Returns the resources of the machine minus those of the jobs that have been issued but not yet returned
+        as updated.
+        """
+        cpu, memory, disk = self.maxCpus, self.maxMemory, self.maxDisk
+        for jobCpu, jobMemory, jobDisk in self.jobResources.itervalues():
+            cpu -= jobCpu
+            memory -= jobMemory
+            disk -= jobDisk
+        return cpu, memory, disk
+
     def shutdown(self):
         """
         Cleanly terminate worker threads. Add sentinels to inputQueue equal to maxThreads. Join all worker threads.
@@ -270,9 +330,10 @@ class SingleMachineBatchSystem(AbstractBatchSystem):
         except Empty:
             return None
         jobID, exitValue = i
+        self.outputQueue.task_done()
         self.jobs.pop(jobID)
+        self.jobResources.pop(jobID)
         logger.debug("Ran jobID: %s with exit value: %i" % (jobID, exitValue))
-        self.outputQueue.task_done()
         return jobID, exitValue
 
     @classmethod
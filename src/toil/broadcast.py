@@ -0,0 +1,205 @@
+"""
+Broadcasting of global files: a single read-only copy of a broadcast file is kept on each
+node, shared by all the jobs of the workflow on the node, see Job.FileStore.broadcast.
+
+The copies are kept in a directory per workflow in the node's temporary directory. Each file
+in the directory has a lock file, held while the file is fetched and while its reference
+count is changed, and a file holding the number of jobs currently using it. Copies are pinned
+for the lifetime of the workflow: they are only removed by the leader when the workflow
+finishes, or, on nodes other than the leader's, by the next worker of any workflow to start
+on the node once the leader has marked the workflow as finished in its job store.
+"""
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger( __name__ )
+
+_dirPrefix = "toil-broadcast-"
+
+# Held by the worker looking for the broadcast directories of finished workflows on the node,
+# holds the time they were last looked for
+_scanLockName = "toil-broadcasts.lock"
+
+def getBroadcastDir( config ):
+    """
+    Returns the path of the directory holding the broadcast files of the workflow with the
+    given config on this node. The directory may not exist.
+    """
+    workflowID = hashlib.md5( config.attrib[ "job_store" ] + ":" +
+                              config.attrib.get( "rootJob", "" ) ).hexdigest( )
+    return os.path.join( tempfile.gettempdir( ), _dirPrefix + workflowID )
+
+class Broadcasts( object ):
+    """
+    The broadcast files used by a job. Created by the Job.FileStore of the job.
+    """
+    def __init__( self, config ):
+        self.config = config
+        self.dirPath = getBroadcastDir( config )
+        # The names of the files whose reference counts were incremented by the job
+        self.held = [ ]
+
+    def get( self, fileStoreID, readFn ):
+        """
+        Returns the path of the node's copy of the global file with the given ID, fetching it
+        by calling readFn with the ID and a local path if this is the first use of the file on
+        the node. The job holds a reference to the file until release is called.
+        """
+        name = hashlib.md5( fileStoreID ).hexdigest( )
+        filePath = os.path.join( self.dirPath, name )
+        with self._lock( name ):
+            if not os.path.exists( filePath ):
+                logger.info( "Fetching broadcast file %s to %s", fileStoreID, filePath )
+                tempPath = filePath + ".tmp"
+                readFn( fileStoreID, tempPath )
+                os.chmod( tempPath, 0444 )
+                os.rename( tempPath, filePath )
+            self._addReferences( name, 1 )
+        self.held.append( name )
+        return filePath
+
+    def release( self ):
+        """
+        Releases the references held by the job.
+        """
+        for name in self.held:
+            with self._lock( name ):
+                self._addReferences( name, -1 )
+        self.held = [ ]
+
+    @contextmanager
+    def _lock( self, name ):
+        self._makeDir( )
+        with open( os.path.join( self.dirPath, name + ".lock" ), 'a' ) as lockFile:
+            fcntl.flock( lockFile, fcntl.LOCK_EX )
+            try:
+                yield
+            finally:
+                fcntl.flock( lockFile, fcntl.LOCK_UN )
+
+    def _makeDir( self ):
+        if not os.path.exists( self.dirPath ):
+            try:
+                os.mkdir( self.dirPath )
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            else:
+                # Record the workflow for removeFinishedBroadcastDirs
+                with open( os.path.join( self.dirPath, "workflow" ), 'w' ) as f:
+                    f.write( self.config.attrib[ "job_store" ] + "\n" +
+                             self.config.attrib.get( "rootJob", "" ) )
+
+    def _addReferences( self, name, n ):
+        refsPath = os.path.join( self.dirPath, name + ".refs" )
+        refs = _readReferences( refsPath ) + n
+        with open( refsPath, 'w' ) as f:
+            f.write( str( refs ) )
+
+def _readReferences( refsPath ):
+    try:
+        with open( refsPath, 'r' ) as f:
+            return int( f.read( ) or 0 )
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return 0
+
+def removeBroadcastDir( config ):
+    """
+    Removes the broadcast files of the workflow with the given config from this node, once the
+    workflow has finished. Files still referenced by a job are kept, with a warning.
+    """
+    dirPath = getBroadcastDir( config )
+    if not os.path.exists( dirPath ):
+        return
+    referenced = [ fileName[ :-len( ".refs" ) ] for fileName in os.listdir( dirPath )
+                   if fileName.endswith( ".refs" )
+                   and _readReferences( os.path.join( dirPath, fileName ) ) > 0 ]
+    if len( referenced ) == 0:
+        shutil.rmtree( dirPath, ignore_errors=True )
+    else:
+        logger.warn( "Not removing the broadcast files %s in %s as they are still in use",
+                     referenced, dirPath )
+
+def _finishedFileName( rootJob ):
+    return "workflowFinished-" + hashlib.md5( rootJob ).hexdigest( )
+
+def markWorkflowFinished( config, jobStore ):
+    """
+    Records in the job store that the workflow with the given config has finished, so that
+    the workers of other workflows remove its broadcast files from their nodes, see
+    removeFinishedBroadcastDirs.
+    """
+    rootJob = config.attrib.get( "rootJob", "" )
+    with jobStore.writeSharedFileStream( _finishedFileName( rootJob ) ):
+        pass
+
+def markWorkflowRunning( config, jobStore ):
+    """
+    Removes the record made by markWorkflowFinished, when the workflow with the given config is
+    restarted.
+    """
+    jobStore.deleteSharedFile( _finishedFileName( config.attrib.get( "rootJob", "" ) ) )
+
+def removeFinishedBroadcastDirs( config, minInterval=60 ):
+    """
+    Removes the broadcast directories on this node of workflows other than the one with the
+    given config whose job store has been deleted, or was marked as finished by
+    markWorkflowFinished. Only the job stores of file: locators are checked, checking remote
+    job stores could remove the files of running workflows if the store is unavailable.
+
+    A single worker of the node looks for the directories at a time, at most once every
+    minInterval seconds.
+    """
+    tempDir = tempfile.gettempdir( )
+    with open( os.path.join( tempDir, _scanLockName ), 'a+' ) as lockFile:
+        try:
+            fcntl.flock( lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB )
+        except IOError as e:
+            if e.errno not in ( errno.EAGAIN, errno.EACCES ):
+                raise
+            return
+        try:
+            lockFile.seek( 0 )
+            try:
+                lastScanTime = float( lockFile.read( ) )
+            except ValueError:
+                lastScanTime = 0
+            if time.time( ) - lastScanTime < minInterval:
+                return
+            lockFile.truncate( 0 )
+            lockFile.write( str( time.time( ) ) )
+            lockFile.flush( )
+            _removeFinishedBroadcastDirs( getBroadcastDir( config ), tempDir )
+        finally:
+            fcntl.flock( lockFile, fcntl.LOCK_UN )
+
+def _removeFinishedBroadcastDirs( ownDirPath, tempDir ):
+    for dirName in os.listdir( tempDir ):
+        dirPath = os.path.join( tempDir, dirName )
+        if not dirName.startswith( _dirPrefix ) or dirPath == ownDirPath:
+            continue
+        try:
+            with open( os.path.join( dirPath, "workflow" ), 'r' ) as f:
+                jobStoreString, rootJob = f.read( ).split( "\n" )
+        except (IOError, ValueError):
+            continue
+        if jobStoreString.startswith( 'file:' ):
+            jobStoreString = jobStoreString[ len( 'file:' ): ]
+        if not jobStoreString.startswith( '/' ):
+            continue
+        # The shared files of a file job store are in its directory, see
+        # FileJobStore.writeSharedFileStream
+        if os.path.exists( jobStoreString ) and not os.path.exists(
+                os.path.join( jobStoreString, _finishedFileName( rootJob ) ) ):
+            continue
+        logger.info( "Removing the broadcast files of the finished workflow in %s", dirPath )
+        shutil.rmtree( dirPath, ignore_errors=True )
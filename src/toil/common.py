@@ -28,9 +28,11 @@ from argparse import ArgumentParser
 from optparse import OptionContainer, OptionGroup
 
 from toil.lib.bioio import addLoggingOptions, getLogLevelString, system, absSymPath
+from toil.lib.compression import codecNames, getCodec
 from toil.batchSystems.parasol import ParasolBatchSystem
 from toil.batchSystems.gridengine import GridengineBatchSystem
 from toil.batchSystems.singleMachine import SingleMachineBatchSystem
+from toil.batchSystems.inProcess import InProcessBatchSystem
 from toil.batchSystems.combinedBatchSystem import CombinedBatchSystem
 from toil.batchSystems.lsf import LSFBatchSystem
 
@@ -88,7 +90,7 @@ def _addOptions(addGroupFn, defaultStr):
                              "Allows the specification of the batch system, and arguments to the batch system/big batch system (see below).")
     addOptionFn("--batchSystem", dest="batchSystem", default="singleMachine", #detectQueueSystem(),
                       help=("The type of batch system to run the batchjob(s) with, currently can be "
-                            "'singleMachine'/'parasol'/'acidTest'/'gridEngine'/'lsf/mesos/badmesos'. default=%s" % defaultStr))
+                            "'singleMachine'/'inProcess'/'parasol'/'acidTest'/'gridEngine'/'lsf/mesos/badmesos'. default=%s" % defaultStr))
     addOptionFn("--scale", dest="scale", default=1,
                 help=("A scaling factor to change the value of all submitted tasks's submitted cpu. "
                       "Used in singleMachine batch system. default=%s" % defaultStr))
@@ -115,6 +117,10 @@ def _addOptions(addGroupFn, defaultStr):
     addOptionFn("--maxDisk", dest="maxDisk", default=sys.maxint,
                       help=("The maximum amount of disk space to request from the batch \
                       system at any one time. default=%s" % defaultStr))
+    addOptionFn("--predictResources", dest="predictResources", action="store_true", default=False,
+                      help=("Predict the memory, cpu and disk requirements of jobs that don't specify them "
+                            "from the usage of earlier jobs of the same class, instead of using the defaults. "
+                            "default=%s" % defaultStr))
 
     addOptionFn = addGroupFn("toil options for rescuing/killing/restarting jobs", \
             "The options for jobs that either run too long/fail or get lost \
@@ -126,6 +132,11 @@ def _addOptions(addGroupFn, defaultStr):
                       help=("Maximum runtime of a batchjob (in seconds) before we kill it "
                             "(this is a lower bound, and the actual time before killing "
                             "the batchjob may be longer). default=%s" % defaultStr))
+    addOptionFn("--killGracePeriod", dest="killGracePeriod", default=30,
+                      help=("Period of time (in seconds) between sending SIGTERM to a batchjob "
+                            "being killed, which allows the job to checkpoint, and killing it "
+                            "with SIGKILL. Only used by batch systems that kill jobs themselves. "
+                            "default=%s" % defaultStr))
     addOptionFn("--rescueJobsFrequency", dest="rescueJobsFrequency",
                       help=("Period of time to wait (in seconds) between checking for "
                             "missing/overlong jobs, that is jobs which get lost by the batch system. Expert parameter. (default is set by the batch system)"))
@@ -157,6 +168,32 @@ def _addOptions(addGroupFn, defaultStr):
                       help=("The maximum size of a batchjob log file to keep (in bytes), log files larger "
                             "than this will be truncated to the last X bytes. Default is 50 "
                             "kilobytes, default=%s" % defaultStr))
+    addOptionFn("--compression", dest="compression", default="none",
+                      choices=codecNames,
+                      help=("The codec used to compress global files and pickled jobs "
+                            "in the jobStore, one of none, zlib, bz2 or lzma. Files "
+                            "are decompressed transparently when read, individual files "
+                            "can be written with a different codec, see "
+                            "Job.FileStore.writeGlobalFile. default=%s" % defaultStr))
+    addOptionFn("--attributeCacheTTL", dest="attributeCacheTTL", default=0,
+                      help=("The time (in seconds) for which the file jobStore caches the "
+                            "attributes of immutable global files, saving round trips to the "
+                            "server of a network file system such as NFS. Files deleted by other "
+                            "nodes may seem to exist for up to this long. 0 disables the cache, "
+                            "default=%s" % defaultStr))
+    addOptionFn("--shardRoots", dest="shardRoots", default=None,
+                      help=("Comma separated directories, e.g. on other file systems, that the "
+                            "file jobStore spreads the directories of jobs over, in addition "
+                            "to its own directory. Each job is placed by consistent hashing, "
+                            "so changing the directories on restart moves few jobs. "
+                            "default=%s" % defaultStr))
+    addOptionFn("--durability", dest="durability", default="none",
+                      choices=("none", "fsync", "group"),
+                      help=("How the file jobStore makes updates of jobs durable against "
+                            "crashes of the node: none leaves them to the operating system, "
+                            "fsync flushes each to disk, group writes them to a journal that "
+                            "is flushed once for the updates made at the same time, which "
+                            "is replayed when the workflow is restarted. default=%s" % defaultStr))
 
 
 def addOptions(parser):
@@ -213,6 +250,7 @@ def createConfig(options):
     config.attrib["parasol_command"] = options.parasolCommand
     config.attrib["try_count"] = str(int(options.retryCount) + 1)
     config.attrib["max_job_duration"] = str(float(options.maxJobDuration))
+    config.attrib["kill_grace_period"] = str(float(options.killGracePeriod))
     config.attrib["batch_system"] = options.batchSystem
     config.attrib["job_time"] = str(float(options.jobTime))
     config.attrib["max_log_file_size"] = str(int(options.maxLogFileSize))
@@ -231,6 +269,16 @@ def createConfig(options):
         config.attrib["big_max_memory"] = str(int(options.bigMaxMemory))
     if options.stats:
         config.attrib["stats"] = ""
+    if options.predictResources:
+        config.attrib["predict_resources"] = ""
+    if getCodec(options.compression) is not None:
+        config.attrib["compression"] = options.compression
+    if float(options.attributeCacheTTL) > 0:
+        config.attrib["attribute_cache_ttl"] = str(float(options.attributeCacheTTL))
+    if options.shardRoots is not None:
+        config.attrib["shard_roots"] = options.shardRoots
+    if options.durability != "none":
+        config.attrib["durability"] = options.durability
     return config
 
 
@@ -261,6 +309,9 @@ def loadBatchSystemClass(config, key="batch_system"):
     elif batchSystemName == 'single_machine' or batchSystemName == 'singleMachine':
         batchSystemClass = SingleMachineBatchSystem
         logger.info('Using the single machine batch system')
+    elif batchSystemName == 'in_process' or batchSystemName == 'inProcess':
+        batchSystemClass = InProcessBatchSystem
+        logger.info('Using the in process batch system')
     elif batchSystemName == 'gridengine' or batchSystemName == 'gridEngine':
         batchSystemClass = GridengineBatchSystem
         logger.info('Using the grid engine machine batch system')
@@ -358,6 +409,12 @@ def loadJobStore( jobStoreString, config=None ):
         from toil.jobStores.awsJobStore import AWSJobStore
         region, namePrefix = jobStoreArgs.split( ':', 1 )
         return AWSJobStore( region, namePrefix, config=config )
+    elif jobStoreName == 'memory':
+        from toil.jobStores.memoryJobStore import MemoryJobStore
+        return MemoryJobStore( jobStoreArgs, config=config )
+    elif jobStoreName == 'sqlite':
+        from toil.jobStores.sqliteJobStore import SQLiteJobStore
+        return SQLiteJobStore( jobStoreArgs, config=config )
     else:
         raise RuntimeError( "Unknown batchjob store implementation '%s'" % jobStoreName )
 
@@ -20,16 +20,29 @@
 #OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 #THE SOFTWARE.
 from collections import namedtuple
+import copy
+import errno
 import os
+import signal
 import sys
 import importlib
+import itertools
 from optparse import OptionParser
 import xml.etree.cElementTree as ET
 from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
 import tempfile
 import uuid
 import time
+import mmap
+import hashlib
+import urlparse
+import operator
 from toil.resource import ModuleDescriptor
+from toil.resourcePredictor import getResourcePredictions
+from toil.broadcast import Broadcasts, removeBroadcastDir, markWorkflowFinished
+from toil import accumulator
+from toil.pipe import openProducer, openConsumer, startProducing, finishProducing
 
 try:
     import cPickle 
@@ -40,8 +53,13 @@ import logging
 logger = logging.getLogger( __name__ )
 
 from toil.lib.bioio import (setLoggingFromOptions,
-                               getTotalCpuTimeAndMemoryUsage, getTotalCpuTime)
-from toil.common import setupToil, addOptions
+                               getTotalCpuTimeAndMemoryUsage, getTotalCpuTime,
+                               getDirSize)
+from toil.lib.compression import (getCodec, compressedWriteStream, openDecompressed,
+                                  decompressedReadStream, decompressFile, copyStream,
+                                  getFileCodec, getStreamCodec, maxHeaderSize)
+from toil.jobStores.abstractJobStore import RangeReader, NoSuchFileException
+from toil.common import setupToil, addOptions, createConfig, loadJobStore
 from toil.leader import mainLoop
 
 class Job(object):
@@ -70,6 +88,12 @@ class Job(object):
         self._followOns = []
         #See Job.addService
         self._services = []
+        #See Job.addChildren
+        self._lazyChildren = []
+        #See Job.addPipe, the pipes between the children of the job, as tuples
+        #of (pipe, producer, consumer), and the pipes the job produces
+        self._pipes = []
+        self._producedPipes = []
         #A follow-on, service or child of a job A, is a "successor" of A, if B
         #is a successor of A, then A is a predecessor of B. 
         self._predecessors = set()
@@ -117,6 +141,22 @@ class Job(object):
         childJob._addPredecessor(self)
         return childJob
     
+    def addChildren(self, childJobs):
+        """
+        Adds the jobs produced by the iterable childJobs as children of this
+        job, see Job.addChild. The iterable is only consumed once the run
+        method has completed, when the children are written to the jobStore
+        in batches of Job.lazyChildBatchSize as they are produced. A generator
+        can therefore be used to create very many children without holding
+        them all in memory.
+        
+        Each child and its successors must form a job graph of their own,
+        i.e. they must not be connected to any other job. As a consequence
+        the promised return values of the children can only be used by their
+        successors.
+        """
+        self._lazyChildren.append(childJobs)
+    
     def addService(self, service):
         """
         Add a service of type Job.Service. The Job.Service.start() method
@@ -131,6 +171,41 @@ class Job(object):
         self._services.append(jobService)
         return jobService.rv()
     
+    def addPipe(self, pipe, producer, consumer):
+        """
+        Adds the given toil.pipe.Pipe from the child job producer to the 
+        child job consumer, through which the producer streams data to the 
+        consumer without writing it to the jobStore. The pipe is passed to 
+        both jobs as an argument, and opened with Job.FileStore.openPipe.
+        
+        The producer and consumer are scheduled together, the consumer being 
+        issued once the producer has started. If the consumer has not opened 
+        the pipe within the pipe's timeout of the producer opening it, e.g. 
+        because the two run on different nodes, the stream is written to a 
+        global file instead, which the consumer reads. A job can't both 
+        produce and consume pipes.
+        
+        The consumer must read the stream to its end, and fails if the 
+        producer fails. A stream that was streamed rather than written to a 
+        global file is not kept, so if the consumer fails after reading it, 
+        its retries fail too.
+        
+        Returns the pipe.
+        """
+        if producer not in self._children or consumer not in self._children:
+            raise RuntimeError("The producer and consumer of a pipe must be "
+                               "children of the job")
+        if producer is consumer:
+            raise RuntimeError("The producer and consumer of a pipe must differ")
+        for otherPipe, otherProducer, otherConsumer in self._pipes:
+            if pipe is otherPipe:
+                raise RuntimeError("The pipe %s has already been added" % pipe.name)
+            if producer is otherConsumer or consumer is otherProducer:
+                raise RuntimeError("A job can't both produce and consume pipes")
+        self._pipes.append((pipe, producer, consumer))
+        producer._producedPipes.append(pipe)
+        return pipe
+    
     def addFollowOn(self, followOnJob):
         """
         Adds a follow-on job, follow-on jobs will be run
@@ -199,9 +274,24 @@ class Job(object):
         :rtype : A new EncapsulatedJob for this job.
         """
         return EncapsulatedJob(self)
-    
+
+    @staticmethod
+    def mapReduce(mapFn, inputs, reduceFn, fanIn=2, combineFn=None,
+                  chunkSize=1, memory=sys.maxint, cpu=sys.maxint, disk=sys.maxint):
+        """
+        Makes a Job that applies mapFn to each of the inputs and reduces
+        the mapped values with the binary function reduceFn.
+
+        See MapReduceJob.
+
+        :rtype : A new MapReduceJob, whose rv() is the reduced value.
+        """
+        return MapReduceJob(mapFn, inputs, reduceFn, fanIn=fanIn,
+                            combineFn=combineFn, chunkSize=chunkSize,
+                            memory=memory, cpu=cpu, disk=disk)
+
     ####################################################
-    #The following function is used for passing return values between 
+    #The following function is used for passing return values between
     #job run functions
     ####################################################
     
@@ -252,8 +342,10 @@ class Job(object):
                 else:
                     roots.add(job)
                 #The following call ensures we explore all successor edges.
+                #Services are not linked to their job until
+                #_modifyJobGraphForServices, so are not considered here.
                 map(lambda c : getRoots(c), job._children +
-                    job._followOns + job._services)
+                    job._followOns)
         getRoots(self)
         return roots
     
@@ -351,13 +443,101 @@ class Job(object):
                     rootJob = jobStore.load(config.attrib["rootJob"])
                 return mainLoop(config, batchSystem, jobStore, rootJob)
         
+        @staticmethod
+        def runLocal(job, threads=1, options=None):
+            """
+            Runs the toil starting with this job in this process, keeping the 
+            jobStore in memory and running up to the given number of jobs at 
+            once in threads, see toil.batchSystems.inProcess. The jobs are run 
+            as by startToil, with the same semantics for successors, services, 
+            promises and files, which makes runLocal suited to tests and small 
+            workflows. Returns the number of failed jobs, like startToil.
+            
+            The given options (see Job.Runner.getDefaultOptions) are used but 
+            for the jobStore and the batch system. The jobStore is removed once
+            the toil has finished, so it can't be restarted. As the jobs share 
+            the process, they must not change its working directory or 
+            environment, and a job can only be killed while it runs Python code.
+            """
+            options = copy.copy(options or Job.Runner.getDefaultOptions())
+            options.toil = "memory:" + uuid.uuid4().hex
+            options.batchSystem = "inProcess"
+            options.maxCpus = threads
+            setLoggingFromOptions(options)
+            with setupToil(options) as (config, batchSystem, jobStore):
+                try:
+                    return mainLoop(config, batchSystem, jobStore, 
+                                    job._serialiseFirstJob(jobStore))
+                finally:
+                    jobStore.deleteJobStore()
+        
         @staticmethod
         def cleanup(options):
             """
-            Removes the jobStore backing the toil.
+            Removes the jobStore backing the toil, and the broadcast files of 
+            the toil on this node. The toil is marked as finished first, in 
+            case the leader did not exit normally, see 
+            toil.broadcast.markWorkflowFinished.
             """
             with setupToil(options) as (config, batchSystem, jobStore):
+                removeBroadcastDir(config)
+                markWorkflowFinished(config, jobStore)
                 jobStore.deleteJobStore()
+        
+        @staticmethod
+        def importFiles(urls, options, threads=None):
+            """
+            Imports the files at the given URLs into the jobStore given by the 
+            options, creating it if it does not exist, before starting the toil. 
+            Returns a list of fileStoreIDs, in the order of the urls, which can 
+            be passed to the first job. See Job.FileStore.importFiles.
+            
+            The files are kept until they are removed by 
+            Job.Runner.deleteImportedFiles or the jobStore is removed.
+            """
+            config = createConfig(options)
+            jobStore = loadJobStore(config.attrib["job_store"], config=config)
+            holderID = _getImportHolderID(jobStore, create=True)
+            return jobStore.importFiles(holderID, urls, threads)
+        
+        @staticmethod
+        def deleteImportedFiles(options):
+            """
+            Removes the files imported with Job.Runner.importFiles into the 
+            jobStore given by the options, once they are no longer needed.
+            """
+            jobStore = loadJobStore(createConfig(options).attrib["job_store"])
+            holderID = _getImportHolderID(jobStore, create=False)
+            if holderID is not None:
+                #The pointer is deleted last, so that a holder isn't left behind
+                #if the deletion fails
+                jobStore.delete(holderID)
+                jobStore.deleteSharedFile(_importHolderFileName)
+        
+        @staticmethod
+        def exportFiles(fileStoreIDs, destDir, options, fileNames=None, threads=None):
+            """
+            Exports the files with the given fileStoreIDs from the jobStore 
+            given by the options to the local directory destDir, returning the 
+            paths of the files. See Job.FileStore.exportFiles.
+            
+            Only files that have not been deleted with the job that created 
+            them can be exported once the toil has finished, such as files 
+            imported with Job.Runner.importFiles and updated by jobs.
+            """
+            jobStore = loadJobStore(createConfig(options).attrib["job_store"])
+            return _exportFiles(jobStore, fileStoreIDs, destDir, fileNames, threads)
+        
+        @staticmethod
+        def getAccumulatorValues(options):
+            """
+            Returns a dictionary mapping the names of the accumulators of the 
+            toil given by the options to their values, see 
+            Job.FileStore.accumulator. Once Job.Runner.startToil has returned 
+            the values are final.
+            """
+            jobStore = loadJobStore(createConfig(options).attrib["job_store"])
+            return accumulator.readValues(jobStore)
             
     class FileStore:
         """
@@ -375,37 +555,151 @@ class Job(object):
             self.batchjob = batchjob
             self.localTempDir = localTempDir
             self.loggingMessages = []
+            #The buffers returned by readGlobalFileBuffer, closed when the job ends
+            self._buffers = []
+            #The broadcast files used by the job, see broadcast
+            self._broadcasts = None
         
-        def writeGlobalFile(self, localFileName):
+        def writeGlobalFile(self, localFileName, compression=None, immutable=False):
             """
             Takes a file (as a path) and uploads it to to the global file store, returns
             an ID that can be used to retrieve the file. 
+            
+            The file is compressed with the given codec, one of "none", "zlib", 
+            "bz2" or "lzma". If compression is None the codec given by the 
+            --compression option is used. Compressed files are decompressed 
+            transparently when read through the FileStore.
+            
+            If immutable is True the job promises not to modify the local file 
+            afterwards, so that an uncompressed file can be linked into the 
+            jobStore rather than copied, if the jobStore supports it.
             """
-            return self.jobStore.writeFile(self.batchjob.jobStoreID, localFileName)
+            codec = self._getCodec(compression)
+            if codec is None:
+                return self.jobStore.writeFile(self.batchjob.jobStoreID, localFileName,
+                                               immutable=immutable)
+            with self.writeGlobalFileStream(compression) as (fileHandle, fileStoreID):
+                with open(localFileName, 'r') as localFileHandle:
+                    copyStream(localFileHandle, fileHandle)
+            return fileStoreID
         
-        def updateGlobalFile(self, fileStoreID, localFileName):
+        def updateGlobalFile(self, fileStoreID, localFileName, compression=None, 
+                             immutable=False):
             """
             Replaces the existing version of a file in the global file store, 
             keyed by the fileStoreID. 
             Throws an exception if the file does not exist.
+            
+            The compression and immutable arguments are as for writeGlobalFile.
             """
-            self.jobStore.updateFile(fileStoreID, localFileName)
+            codec = self._getCodec(compression)
+            if codec is None:
+                self.jobStore.updateFile(fileStoreID, localFileName, immutable=immutable)
+            else:
+                with self.updateGlobalFileStream(fileStoreID, compression) as fileHandle:
+                    with open(localFileName, 'r') as localFileHandle:
+                        copyStream(localFileHandle, fileHandle)
         
-        def readGlobalFile(self, fileStoreID, localFilePath=None):
+        def readGlobalFile(self, fileStoreID, localFilePath=None, byteRange=None):
             """
             Returns a path to a local copy of the file keyed by fileStoreID. 
             The version will be consistent with the last copy of the file 
             written/updated to the global file store. If localFilePath is not None, 
-            the returned file path will be localFilePath.
+            the returned file path will be localFilePath. If the file was 
+            compressed the local copy is decompressed.
+            
+            If byteRange is not None, it is a tuple of the offset and length of 
+            the bytes of the file to copy, see readGlobalFileStream.
             """
             if localFilePath is None:
                 fd, localFilePath = tempfile.mkstemp(dir=self.getLocalTempDir())
-                self.jobStore.readFile(fileStoreID, localFilePath)
                 os.close(fd)
-            else:
+            if byteRange is None:
                 self.jobStore.readFile(fileStoreID, localFilePath)
+                decompressFile(localFilePath)
+            elif self._getFileCodec(fileStoreID) is None:
+                self.jobStore.readFile(fileStoreID, localFilePath, byteRange)
+            else:
+                with self.readGlobalFileStream(fileStoreID, *byteRange) as fileHandle:
+                    with open(localFilePath, 'w') as localFileHandle:
+                        copyStream(fileHandle, localFileHandle)
+            return localFilePath
+        
+        def readGlobalFileBuffer(self, fileStoreID):
+            """
+            Returns a read-only mmap of the file keyed by fileStoreID, which 
+            supports random access without reading the whole file. If the 
+            jobStore keeps the file in the local file system, as the 
+            FileJobStore does, the mmap is of the file in the jobStore, 
+            otherwise, or if the file was compressed, it is of a local copy 
+            made by readGlobalFile. Pages of the file are shared by all the 
+            processes on the node mapping it.
+            
+            The mmap is closed when the job's run method returns, and must not 
+            be used afterwards. The file must not be updated while mapped. An 
+            empty file is returned as an empty string, as empty files can't be 
+            mapped.
+            """
+            localFilePath = self.jobStore.getLocalFilePath(fileStoreID)
+            if localFilePath is None or getFileCodec(localFilePath) is not None:
+                localFilePath = self.readGlobalFile(fileStoreID)
+            return self._mapFile(localFilePath)
+        
+        def broadcast(self, fileStoreID, buffer=False):
+            """
+            Returns the path of a local, read-only copy of the file keyed by 
+            fileStoreID that is shared by all the jobs of the workflow on the 
+            node, for large inputs read by many jobs. The file is only fetched 
+            once per node, by the first job to broadcast it, later jobs wait 
+            for the fetch to finish. The path is a hard link to the node's copy 
+            in the local temp dir, or, if the link can't be made, the path of 
+            the node's copy itself.
+            
+            If buffer is True, returns a read-only mmap of the node's copy, 
+            see readGlobalFileBuffer.
+            
+            The node's copy is kept until the workflow finishes, it must not be 
+            modified, and the file must not be updated in the global file store 
+            while the workflow runs.
+            """
+            if self._broadcasts is None:
+                self._broadcasts = Broadcasts(self.jobStore.config)
+            sharedFilePath = self._broadcasts.get(fileStoreID, 
+                                                  lambda fileStoreID, localFilePath : 
+                                                  self.readGlobalFile(fileStoreID, localFilePath))
+            if buffer:
+                return self._mapFile(sharedFilePath)
+            localFilePath = os.path.join(self.localTempDir, 
+                                         "broadcast-" + os.path.basename(sharedFilePath))
+            if not os.path.exists(localFilePath):
+                try:
+                    os.link(sharedFilePath, localFilePath)
+                except OSError:
+                    return sharedFilePath
             return localFilePath
         
+        def importFiles(self, urls, threads=None):
+            """
+            Imports the files at the given URLs, which may be file:, http: or 
+            https: URLs or local paths, into the global file store, returning 
+            a list of their fileStoreIDs in the order of the urls. Up to 
+            threads files are transferred concurrently, and the checksum of 
+            each file is verified once it is stored. The files are not 
+            compressed.
+            """
+            return self.jobStore.importFiles(self.batchjob.jobStoreID, urls, threads)
+        
+        def exportFiles(self, fileStoreIDs, destDir, fileNames=None, threads=None):
+            """
+            Copies the files with the given fileStoreIDs to the local directory 
+            destDir, which may also be given as a file: URL, returning the paths 
+            of the copies. The files are named by the given list of fileNames, 
+            or by their fileStoreIDs. Up to threads files are transferred 
+            concurrently, and the checksum of each copy is verified. Exported 
+            files are not decompressed.
+            """
+            return _exportFiles(self.jobStore, fileStoreIDs, destDir, fileNames, threads)
+        
         def deleteGlobalFile(self, fileStoreID):
             """
             Deletes a global file with the given fileStoreID. Returns true if 
@@ -413,22 +707,28 @@ class Job(object):
             """
             return self.jobStore.deleteFile(fileStoreID)
         
-        def writeGlobalFileStream(self):
+        @contextmanager
+        def writeGlobalFileStream(self, compression=None):
             """
             Similar to writeGlobalFile, but returns a context manager yielding a 
             tuple of 1) a file handle which can be written to and 2) the ID of 
             the resulting file in the batchjob store. The yielded file handle does
             not need to and should not be closed explicitly.
             """
-            return self.jobStore.writeFileStream(self.batchjob.jobStoreID)
+            with self.jobStore.writeFileStream(self.batchjob.jobStoreID) as (fileHandle, fileStoreID):
+                with compressedWriteStream(fileHandle, self._getCodec(compression)) as fileHandle:
+                    yield fileHandle, fileStoreID
         
-        def updateGlobalFileStream(self, fileStoreID):
+        @contextmanager
+        def updateGlobalFileStream(self, fileStoreID, compression=None):
             """
             Similar to updateGlobalFile, but returns a context manager yielding 
             a file handle which can be written to. The yielded file handle does 
             not need to and should not be closed explicitly.
             """
-            return self.jobStore.updateFileStream(fileStoreID)
+            with self.jobStore.updateFileStream(fileStoreID) as fileHandle:
+                with compressedWriteStream(fileHandle, self._getCodec(compression)) as fileHandle:
+                    yield fileHandle
         
         def getEmptyFileStoreID(self):
             """
@@ -442,14 +742,42 @@ class Job(object):
             false.
             """
             return self.jobStore.fileExists(fileStoreID)
+
+        def waitForGlobalFileDeletion(self, fileStoreIDs, timeout=None):
+            """
+            Blocks until none of the given fileStoreIDs exist in the global
+            file store, or until timeout seconds have passed. If timeout is None
+            blocks until the files are deleted.
+
+            :rtype : True if all the files were deleted, False if the timeout
+            expired first.
+            """
+            return self.jobStore.waitForFileDeletion(fileStoreIDs, timeout)
         
-        def readGlobalFileStream(self, fileStoreID):
+        @contextmanager
+        def readGlobalFileStream(self, fileStoreID, offset=0, length=None):
             """
             Similar to readGlobalFile, but returns a context manager yielding a 
             file handle which can be read from. The yielded file handle does not 
-            need to and should not be closed explicitly.
+            need to and should not be closed explicitly. If the file was 
+            compressed the data read from the file handle is decompressed.
+            
+            The file handle yields the bytes of the file from the given offset, 
+            up to the given length, or the end of the file if length is None. 
+            Only the requested bytes are read from the jobStore, unless the 
+            file was compressed, in which case the file is decompressed up to 
+            the end of the range.
             """
-            return self.jobStore.readFileStream(fileStoreID)
+            if (offset == 0 and length is None) or self._getFileCodec(fileStoreID) is not None:
+                with self.jobStore.readFileStream(fileStoreID) as fileHandle:
+                    with decompressedReadStream(fileHandle) as fileHandle:
+                        if offset == 0 and length is None:
+                            yield fileHandle
+                        else:
+                            yield RangeReader(fileHandle, offset, length)
+            else:
+                with self.jobStore.readFileStream(fileStoreID, offset, length) as fileHandle:
+                    yield fileHandle
            
         def getLocalTempDir(self):
             """
@@ -459,12 +787,142 @@ class Job(object):
             """
             return self.localTempDir
         
+        def checkpoint(self, state, fileStoreIDs=()):
+            """
+            Saves a checkpoint of the job's progress, so that a retry of the 
+            job, after a failure or after the job was killed, can resume from 
+            it rather than start again, see restoreCheckpoint. The checkpoint 
+            is the given picklable state and the fileStoreIDs of global files 
+            written by the job that the state refers to, which are kept until 
+            the job's batchjob is deleted.
+            
+            Each checkpoint replaces the job's previous checkpoint. The 
+            checkpoint is removed once the job has succeeded.
+            
+            Jobs killed by the leader, for running too long or going missing, 
+            are sent SIGTERM, and only killed with SIGKILL once the grace 
+            period given by --killGracePeriod has passed. SIGTERM raises a 
+            JobTerminatedException in the job, which the job can catch to 
+            save a last checkpoint before re-raising it. A SIGTERM received 
+            while the worker itself writes to the jobStore, rather than 
+            while a job runs, is deferred until the next job starts.
+            """
+            with self.jobStore.writeFileStream(self.batchjob.jobStoreID) as (fileHandle, fileStoreID):
+                cPickle.dump((self.batchjob.command, state, list(fileStoreIDs)), 
+                             fileHandle, cPickle.HIGHEST_PROTOCOL)
+            previousFileStoreID = self.batchjob.checkpointJobStoreFileID
+            self.batchjob.checkpointJobStoreFileID = fileStoreID
+            self.jobStore.update(self.batchjob)
+            if previousFileStoreID is not None:
+                self.jobStore.deleteFile(previousFileStoreID)
+        
+        def restoreCheckpoint(self):
+            """
+            Returns the last checkpoint saved by an earlier attempt of the job, 
+            see checkpoint, as a tuple of the state and the list of 
+            fileStoreIDs, or None if there is no checkpoint.
+            """
+            if self.batchjob.checkpointJobStoreFileID is None:
+                return None
+            with self.jobStore.readFileStream(self.batchjob.checkpointJobStoreFileID) as fileHandle:
+                command, state, fileStoreIDs = cPickle.load(fileHandle)
+            #A checkpoint is only restored by the job that saved it
+            if command != self.batchjob.command:
+                return None
+            return state, fileStoreIDs
+        
+        def accumulator(self, name, initialValue=0, mergeFn=operator.add):
+            """
+            Returns an accumulator, a value aggregated across jobs, such as a 
+            counter or a sum, without a promise per job. The accumulator can be 
+            passed to other jobs, which add values to it with its add method. 
+            The values are merged with mergeFn, which is called with the 
+            current value and the value added, and must be associative and 
+            commutative, as values are merged in any order. mergeFn and the 
+            values must be picklable, mergeFn is typically a function of the 
+            operator module.
+            
+            The additions of a job are sent to the leader once it has 
+            succeeded, the additions of a failed job are discarded. A job can 
+            read the value of an accumulator with readAccumulator, which 
+            includes the additions of all the jobs that finished before it was 
+            issued, such as the children of the job a follow-on follows. The 
+            final values can be read with Job.Runner.getAccumulatorValues 
+            once the toil has finished.
+            
+            Accumulators are identified by name, which must be unique within 
+            the toil.
+            """
+            newAccumulator = accumulator.Accumulator(name, initialValue, mergeFn)
+            accumulator.declare(newAccumulator)
+            return newAccumulator
+        
+        def openPipe(self, pipe, mode='r'):
+            """
+            Returns a context manager yielding a file handle for the given 
+            pipe, see Job.addPipe. The producer of the pipe opens it with 
+            mode 'w' and writes to it, the consumer opens it with mode 'r' 
+            and reads from it. Each pipe can be opened once by its producer 
+            and once by its consumer.
+            """
+            if mode == 'w':
+                return openProducer(pipe, self)
+            if mode == 'r':
+                return openConsumer(pipe, self)
+            raise RuntimeError("Pipes can only be opened with mode 'r' or 'w', not %s" % mode)
+        
+        def readAccumulator(self, accumulator):
+            """
+            Returns the current value of the given accumulator, see 
+            Job.FileStore.accumulator.
+            """
+            return _getAccumulatorValue(accumulator, self.jobStore)
+        
         def logToMaster(self, string):
             """
             Send a logging message to the leader. Will only ne reported if logging 
             is set to INFO level (or lower) in the leader.
             """
             self.loggingMessages.append(str(string))
+        
+        def _getCodec(self, compression):
+            """
+            Returns the codec to compress a global file with, given the 
+            compression argument of the write/update functions.
+            """
+            return _getCodec(self.jobStore.config, compression)
+        
+        def _getFileCodec(self, fileStoreID):
+            """
+            Returns the codec the global file was compressed with, or None, 
+            reading only the header of the file.
+            """
+            with self.jobStore.readFileStream(fileStoreID, 0, maxHeaderSize) as fileHandle:
+                return getStreamCodec(fileHandle)
+        
+        def _mapFile(self, localFilePath):
+            """
+            Returns a read-only mmap of the given file, closed when the job's 
+            run method returns, see readGlobalFileBuffer.
+            """
+            with open(localFilePath, 'r') as fileHandle:
+                if os.fstat(fileHandle.fileno()).st_size == 0:
+                    return ""
+                buf = mmap.mmap(fileHandle.fileno(), 0, access=mmap.ACCESS_READ)
+            self._buffers.append(buf)
+            return buf
+        
+        def _close(self):
+            """
+            Closes the buffers returned by readGlobalFileBuffer and releases 
+            the broadcast files used by the job. Called when the job's run 
+            method returns.
+            """
+            for buf in self._buffers:
+                buf.close()
+            self._buffers = []
+            if self._broadcasts is not None:
+                self._broadcasts.release()
     
     class Service:
         """
@@ -539,18 +997,117 @@ class Job(object):
         """
         Create an empty batchjob for the job.
         """
-        return jobStore.create(command=command,
-                               memory=(self.memory if self.memory != sys.maxint 
-                                       else float(jobStore.config.attrib["default_memory"])),
-                               cpu=(self.cpu if self.cpu != sys.maxint
-                                    else float(jobStore.config.attrib["default_cpu"])),
-                               disk=(self.disk if self.disk != sys.maxint
-                                    else float(jobStore.config.attrib["default_disk"])),
+        memory, cpu, disk = self._getResourceRequirements(jobStore)
+        return jobStore.create(command=command, memory=memory, cpu=cpu, disk=disk,
                                updateID=updateID, predecessorNumber=predecessorNumber)
+    
+    def _getResourceRequirements(self, jobStore):
+        """
+        Returns the memory, cpu and disk requirements of the job. Requirements
+        not specified by the job are predicted from the usage of earlier jobs of
+        the same class, if the predict_resources option is set, and otherwise
+        taken from the defaults.
+        """
+        config = jobStore.config
+        requirements = [self.memory, self.cpu, self.disk]
+        if sys.maxint in requirements and config.attrib.has_key("predict_resources"):
+            predicted = getResourcePredictions(jobStore).get(self._getPredictionKey())
+            if predicted is not None:
+                #Predictions are capped at the maximum that may be requested
+                requirements = [min(predicted[i], float(config.attrib[maximum]))
+                                if requirements[i] == sys.maxint else requirements[i]
+                                for i, maximum in enumerate(("max_memory", "max_cpus", "max_disk"))]
+        return tuple(float(config.attrib[default]) if requirements[i] == sys.maxint 
+                     else requirements[i] 
+                     for i, default in enumerate(("default_memory", "default_cpu", "default_disk")))
+        
+    def _getPredictionKey(self):
+        """
+        Returns the name under which the resource usage of the job is 
+        recorded to predict the requirements of similar jobs, see 
+        toil.resourcePredictor. By default the class of the job.
+        """
+        return self.__class__.__name__
         
-    def _makeJobWrappers(self, jobStore, jobsToUUIDs, jobsToJobs, predecessor, rootJob):
+    def _makeSuccessorWrappers(self, batchjob, jobStore, jobsToUUIDs, jobsToJobs,
+                               lazyUpdateIDs, rootJob, interner):
         """
-        Creates a batchjob for each job in the job graph, recursively.
+        Creates the batchjobs for the followOns and children of the job, 
+        adding them to the stack of the job's batchjob.
+        """
+        #The files of the pipes between the children belong to the root job,
+        #and must exist before the children are pickled
+        for pipe, producer, consumer in self._pipes:
+            pipe.createFiles(jobStore, rootJob.jobStoreID)
+        for successors in (self._followOns, self._children):
+            jobs = map(lambda successor:
+                successor._makeJobWrappers(jobStore, jobsToUUIDs, jobsToJobs, 
+                                           lazyUpdateIDs, self, rootJob, interner), successors)
+            if successors is self._children and len(self._lazyChildren) > 0:
+                jobs += self._makeLazyChildWrappers(jobStore, lazyUpdateIDs[self], rootJob,
+                                                    interner)
+            if len(jobs) > 0:
+                batchjob.stack.append(jobs)
+        batchjob.gangs = self._getPipeGangs(jobsToJobs)
+    
+    def _getPipeGangs(self, jobsToJobs):
+        """
+        Returns the gangs of the consumers of the pipes between the children 
+        of the job and their producers, see BatchJob.gangs.
+        """
+        gangs = {}
+        for pipe, producer, consumer in self._pipes:
+            startFileStoreIDs, producers = gangs.setdefault(jobsToJobs[consumer].jobStoreID,
+                                                            ([], []))
+            startFileStoreIDs.append(pipe.startFileStoreID)
+            producers.append(jobsToJobs[producer].jobStoreID)
+        return [ (consumerJobStoreID, tuple(startFileStoreIDs), tuple(producers))
+                 for consumerJobStoreID, (startFileStoreIDs, producers) in gangs.iteritems() ]
+    
+    #The number of children added by Job.addChildren that are held in memory
+    #at a time while serialising them
+    lazyChildBatchSize = 1000
+    
+    def _makeLazyChildWrappers(self, jobStore, updateID, rootJob, interner):
+        """
+        Consumes the iterables given to Job.addChildren, creating the batchjobs
+        for the children and their successors in batches of
+        Job.lazyChildBatchSize. All the batchjobs are given the updateID, so
+        that they can be removed together if the update of the job graph fails.
+        Returns the list of stack entries for the children.
+        """
+        jobs = []
+        children = itertools.chain(*self._lazyChildren)
+        self._lazyChildren = []
+        while True:
+            batch = list(itertools.islice(children, self.lazyChildBatchSize))
+            if len(batch) == 0:
+                break
+            jobsToUUIDs = {}
+            for child in batch:
+                #The child must be the root of its own job graph
+                if len(child._predecessors) > 0:
+                    raise JobGraphDeadlockException("The job %s added with addChildren has "
+                                                    "predecessors" % child)
+                child.checkJobGraphForDeadlocks()
+                child._setFileIDsForPromisedValues(jobStore, rootJob.jobStoreID, set())
+                child._addPredecessor(self)
+                child._getHashOfJobsToUUIDs2(jobsToUUIDs)
+            jobsToUUIDs = dict.fromkeys(jobsToUUIDs, updateID)
+            #Children added lazily by the children themselves share the updateID
+            lazyUpdateIDs = dict.fromkeys(filter(lambda job : len(job._lazyChildren) > 0,
+                                                 jobsToUUIDs), updateID)
+            jobsToJobs = {}
+            jobs += map(lambda child:
+                child._makeJobWrappers(jobStore, jobsToUUIDs, jobsToJobs,
+                                       lazyUpdateIDs, self, rootJob, interner), batch)
+        return jobs
+    
+    def _makeJobWrappers(self, jobStore, jobsToUUIDs, jobsToJobs, lazyUpdateIDs, 
+                         predecessor, rootJob, interner):
+        """
+        Creates a batchjob for each job in the job graph, recursively. The 
+        interner is an ArgumentInterner shared by the jobs of the graph.
         """
         if self not in jobsToJobs:
             #The batchjob for the job
@@ -560,12 +1117,8 @@ class Job(object):
             jobsToJobs[self] = batchjob
             
             #Add followOns/children to be run after the current job.
-            for successors in (self._followOns, self._children):
-                jobs = map(lambda successor:
-                    successor._makeJobWrappers(jobStore, jobsToUUIDs,
-                                               jobsToJobs, self, rootJob), successors)
-                if len(jobs) > 0:
-                    batchjob.stack.append(jobs)
+            self._makeSuccessorWrappers(batchjob, jobStore, jobsToUUIDs, jobsToJobs,
+                                        lazyUpdateIDs, rootJob, interner)
             
             #Pickle the job so that its run method can be run at a later time.
             #Drop out the children/followOns/predecessors/services - which are 
@@ -574,13 +1127,15 @@ class Job(object):
             self._children = []
             self._followOns = []
             self._services = []
+            self._pipes = []
             self._predecessors = set()
             #The pickled job is "run" as the command of the batchjob, see worker
             #for the mechanism which unpickles the job and executes the Job.run
-            #method.
-            fileStoreID = jobStore.getEmptyFileStoreID(rootJob.jobStoreID)
+            #method. Large arguments shared with other jobs are stored once by
+            #the interner.
             with jobStore.writeFileStream(rootJob.jobStoreID) as (fileHandle, fileStoreID):
-                cPickle.dump(self, fileHandle, cPickle.HIGHEST_PROTOCOL)
+                with compressedWriteStream(fileHandle, _getCodec(jobStore.config)) as fileHandle:
+                    interner.dump(self, fileHandle)
             jobClassName = self.__class__.__name__
             batchjob.command = ' '.join( ('scriptTree', fileStoreID, jobClassName) + self.userModule)
             #Update the status of the batchjob on disk
@@ -598,31 +1153,43 @@ class Job(object):
         return (batchjob.jobStoreID, batchjob.memory, batchjob.cpu, batchjob.disk,
                 None if batchjob.predecessorNumber <= 1 else str(uuid.uuid4()))
     
-    def _serialiseJobGraph(self, batchjob, jobStore):
+    def _serialiseJobGraph(self, batchjob, jobStore, gang=None):
         """
         Serialises the graph of jobs rooted at this job,
         storing them in the jobStore.
         Assumes the root job is already in the jobStore.
+        The gang argument is the return value of _modifyJobGraphForServices.
         """
         #Create jobIDs as UUIDs
         jobsToUUIDs = self._getHashOfJobsToUUIDs({})
-        #Set the jobs to delete
-        batchjob.jobsToDelete = list(jobsToUUIDs.values())
-        #Update the batchjob on disk. The jobs to delete is a record of what to
-        #remove if the update goes wrong
-        jobStore.update(batchjob)
-        #Create the jobs for followOns/children
-        jobsToJobs = {}
-        for successors in (self._followOns, self._children):
-            jobs = map(lambda successor:
-                successor._makeJobWrappers(jobStore, jobsToUUIDs,
-                                           jobsToJobs, self, batchjob), successors)
-            if len(jobs) > 0:
-                batchjob.stack.append(jobs)
-        #Remove the jobs to delete list and remove the old command finishing the update
-        batchjob.jobsToDelete = []
-        batchjob.command = None
-        jobStore.update(batchjob)
+        #The children added by Job.addChildren are not yet known, so all the
+        #children of a job added this way, and their successors, share one UUID
+        lazyUpdateIDs = dict(map(lambda job : (job, str(uuid.uuid1())),
+                                 filter(lambda job : len(job._lazyChildren) > 0,
+                                        jobsToUUIDs.keys() + [self])))
+        #Stores that support it create the successors and update the batchjob
+        #in one transaction
+        with jobStore.batch():
+            #Set the jobs to delete
+            batchjob.jobsToDelete = list(jobsToUUIDs.values()) + lazyUpdateIDs.values()
+            #Update the batchjob on disk. The jobs to delete is a record of what to
+            #remove if the update goes wrong
+            jobStore.update(batchjob)
+            #Create the jobs for followOns/children
+            jobsToJobs = {}
+            self._makeSuccessorWrappers(batchjob, jobStore, jobsToUUIDs, jobsToJobs,
+                                        lazyUpdateIDs, batchjob, 
+                                        ArgumentInterner(jobStore, batchjob.jobStoreID))
+            #Record the gang of services and their clients for the leader, the
+            #gangs of pipes have been recorded by _makeSuccessorWrappers
+            if gang is not None:
+                clientsJob, startFileStoreIDs, services = gang
+                batchjob.gangs.append((jobsToJobs[clientsJob].jobStoreID, tuple(startFileStoreIDs),
+                                       tuple(jobsToJobs[service].jobStoreID for service in services)))
+            #Remove the jobs to delete list and remove the old command finishing the update
+            batchjob.jobsToDelete = []
+            batchjob.command = None
+            jobStore.update(batchjob)
         
     def _serialiseFirstJob(self, jobStore):
         """
@@ -632,7 +1199,8 @@ class Job(object):
         #"firstJob"
         sharedJobFile = "firstJob"
         with jobStore.writeSharedFileStream(sharedJobFile) as f:
-            cPickle.dump(self, f, cPickle.HIGHEST_PROTOCOL)
+            with compressedWriteStream(f, _getCodec(jobStore.config)) as f:
+                cPickle.dump(self, f, cPickle.HIGHEST_PROTOCOL)
         #Make the first batchjob
         jobClassName = self.__class__.__name__
         command = ('scriptTree', sharedJobFile, jobClassName) + self.userModule
@@ -787,7 +1355,10 @@ class Job(object):
     def _modifyJobGraphForServices(self, fileStore):
         """
         Modifies the job graph to correctly schedule any services
-        defined for this job.
+        defined for this job. Returns None if the job has no services, else
+        a tuple of the job that runs the clients of the services, the
+        jobStoreFileIDs that are deleted once the services have started and
+        the services, see BatchJob.gangs.
         """
         if len(self._services) > 0:
             #Set the start/stop jobStore fileIDs for each service
@@ -802,14 +1373,20 @@ class Job(object):
                 job._predecessors.remove(self)
             
             #t1 and t2 are used to run the children and followOns of the job
-            #after the services of the job are started
+            #after the services of the job are started. The leader does not
+            #issue t1 until the services have deleted their startFileStoreIDs,
+            #so no batch system slot is spent waiting for the services.
             startFileStoreIDs = map(lambda i : i.startFileStoreID, self._services)
-            t1, t2 = Job.wrapJobFn(blockUntilDeleted, startFileStoreIDs), Job()
+            t1, t2 = Job(), Job()
             #t1 runs the children of the job
             for child in self._children:
                 removePredecessor(child)
                 t1.addChild(child)
             self._children = []
+            t1._lazyChildren = self._lazyChildren
+            self._lazyChildren = []
+            t1._pipes = self._pipes
+            self._pipes = []
             #t2 runs the followOns of the job
             for followOn in self._followOns:
                 removePredecessor(followOn)
@@ -825,7 +1402,10 @@ class Job(object):
             #The final task once t1 and t2 have finished is to stop the services
             #this is achieved by deleting the stopFileStoreIDs.
             t2.addFollowOnJobFn(deleteFileStoreIDs, map(lambda i : i.stopFileStoreID, self._services))
+            services = self._services
             self._services = [] #Defensive
+            return t1, startFileStoreIDs, services
+        return None
     
     ####################################################
     #Function which worker calls to ultimately invoke
@@ -843,9 +1423,20 @@ class Job(object):
         baseDir = os.getcwd()
         #Switch out any promised return value instances with the actual values
         self._switchOutPromisedJobReturnValues(jobStore)
+        #Drop any additions to accumulators made by a failed job
+        accumulator.discardJobUpdates()
         #Run the job, first cleanup then run.
         fileStore = Job.FileStore(jobStore, batchjob, localTempDir)
-        returnValues = self.run(fileStore)
+        #The consumers of the pipes the job produces are issued once it starts
+        startProducing(self._producedPipes, jobStore)
+        succeeded = False
+        try:
+            with workerTermination.runningJob():
+                returnValues = self.run(fileStore)
+            succeeded = True
+        finally:
+            fileStore._close()
+            finishProducing(self._producedPipes, jobStore, succeeded)
         #Check if the job graph has created
         #any cycles of dependencies or has multiple roots
         self.checkJobGraphForDeadlocks()
@@ -854,9 +1445,15 @@ class Job(object):
         #Store the return values for any promised return value
         self._setReturnValuesForPromises(self, returnValues, jobStore)
         #Modify job graph to run any services correctly
-        self._modifyJobGraphForServices(fileStore)
+        gang = self._modifyJobGraphForServices(fileStore)
+        #The job succeeded, so its checkpoint is removed once the batchjob has
+        #been updated
+        checkpointJobStoreFileID = batchjob.checkpointJobStoreFileID
+        batchjob.checkpointJobStoreFileID = None
         #Turn the graph into a graph of jobs in the jobStore
-        self._serialiseJobGraph(batchjob, jobStore)
+        self._serialiseJobGraph(batchjob, jobStore, gang)
+        if checkpointJobStoreFileID is not None:
+            jobStore.deleteFile(checkpointJobStoreFileID)
         #Change dir back to cwd dir, if changed by job (this is a safety issue)
         if os.getcwd() != baseDir:
             os.chdir(baseDir)
@@ -867,7 +1464,11 @@ class Job(object):
             totalCpuTime, totalMemoryUsage = getTotalCpuTimeAndMemoryUsage()
             stats.attrib["clock"] = str(totalCpuTime - startClock)
             stats.attrib["class"] = ".".join((self.__class__.__name__,))
+            stats.attrib["predictionKey"] = self._getPredictionKey()
             stats.attrib["memory"] = str(totalMemoryUsage)
+            stats.attrib["disk"] = str(getDirSize(localTempDir))
+        #The job succeeded, so its additions to accumulators are kept
+        accumulator.commitJobUpdates()
         #Return any logToMaster logging messages
         return fileStore.loggingMessages
     
@@ -904,6 +1505,56 @@ class JobGraphDeadlockException( Exception ):
     def __init__( self, string ):
         super( JobGraphDeadlockException, self ).__init__( string )
 
+class JobTerminatedException( BaseException ):
+    """
+    Raised in a job when its worker is sent SIGTERM, see Job.FileStore.checkpoint. 
+    Like KeyboardInterrupt, it is not an Exception, so that it isn't caught by 
+    handlers of errors. It is also raised in the thread of a job killed by the 
+    in process batch system, which instantiates it without arguments.
+    """
+    def __init__( self, string="The job was terminated" ):
+        super( JobTerminatedException, self ).__init__( string )
+
+class _WorkerTermination( object ):
+    """
+    Handles the SIGTERM sent to a worker, see toil.worker.main. The 
+    JobTerminatedException is only raised while the code of a job runs, a 
+    signal received while the worker itself writes to the jobStore is 
+    deferred until the next job starts.
+    """
+    def __init__( self ):
+        #The signal received, if any
+        self.signalNumber = None
+        self.inJob = False
+    
+    def handleSignal( self, signalNumber, frame ):
+        #The exception is raised once, a second SIGTERM must not interrupt
+        #the checkpoint
+        signal.signal( signal.SIGTERM, signal.SIG_IGN )
+        self.signalNumber = signalNumber
+        if self.inJob:
+            self.inJob = False
+            self._raise( )
+    
+    @contextmanager
+    def runningJob( self ):
+        """
+        Context manager for running the code of a job, in which the 
+        exception is raised.
+        """
+        if self.signalNumber is not None:
+            self._raise( )
+        self.inJob = True
+        try:
+            yield
+        finally:
+            self.inJob = False
+    
+    def _raise( self ):
+        raise JobTerminatedException( "The worker was sent signal %i" % self.signalNumber )
+
+workerTermination = _WorkerTermination( )
+
 class FunctionWrappingJob(Job):
     """
     Job used to wrap a function.
@@ -935,6 +1586,13 @@ class FunctionWrappingJob(Job):
 
     def getUserScript(self):
         return self.userFunctionModule
+    
+    def _getPredictionKey(self):
+        """
+        Jobs wrapping different functions use different resources, so are 
+        told apart by the module and name of the function.
+        """
+        return "%s.%s" % (self.userFunctionModule.name, self.userFunctionName)
 
 class JobFunctionWrappingJob(FunctionWrappingJob):
     """
@@ -991,8 +1649,7 @@ class ServiceJob(Job):
         #Now block until we are told to stop, which is indicated by the removal 
         #of a file
         assert self.stopFileStoreID != None
-        while fileStore.globalFileExists(self.stopFileStoreID):
-            time.sleep(1) #Avoid excessive polling
+        fileStore.waitForGlobalFileDeletion([self.stopFileStoreID])
         #Now kill the service
         self.service.stop()
         
@@ -1037,6 +1694,9 @@ class EncapsulatedJob(Job):
         
     def addChild(self, childJob):
         return Job.addChild(self.followOn, childJob)
+
+    def addChildren(self, childJobs):
+        return Job.addChildren(self.followOn, childJobs)
     
     def addService(self, service):
         return Job.addService(self.followOn, service)
@@ -1047,6 +1707,281 @@ class EncapsulatedJob(Job):
     def rv(self, argIndex=0):
         return self.followOn.rv(argIndex)
 
+class UserFunction(object):
+    """
+    A picklable reference to a module level user function. The function is
+    looked up by name when called, importing its module in the same way as
+    FunctionWrappingJob does, so functions defined in the main script of a
+    workflow can be passed to jobs as arguments.
+    """
+    def __init__(self, userFunction):
+        self.userFunctionModule = ModuleDescriptor.forModule(userFunction.__module__)
+        self.userFunctionName = str(userFunction.__name__)
+
+    def __call__(self, *args, **kwargs):
+        userFunctionModule = self.userFunctionModule.localize()
+        if userFunctionModule.dirPath not in sys.path:
+            sys.path.append(userFunctionModule.dirPath)
+        userFunction = getattr(importlib.import_module(userFunctionModule.name),
+                               self.userFunctionName)
+        return userFunction(*args, **kwargs)
+
+class MapReduceJob(Job):
+    """
+    Job used to map a function over a list of inputs and reduce the mapped
+    values, see Job.mapReduce.
+
+    The inputs are split into chunks of chunkSize inputs. Each chunk is mapped
+    by a separate job, which applies mapFn to each input of the chunk in turn.
+    If combineFn is given the mapped values of a chunk are folded with combineFn
+    before they leave the map job, else they are written out individually.
+
+    The chunks are reduced by a balanced tree of jobs in which each reduce job
+    has at most fanIn predecessors, so the depth of the tree is
+    O(log_fanIn(number of chunks)). Each reduce job folds, in input order, the
+    values written by its predecessors with reduceFn, reading them one at a
+    time from global files rather than receiving them as promises, so a reduce
+    job only ever holds one partial result plus the accumulated value in memory.
+
+    mapFn, reduceFn and combineFn must be module level functions. reduceFn and
+    combineFn must be associative, but need not be commutative.
+
+    The rv() of a MapReduceJob is the reduced value, or None if there were
+    no inputs. Like an EncapsulatedJob, children and follow-ons added to a
+    MapReduceJob are run after the reduction is complete.
+    """
+    def __init__(self, mapFn, inputs, reduceFn, fanIn=2, combineFn=None,
+                 chunkSize=1, memory=sys.maxint, cpu=sys.maxint, disk=sys.maxint):
+        if fanIn < 2:
+            raise RuntimeError("The fanIn of a map/reduce must be at least two: %s" % fanIn)
+        if chunkSize < 1:
+            raise RuntimeError("The chunkSize of a map/reduce must be at least one: %s" % chunkSize)
+        Job.__init__(self)
+        self.spec = MapReduceSpec(mapFn=UserFunction(mapFn),
+                                  reduceFn=UserFunction(reduceFn),
+                                  combineFn=None if combineFn is None else UserFunction(combineFn),
+                                  fanIn=fanIn,
+                                  resources=dict(memory=memory, cpu=cpu, disk=disk))
+        self.inputs = list(inputs)
+        self.chunkSize = chunkSize
+        #The follow-on loads the reduced value and returns it as its return value
+        self.followOn = JobFunctionWrappingJob(loadMapReduceResult, self.spec,
+                                               Job.rv(self, 0))
+        Job.addFollowOn(self, self.followOn)
+
+    def run(self, fileStore):
+        outputFileStoreID = fileStore.getEmptyFileStoreID()
+        chunks = [ self.inputs[i:i+self.chunkSize] for i in
+                  xrange(0, len(self.inputs), self.chunkSize) ]
+        if len(chunks) > 0:
+            Job.addChild(self, JobFunctionWrappingJob(mapReduceNode, self.spec, chunks,
+                                                      outputFileStoreID, root=True,
+                                                      **self.spec.resources))
+        return outputFileStoreID
+
+    def addChild(self, childJob):
+        return Job.addChild(self.followOn, childJob)
+
+    def addChildren(self, childJobs):
+        return Job.addChildren(self.followOn, childJobs)
+
+    def addService(self, service):
+        return Job.addService(self.followOn, service)
+
+    def addFollowOn(self, followOnJob):
+        return Job.addFollowOn(self.followOn, followOnJob)
+
+    def rv(self, argIndex=0):
+        return self.followOn.rv(argIndex)
+
+MapReduceSpec = namedtuple('MapReduceSpec', ('mapFn', 'reduceFn', 'combineFn',
+                                             'fanIn', 'resources'))
+
+def mapReduceNode(job, spec, chunks, outputFileStoreID, root=False):
+    """
+    Job function for a node of the reduction tree of a MapReduceJob. A node
+    with a single chunk maps the chunk, else the chunks are split into
+    at most spec.fanIn groups of near equal size, each handled by a child node,
+    and a follow-on reduces the values of the children. The root node, which
+    has no reduction after it, folds the values of a single chunk with
+    spec.reduceFn unless there is a combineFn.
+    """
+    if len(chunks) == 1:
+        values = itertools.imap(spec.mapFn, chunks[0])
+        if spec.combineFn is not None:
+            values = [ reduce(spec.combineFn, values) ]
+        elif root:
+            values = [ reduce(spec.reduceFn, values) ]
+        with job.fileStore.updateGlobalFileStream(outputFileStoreID) as fileHandle:
+            for value in values:
+                cPickle.dump(value, fileHandle, cPickle.HIGHEST_PROTOCOL)
+    else:
+        groupNumber = min(spec.fanIn, len(chunks))
+        partialFileStoreIDs = []
+        for i in xrange(groupNumber):
+            group = chunks[(i * len(chunks)) / groupNumber:((i+1) * len(chunks)) / groupNumber]
+            partialFileStoreIDs.append(job.fileStore.getEmptyFileStoreID())
+            job.addChildJobFn(mapReduceNode, spec, group,
+                              partialFileStoreIDs[-1], **spec.resources)
+        job.addFollowOnJobFn(mapReduceReduce, spec, partialFileStoreIDs,
+                             outputFileStoreID, **spec.resources)
+
+def mapReduceReduce(job, spec, partialFileStoreIDs, outputFileStoreID):
+    """
+    Job function that folds the values in the given partial files with
+    spec.reduceFn, writes the result to the output file and deletes the
+    partial files.
+    """
+    reducedValue = []
+    for partialFileStoreID in partialFileStoreIDs:
+        with job.fileStore.readGlobalFileStream(partialFileStoreID) as fileHandle:
+            for value in loadPickles(fileHandle):
+                reducedValue = [ spec.reduceFn(reducedValue[0], value)
+                                if len(reducedValue) > 0 else value ]
+    with job.fileStore.updateGlobalFileStream(outputFileStoreID) as fileHandle:
+        for value in reducedValue:
+            cPickle.dump(value, fileHandle, cPickle.HIGHEST_PROTOCOL)
+    map(job.fileStore.deleteGlobalFile, partialFileStoreIDs)
+
+def loadMapReduceResult(job, spec, outputFileStoreID):
+    """
+    Job function that returns the reduced value of a MapReduceJob, or None
+    if there were no inputs, and deletes the file that held it. Should the file
+    hold more than one value they are folded with spec.reduceFn.
+    """
+    with job.fileStore.readGlobalFileStream(outputFileStoreID) as fileHandle:
+        values = list(loadPickles(fileHandle))
+    job.fileStore.deleteGlobalFile(outputFileStoreID)
+    return reduce(spec.reduceFn, values) if len(values) > 0 else None
+
+def loadPickles(fileHandle):
+    """
+    Iterates over the objects pickled one after another into the given file.
+    """
+    while True:
+        try:
+            yield cPickle.load(fileHandle)
+        except EOFError:
+            break
+
+class ArgumentInterner(object):
+    """
+    Pickles the jobs of a job graph being serialised, storing each of their 
+    large arguments once, in a file of its own in the jobStore, and replacing 
+    the arguments in the pickles of the jobs by references to the files. 
+    Workers resolve the references when loading the jobs, see loadJob.
+    
+    The arguments of a job are its attributes, except that for attributes that 
+    are tuples or dicts, such as the arguments of a job function, the arguments 
+    are their elements. Arguments of the builtin types whose pickles are at 
+    least minSize bytes are interned. An argument shared by many jobs is 
+    pickled once, as are arguments with the same pickle.
+    """
+    minSize = 16 * 1024
+    
+    internedTypes = (str, unicode, list, tuple, dict, set, frozenset)
+    
+    #The maximum total size of the pickles of interned arguments cached by a 
+    #worker process
+    maxCacheSize = 256 * 1024 * 1024
+    
+    #Map of fileStoreIDs of interned arguments to their pickles, see loadJob
+    _cache = {}
+    
+    def __init__(self, jobStore, jobStoreID):
+        """
+        Interned arguments are stored as files of the batchjob with the given
+        jobStoreID, as are the pickles of the jobs.
+        """
+        self.jobStore = jobStore
+        self.jobStoreID = jobStoreID
+        #Map of the ids of the arguments seen to the argument, which keeps the 
+        #id valid, and the fileStoreID of the argument, or None if the 
+        #argument is not interned
+        self.arguments = {}
+        #Map of the hashes of the pickles of the interned arguments to their 
+        #fileStoreIDs
+        self.hashes = {}
+    
+    def dump(self, job, fileHandle):
+        """
+        Pickles the job to the file handle.
+        """
+        #The references are made distinct for distinct arguments with the same
+        #pickle, so that they are not loaded as one object
+        references = {}
+        for argument in self._getArguments(job):
+            fileStoreID = self._intern(argument)
+            if fileStoreID is not None and id(argument) not in references:
+                references[id(argument)] = (fileStoreID, len(references))
+        pickler = cPickle.Pickler(fileHandle, cPickle.HIGHEST_PROTOCOL)
+        if len(references) > 0:
+            pickler.persistent_id = lambda obj : references.get(id(obj))
+        pickler.dump(job)
+    
+    def _getArguments(self, job):
+        for value in job.__dict__.itervalues():
+            if isinstance(value, tuple):
+                values = value
+            elif isinstance(value, dict):
+                values = value.itervalues()
+            else:
+                values = (value,)
+            for argument in values:
+                if isinstance(argument, self.internedTypes):
+                    yield argument
+    
+    def _intern(self, argument):
+        """
+        Returns the fileStoreID of the interned argument, storing it if it 
+        was not already, or None if the argument is too small to intern.
+        """
+        if id(argument) not in self.arguments:
+            fileStoreID = None
+            data = cPickle.dumps(argument, cPickle.HIGHEST_PROTOCOL)
+            if len(data) >= self.minSize:
+                digest = hashlib.sha1(data).hexdigest()
+                if digest not in self.hashes:
+                    with self.jobStore.writeFileStream(self.jobStoreID) as (fileHandle, 
+                                                                            fileStoreID):
+                        with compressedWriteStream(fileHandle, 
+                                                   _getCodec(self.jobStore.config)) as fileHandle:
+                            fileHandle.write(data)
+                    self.hashes[digest] = fileStoreID
+                fileStoreID = self.hashes[digest]
+            self.arguments[id(argument)] = (argument, fileStoreID)
+        return self.arguments[id(argument)][1]
+    
+    @classmethod
+    def loadJob(cls, fileHandle, jobStore):
+        """
+        Unpickles a job pickled by dump from the file handle, loading its 
+        interned arguments from the jobStore. The pickles of the arguments are 
+        cached, so that the arguments of later jobs run by the worker that 
+        share them are not read again, but each job gets its own copy of them.
+        """
+        arguments = {}
+        def persistentLoad(reference):
+            if reference not in arguments:
+                fileStoreID = reference[0]
+                arguments[reference] = cPickle.loads(cls._loadPickle(fileStoreID, jobStore))
+            return arguments[reference]
+        unpickler = cPickle.Unpickler(fileHandle)
+        unpickler.persistent_load = persistentLoad
+        return unpickler.load()
+    
+    @classmethod
+    def _loadPickle(cls, fileStoreID, jobStore):
+        #The cache may be cleared by another thread, see Job.Runner.runLocal
+        data = cls._cache.get(fileStoreID)
+        if data is None:
+            with jobStore.readFileStream(fileStoreID) as fileHandle:
+                data = openDecompressed(fileHandle).read()
+            if sum(map(len, cls._cache.values())) + len(data) > cls.maxCacheSize:
+                cls._cache.clear()
+            cls._cache[fileStoreID] = data
+        return data
+
 class PromisedJobReturnValue():
     """
     References a return value from a Job's run function. Let T be a job.
@@ -1088,15 +2023,59 @@ def deleteFileStoreIDs(job, jobStoreFileIDsToDelete):
     """
     map(lambda i : job.fileStore.deleteGlobalFile(i), jobStoreFileIDsToDelete)
 
-def blockUntilDeleted(job, jobStoreFileIDs):
+def _getCodec(config, compression=None):
     """
-    Function will not terminate until all the fileStoreIDs in jobStoreFileIDs
-    cease to exist.
+    Returns the codec to compress a file with, or None if it is to be stored
+    uncompressed, given a codec name or None to use the codec given by the
+    --compression option.
     """
-    while True:
-        jobStoreFileIDs = [ i for i in jobStoreFileIDs
-                           if job.fileStore.globalFileExists(i) ]
-        if len(jobStoreFileIDs) == 0:
-            break
-        time.sleep(1)
-        
+    if compression is None:
+        compression = config.attrib.get("compression")
+    return getCodec(compression)
+
+def _exportFiles(jobStore, fileStoreIDs, destDir, fileNames, threads):
+    """
+    Implements Job.FileStore.exportFiles and Job.Runner.exportFiles.
+    """
+    scheme, _, path = urlparse.urlparse(destDir)[:3]
+    if scheme not in ('', 'file'):
+        raise RuntimeError("Can't export to '%s', only local directories and file: URLs "
+                           "are supported" % destDir)
+    if fileNames is None:
+        fileNames = [ fileStoreID.replace('/', '_') for fileStoreID in fileStoreIDs ]
+    localFilePaths = [ os.path.join(path, fileName) for fileName in fileNames ]
+    jobStore.exportFiles(fileStoreIDs, localFilePaths, threads)
+    return localFilePaths
+
+#The shared file holding the jobStoreID of the batchjob the files imported by 
+#Job.Runner.importFiles belong to
+_importHolderFileName = "importedFiles"
+
+def _getImportHolderID(jobStore, create):
+    """
+    Returns the jobStoreID of the batchjob holding the files imported by 
+    Job.Runner.importFiles, creating the batchjob if there is none and create 
+    is True, else returning None. The batchjob is never run, a single one is
+    shared by all the imports into the jobStore.
+    """
+    try:
+        with jobStore.readSharedFileStream(_importHolderFileName) as fileHandle:
+            holderID = fileHandle.read()
+    except NoSuchFileException:
+        holderID = None
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        holderID = None
+    if holderID is None and create:
+        holderID = jobStore.create(command=None, memory=0, cpu=0, disk=0).jobStoreID
+        with jobStore.writeSharedFileStream(_importHolderFileName) as fileHandle:
+            fileHandle.write(holderID)
+    return holderID
+
+def _getAccumulatorValue(accumulatorToRead, jobStore):
+    """
+    Implements Job.FileStore.readAccumulator, whose argument hides the 
+    accumulator module.
+    """
+    return accumulator.getValue(accumulatorToRead, jobStore)
@@ -1,6 +1,13 @@
 from abc import ABCMeta, abstractmethod
 from contextlib import contextmanager
+import hashlib
+from multiprocessing.pool import ThreadPool
+import os
 import re
+import tempfile
+import time
+import urllib2
+import urlparse
 import xml.etree.cElementTree as ET
 
 class NoSuchJobException( Exception ):
@@ -16,6 +23,61 @@ class NoSuchFileException( Exception ):
     def __init__( self, fileJobStoreID ):
         super( NoSuchFileException, self ).__init__( "The file '%s' does not exist" % fileJobStoreID )
 
+class ChecksumMismatchException( Exception ):
+    def __init__( self, source, destination ):
+        super( ChecksumMismatchException, self ).__init__(
+            "The checksum of '%s' does not match that of its source '%s'" % ( destination, source ) )
+
+class RangeReader( object ):
+    """
+    A readable file-like object yielding a range of the bytes of another. Used by job stores
+    that can't limit reads of a file to a range of it more efficiently, see
+    AbstractJobStore.readFileStream.
+    """
+    # The size of the chunks read when skipping the bytes before the range
+    chunkSize = 64 * 1024
+
+    def __init__( self, fileHandle, offset=0, length=None ):
+        """
+        Skips the bytes of the given file handle up to the given offset, seeking if the file
+        handle supports it.
+        """
+        self.fileHandle = fileHandle
+        self.remaining = length
+        try:
+            fileHandle.seek( offset, os.SEEK_CUR )
+        except (AttributeError, IOError):
+            while offset > 0:
+                data = fileHandle.read( min( offset, self.chunkSize ) )
+                if not data:
+                    break
+                offset -= len( data )
+
+    def _limit( self, size ):
+        if self.remaining is None:
+            return size
+        return self.remaining if size < 0 else min( size, self.remaining )
+
+    def _consumed( self, data ):
+        if self.remaining is not None:
+            self.remaining -= len( data )
+        return data
+
+    def read( self, size=-1 ):
+        return self._consumed( self.fileHandle.read( self._limit( size ) ) )
+
+    def readline( self, size=-1 ):
+        return self._consumed( self.fileHandle.readline( self._limit( size ) ) )
+
+    def readlines( self ):
+        return list( self )
+
+    def __iter__( self ):
+        return iter( self.readline, "" )
+
+    def close( self ):
+        pass
+
 class AbstractJobStore( object ):
     """ 
     Represents the physical storage for the jobs and associated files in a toil.
@@ -43,6 +105,15 @@ class AbstractJobStore( object ):
     @property
     def config( self ):
         return self.__config
+
+    @classmethod
+    def isProcessLocal( cls ):
+        """
+        Whether the store can only be used by the process that created it, in which case the
+        leader collates the stats and logging in a thread rather than a process and the jobs
+        must be run in the leader's process, see Job.Runner.runLocal.
+        """
+        return False
     
     @abstractmethod
     def deleteJobStore( self ):
@@ -83,7 +154,7 @@ class AbstractJobStore( object ):
             #those jobs from the stack (this cleans up the case that the batchjob
             #had successors to run, but had not been updated to reflect this)
             while len(batchjob.stack) > 0:
-                jobs = [ command[0] for command in batchjob.stack[-1] if self.exists(command[0]) ]
+                jobs = [ command for command in batchjob.stack[-1] if self.exists(command[0]) ]
                 if len(jobs) < len(batchjob.stack[-1]):
                     changed = True
                     if len(jobs) > 0:
@@ -194,26 +265,39 @@ class AbstractJobStore( object ):
         """
         raise NotImplementedError( )
 
+    @contextmanager
+    def batch( self ):
+        """
+        Returns a context manager within which the batchjobs created, updated and deleted by
+        the calling thread may be changed together, e.g. in one transaction, so that none or
+        all of the changes are made. The changes may only be seen once the batch ends, also by
+        the calling thread. This implementation makes each change on its own.
+        """
+        yield
+
     ##########################################
     #The following provide an way of creating/reading/writing/updating files 
     #associated with a given batchjob.
     ##########################################  
 
     @abstractmethod
-    def writeFile( self, jobStoreID, localFilePath ):
+    def writeFile( self, jobStoreID, localFilePath, immutable=False ):
         """
         Takes a file (as a path) and places it in this batchjob store. Returns an ID that can be used
         to retrieve the file at a later time. jobStoreID is the id of the batchjob from which the file
         is being created. When delete(batchjob) is called all files written with the given
         batchjob.jobStoreID will be removed from the jobStore.
+
+        If immutable is True the caller won't modify the local file afterwards, so the store may
+        link the file rather than copy it.
         """
         raise NotImplementedError( )
 
     @abstractmethod
-    def updateFile( self, jobStoreFileID, localFilePath ):
+    def updateFile( self, jobStoreFileID, localFilePath, immutable=False ):
         """
         Replaces the existing version of a file in the jobStore. Throws an exception if the file
-        does not exist.
+        does not exist. The immutable argument is as for writeFile.
 
         :raises ConcurrentFileModificationException: if the file was modified concurrently during
         an invocation of this method
@@ -221,10 +305,13 @@ class AbstractJobStore( object ):
         raise NotImplementedError( )
 
     @abstractmethod
-    def readFile( self, jobStoreFileID, localFilePath ):
+    def readFile( self, jobStoreFileID, localFilePath, byteRange=None ):
         """
         Copies the file referenced by jobStoreFileID to the given local file path. The version
         will be consistent with the last copy of the file written/updated.
+
+        :param byteRange: if not None, a tuple of the offset and length, or None for the rest
+        of the file, of the bytes of the file to copy, see readFileStream.
         """
         raise NotImplementedError( )
 
@@ -277,13 +364,75 @@ class AbstractJobStore( object ):
 
     @abstractmethod
     @contextmanager
-    def readFileStream( self, jobStoreFileID ):
+    def readFileStream( self, jobStoreFileID, offset=0, length=None ):
         """
         Similar to readFile, but returns a context manager yielding a file handle which can be
         read from. The yielded file handle does not need to and should not be closed explicitly.
+
+        The file handle yields the bytes of the file from the given offset, up to the given
+        length, or the end of the file if length is None. Only the requested bytes are read
+        from the store. Fewer bytes are yielded if the range extends past the end of the file.
         """
         raise NotImplementedError( )
-    
+
+    def getLocalFilePath( self, jobStoreFileID ):
+        """
+        Returns the path of the file with the given ID if the store keeps it in the local file
+        system, such that it can be read without copying it. The file must only be read, and
+        reads are only consistent while the file isn't updated.
+
+        :rtype : string, or None if the file is not stored in the local file system
+        """
+        return None
+
+    # The number of files importFiles and exportFiles transfer concurrently by default
+    defaultTransferThreads = 8
+
+    def importFiles( self, jobStoreID, urls, threads=None ):
+        """
+        Copies the files at the given URLs into this store as files of the batchjob with the
+        given jobStoreID, transferring up to the given number of files concurrently. URLs may
+        be file:, http: or https: URLs, or local paths. Unless the store keeps its files in the
+        local file system, the MD5 checksum of each file in the store is checked against that of
+        the data read from the URL.
+
+        :raises ChecksumMismatchException: if a file was corrupted in transfer
+
+        :rtype : list, the IDs of the files, in the order of the URLs
+        """
+        return self._transfer( lambda url: self._importFile( jobStoreID, url ), urls, threads )
+
+    def exportFiles( self, jobStoreFileIDs, localFilePaths, threads=None ):
+        """
+        Copies the files with the given IDs to the given local paths, transferring up to the
+        given number of files concurrently. If the store records the MD5 checksums of its
+        files, that of each file is checked against the checksum of the data read from the
+        store, and a local file is only created once it has been verified.
+
+        :raises ChecksumMismatchException: if a file was corrupted in transfer
+        """
+        self._transfer( lambda args: self._exportFile( *args ),
+                        zip( jobStoreFileIDs, localFilePaths ), threads )
+
+    # The bounds of the interval between checks in waitForFileDeletion, the interval is doubled
+    # after each check that finds files still existing.
+    minDeletionPollInterval = 0.1
+    maxDeletionPollInterval = 10
+
+    def waitForFileDeletion( self, jobStoreFileIDs, timeout=None ):
+        """
+        Blocks until none of the files with the given IDs exist or timeout seconds have passed.
+        If timeout is None, blocks until the files have been deleted.
+
+        This implementation polls fileExists with exponential backoff, subclasses should
+        override it if they can be notified of deletions or check many files at once.
+
+        :rtype : True if all the files have been deleted, False if the timeout expired first.
+        """
+        return self._waitForFileDeletion( jobStoreFileIDs, timeout,
+                                          lambda ids: [ i for i in ids if self.fileExists( i ) ],
+                                          time.sleep )
+
     ##########################################
     #The following methods deal with shared files, i.e. files not associated 
     #with specific jobs.
@@ -317,6 +466,14 @@ class AbstractJobStore( object ):
         """
         raise NotImplementedError( )
 
+    @abstractmethod
+    def deleteSharedFile( self, sharedFileName ):
+        """
+        Deletes the global file referenced by the given name. Like deleteFile, deleting a
+        non-existent file succeeds silently.
+        """
+        raise NotImplementedError( )
+
     @abstractmethod
     def writeStatsAndLogging( self, statsAndLoggingString ):
         """
@@ -336,11 +493,152 @@ class AbstractJobStore( object ):
         """
         raise NotImplementedError( )
 
+    def waitForStatsAndLogging( self, timeout ):
+        """
+        Blocks until stats/logging strings may have been written by writeStatsAndLogging or
+        timeout seconds have passed, returning True in the former case. This implementation
+        sleeps and returns False, subclasses should override it if they can be notified of 
+        writes. As some writes may go unnoticed, readStatsAndLogging should be polled, too.
+        """
+        time.sleep( timeout )
+        return False
+
+    def getTransferStats( self ):
+        """
+        Returns a dictionary mapping the ways in which this instance has copied files between the
+        store and local paths, e.g. 'link' or 'copy', to the number of files copied that way.
+        Reported in the stats of the workers.
+        """
+        return { }
+
     ## Helper methods for subclasses
 
+    def _transfer( self, transferFn, items, threads ):
+        """
+        Calls transferFn on each of the given items using a pool of threads, returning the
+        results in order. Subclasses whose transfers block on the network rather than the disk
+        may increase defaultTransferThreads.
+        """
+        items = list( items )
+        if threads is None:
+            threads = self.defaultTransferThreads
+        if len( items ) <= 1 or threads <= 1:
+            return map( transferFn, items )
+        pool = ThreadPool( min( threads, len( items ) ) )
+        try:
+            return pool.map( transferFn, items )
+        finally:
+            pool.close( )
+            pool.join( )
+
+    def _getFileChecksum( self, jobStoreFileID ):
+        """
+        Returns the hex MD5 digest of the file with the given ID as recorded by the store, which
+        importFiles and exportFiles check the data they transfer against, or None if the store
+        doesn't record one for the file.
+        """
+        return None
+
+    def _getImportedChecksum( self, jobStoreFileID ):
+        """
+        Returns the MD5 digest an imported file is checked against, see importFiles: the one
+        recorded by the store, or else that of the file read back from the store. Returns None
+        if the store keeps its files in the local file system, so the file isn't checked.
+        """
+        checksum = self._getFileChecksum( jobStoreFileID )
+        if checksum is None and self.getLocalFilePath( jobStoreFileID ) is None:
+            with self.readFileStream( jobStoreFileID ) as f:
+                checksum = _md5( f )
+        return checksum
+
+    def _importFile( self, jobStoreID, url ):
+        """
+        Copies the file at the given URL into the store, see importFiles.
+        """
+        scheme, netloc, path = urlparse.urlparse( url )[ :3 ]
+        if scheme in ( '', 'file' ):
+            # Writing from a local path lets subclasses use their most efficient upload, e.g.
+            # a multipart upload
+            jobStoreFileID = self.writeFile( jobStoreID, path )
+            storeChecksum = self._getImportedChecksum( jobStoreFileID )
+            if storeChecksum is not None:
+                with open( path, 'r' ) as f:
+                    checksum = _md5( f )
+        elif scheme in ( 'http', 'https' ):
+            source = urllib2.urlopen( url )
+            try:
+                with self.writeFileStream( jobStoreID ) as ( f, jobStoreFileID ):
+                    checksum = _md5( source, f )
+            finally:
+                source.close( )
+            storeChecksum = self._getImportedChecksum( jobStoreFileID )
+        else:
+            raise RuntimeError( "Can't import '%s', only file:, http: and https: URLs are "
+                                "supported" % url )
+        if storeChecksum is not None and storeChecksum != checksum:
+            self.deleteFile( jobStoreFileID )
+            raise ChecksumMismatchException( url, jobStoreFileID )
+        return jobStoreFileID
+
+    def _exportFile( self, jobStoreFileID, localFilePath ):
+        """
+        Copies the file with the given ID to the given local path, see exportFiles.
+        """
+        fd, tempPath = tempfile.mkstemp( dir=os.path.dirname( os.path.abspath( localFilePath ) ) )
+        try:
+            with os.fdopen( fd, 'w' ) as f:
+                with self.readFileStream( jobStoreFileID ) as source:
+                    checksum = _md5( source, f )
+            storeChecksum = self._getFileChecksum( jobStoreFileID )
+            if storeChecksum is not None and storeChecksum != checksum:
+                raise ChecksumMismatchException( jobStoreFileID, localFilePath )
+            os.rename( tempPath, localFilePath )
+        except:
+            os.remove( tempPath )
+            raise
+
     def _defaultTryCount( self ):
         return int( self.config.attrib[ "try_count" ] )
 
+    def _waitForFileDeletion( self, jobStoreFileIDs, timeout, existingFilesFn, waitFn ):
+        """
+        Implements the backoff loop of waitForFileDeletion.
+
+        :param existingFilesFn: called with a list of file IDs, returns the IDs of those files
+        that still exist
+
+        :param waitFn: called with a number of seconds to wait before checking again. May return
+        early, e.g. when notified of a change to the store.
+        """
+        expiration = None if timeout is None else time.time( ) + timeout
+        interval = self.minDeletionPollInterval
+        jobStoreFileIDs = existingFilesFn( list( jobStoreFileIDs ) )
+        while len( jobStoreFileIDs ) > 0:
+            if expiration is not None:
+                remaining = expiration - time.time( )
+                if remaining <= 0:
+                    return False
+                interval = min( interval, remaining )
+            waitFn( interval )
+            interval = min( interval * 2, self.maxDeletionPollInterval )
+            jobStoreFileIDs = existingFilesFn( jobStoreFileIDs )
+        return True
+
     @classmethod
     def _validateSharedFileName( cls, sharedFileName ):
         return bool( cls.sharedFileNameRegex.match( sharedFileName ) )
+
+def _md5( source, target=None ):
+    """
+    Returns the MD5 digest of the data read from the source file handle, copying the data to
+    the target file handle if it is not None.
+    """
+    md5 = hashlib.md5( )
+    while True:
+        data = source.read( RangeReader.chunkSize )
+        if not data:
+            break
+        md5.update( data )
+        if target is not None:
+            target.write( data )
+    return md5.hexdigest( )
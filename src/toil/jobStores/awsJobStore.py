@@ -5,6 +5,7 @@ from contextlib import contextmanager
 import logging
 import os
 import re
+import shutil
 from threading import Thread
 import uuid
 
@@ -79,6 +80,7 @@ class AWSJobStore( AbstractJobStore ):
             with attempt:
                 assert self.jobDomain.put_attributes( item_name=jobStoreID,
                                                  attributes=batchjob.toItem( ) )
+        self._cacheItem( batchjob )
         return batchjob
 
     def __init__( self, region, namePrefix, config=None ):
@@ -90,6 +92,9 @@ class AWSJobStore( AbstractJobStore ):
         self.versions = None
         self.files = None
         self.stats = None
+        # Map of the IDs of batchjobs loaded or updated by this batchjob store to their items, see
+        # update
+        self.items = { }
         self.db = self._connectSimpleDB( )
         self.s3 = self._connectS3( )
         create = config is not None
@@ -133,18 +138,38 @@ class AWSJobStore( AbstractJobStore ):
         if batchjob is None:
             raise NoSuchJobException( jobStoreID )
         log.debug( "Loaded batchjob %s", jobStoreID )
+        self._cacheItem( batchjob )
         return batchjob
 
     def update( self, batchjob ):
         log.debug( "Updating batchjob %s", batchjob.jobStoreID )
-        for attempt in retry_sdb( ):
-            with attempt:
-                assert self.jobDomain.put_attributes( item_name=batchjob.jobStoreID,
-                                                 attributes=batchjob.toItem( ) )
+        item = batchjob.toItem( )
+        # Only the attributes that changed since this batchjob store last loaded or updated the
+        # batchjob are put, relying on a batchjob being updated by one process at a time
+        oldItem = self.items.get( batchjob.jobStoreID )
+        if oldItem is not None:
+            attributes = { k: v for k, v in item.iteritems( ) if oldItem.get( k ) != v }
+        else:
+            attributes = item
+        if attributes:
+            for attempt in retry_sdb( ):
+                with attempt:
+                    assert self.jobDomain.put_attributes( item_name=batchjob.jobStoreID,
+                                                     attributes=attributes )
+        self._cacheItem( batchjob, item )
+
+    # The maximum number of items kept by _cacheItem
+    maxCachedItems = 10000
+
+    def _cacheItem( self, batchjob, item=None ):
+        if batchjob.jobStoreID not in self.items and len( self.items ) >= self.maxCachedItems:
+            self.items.popitem( )
+        self.items[ batchjob.jobStoreID ] = batchjob.toItem( ) if item is None else item
 
     def delete( self, jobStoreID ):
         # remove batchjob and replace with jobStoreId.
         log.debug( "Deleting batchjob %s", jobStoreID )
+        self.items.pop( jobStoreID, None )
         for attempt in retry_sdb( ):
             with attempt:
                 self.jobDomain.delete_attributes( item_name=jobStoreID )
@@ -166,7 +191,7 @@ class AWSJobStore( AbstractJobStore ):
                 else:
                     self.files.delete_key( key_name=item.name)
 
-    def writeFile( self, jobStoreID, localFilePath ):
+    def writeFile( self, jobStoreID, localFilePath, immutable=False ):
         jobStoreFileID = self._newFileID( )
         firstVersion = self._upload( jobStoreFileID, localFilePath )
         self._registerFile( jobStoreFileID, jobStoreID=jobStoreID, newVersion=firstVersion )
@@ -203,7 +228,7 @@ class AWSJobStore( AbstractJobStore ):
             log.debug( "Wrote version %s of file %s (%s), replacing version %s",
                        newVersion, sharedFileName, jobStoreFileID, oldVersion )
 
-    def updateFile( self, jobStoreFileID, localFilePath ):
+    def updateFile( self, jobStoreFileID, localFilePath, immutable=False ):
         oldVersion = self._getFileVersion( jobStoreFileID )
         newVersion = self._upload( jobStoreFileID, localFilePath )
         self._registerFile( jobStoreFileID, oldVersion=oldVersion, newVersion=newVersion )
@@ -220,20 +245,30 @@ class AWSJobStore( AbstractJobStore ):
         log.debug( "Wrote version %s of file %s, replacing version %s",
                    newVersion, jobStoreFileID, oldVersion )
 
-    def readFile( self, jobStoreFileID, localFilePath ):
+    def readFile( self, jobStoreFileID, localFilePath, byteRange=None ):
         version = self._getFileVersion( jobStoreFileID )
         if version is None: raise NoSuchFileException( jobStoreFileID )
         log.debug( "Reading version %s of file %s to path '%s'",
                    version, jobStoreFileID, localFilePath )
-        self._download( jobStoreFileID, localFilePath, version )
+        if byteRange is None:
+            self._download( jobStoreFileID, localFilePath, version )
+        else:
+            with self.readFileStream( jobStoreFileID, *byteRange ) as readable:
+                with open( localFilePath, 'w' ) as writable:
+                    shutil.copyfileobj( readable, writable )
 
     @contextmanager
-    def readFileStream( self, jobStoreFileID ):
+    def readFileStream( self, jobStoreFileID, offset=0, length=None ):
         version = self._getFileVersion( jobStoreFileID )
         if version is None: raise NoSuchFileException( jobStoreFileID )
         log.debug( "Reading version %s of file %s", version, jobStoreFileID )
-        with self._downloadStream( jobStoreFileID, version, self.files ) as readable:
-            yield readable
+        if length == 0:
+            # A range can't be empty in an HTTP Range header
+            yield StringIO( )
+        else:
+            with self._downloadStream( jobStoreFileID, version, self.files,
+                                       byteRange=( offset, length ) ) as readable:
+                yield readable
 
     @contextmanager
     def readSharedFileStream( self, sharedFileName ):
@@ -246,6 +281,10 @@ class AWSJobStore( AbstractJobStore ):
         with self._downloadStream( jobStoreFileID, version, self.files ) as readable:
             yield readable
 
+    def deleteSharedFile( self, sharedFileName ):
+        assert self._validateSharedFileName( sharedFileName )
+        self.deleteFile( self._newFileID( sharedFileName ) )
+
     def deleteFile( self, jobStoreFileID ):
         version, bucket = self._getFileVersionAndBucket( jobStoreFileID )
         if bucket:
@@ -265,6 +304,34 @@ class AWSJobStore( AbstractJobStore ):
         else:
             log.debug( "File %s does not exist", jobStoreFileID)
 
+    def _getFileChecksum( self, jobStoreFileID ):
+        version = self._getFileVersion( jobStoreFileID )
+        if version is None: raise NoSuchFileException( jobStoreFileID )
+        key = self.files.get_key( jobStoreFileID, version_id=version )
+        # The ETag of an object uploaded in one part is its MD5, that of a multipart upload is
+        # not and has the number of parts appended
+        etag = key.etag.strip( '"' )
+        return None if '-' in etag else etag
+
+    # The maximum number of values SimpleDB allows in the list of an IN comparison
+    _maxSelectInValues = 20
+
+    def waitForFileDeletion( self, jobStoreFileIDs, timeout=None ):
+        def existingFiles( jobStoreFileIDs ):
+            # Check the files in batches, one consistent select per batch
+            existing = set( )
+            for i in xrange( 0, len( jobStoreFileIDs ), self._maxSelectInValues ):
+                batch = jobStoreFileIDs[ i:i + self._maxSelectInValues ]
+                for attempt in retry_sdb( ):
+                    with attempt:
+                        existing.update( item.name for item in self.versions.select(
+                            query="select itemName() from `%s` where itemName() in (%s)" % (
+                                self.versions.name, ', '.join( "'%s'" % j for j in batch )),
+                            consistent_read=True ) )
+            return [ j for j in jobStoreFileIDs if j in existing ]
+
+        return self._waitForFileDeletion( jobStoreFileIDs, timeout, existingFiles, time.sleep )
+
     def getEmptyFileStoreID( self, jobStoreID ):
         jobStoreFileID = self._newFileID( )
         self._registerFile( jobStoreFileID, jobStoreID=jobStoreID )
@@ -500,13 +567,30 @@ class AWSJobStore( AbstractJobStore ):
         key.get_contents_to_filename( localFilePath, version_id=version )
 
     @contextmanager
-    def _downloadStream( self, jobStoreFileID, version, bucket ):
+    def _downloadStream( self, jobStoreFileID, version, bucket, byteRange=( 0, None ) ):
+        """
+        :param byteRange: the offset and length, or None for the rest of the file, of the bytes
+        to download. The bytes are requested with an HTTP Range GET.
+        """
         key = bucket.get_key( jobStoreFileID, validate=False )
+        offset, length = byteRange
+        if offset == 0 and length is None:
+            headers = None
+        else:
+            headers = { 'Range': 'bytes=%d-%s' % (
+                offset, '' if length is None else offset + length - 1 ) }
         readable_fh, writable_fh = os.pipe( )
         with os.fdopen( readable_fh, 'r' ) as readable:
             with os.fdopen( writable_fh, 'w' ) as writable:
                 def writer( ):
-                    key.get_contents_to_file( writable, version_id=version )
+                    try:
+                        key.get_contents_to_file( writable, headers=headers,
+                                                  version_id=version )
+                    except S3ResponseError as e:
+                        # S3 rejects ranges starting past the end of the file with 416,
+                        # which yields no bytes like reads past the end of a local file
+                        if e.status != 416:
+                            raise
                     # This close() will send EOF to the reading end and ultimately cause the
                     # yield to return. It also makes the implict .close() done by the enclosing
                     # "with" context redundant but that should be ok since .close() on file
@@ -777,6 +861,8 @@ class AWSJob( BatchJob ):
     """
     A Batchjob that can be converted to and from a SimpleDB Item
     """
+    __slots__ = ( )
+
     fromItemTransform = defaultdict( lambda: passThrough,
                                      predecessorNumber=int,
                                      memory=float,
@@ -785,10 +871,12 @@ class AWSJob( BatchJob ):
                                      updateID=str,
                                      command=toNoneable,
                                      stack=lambda v:map( literal_eval, toList( v )),
+                                     gangs=lambda v:map( literal_eval, toList( v )),
                                      jobsToDelete=toList,
                                      predecessorsFinished=toSet,
                                      remainingRetryCount=int,
-                                     logJobStoreFileID=toNoneable )
+                                     logJobStoreFileID=toNoneable,
+                                     checkpointJobStoreFileID=toNoneable )
 
     @classmethod
     def fromItem( cls, item, jobStoreID=None ):
@@ -810,7 +898,9 @@ class AWSJob( BatchJob ):
                                    updateID=str,
                                    children=skip,
                                    stack=lambda v: fromList( map( repr, v ) ),
+                                   gangs=lambda v: fromList( map( repr, v ) ),
                                    logJobStoreFileID=fromNoneable,
+                                   checkpointJobStoreFileID=fromNoneable,
                                    predecessorsFinished=fromSet,
                                    jobsToDelete=fromList ,
                                    predecessorNumber=str,
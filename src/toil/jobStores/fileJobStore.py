@@ -1,16 +1,30 @@
+from bisect import bisect
+from collections import OrderedDict, defaultdict, deque
 from contextlib import contextmanager
+from cStringIO import StringIO
+import errno
+import fcntl
+from functools import partial
+import hashlib
+from itertools import islice, izip
 import logging
-import marshal as pickler
-#import cPickle as pickler
-#import pickle as pickler
-#import json as pickler    
+import marshal
+from multiprocessing.pool import ThreadPool
 import random
 import shutil
 import os
+import stat
+import struct
 import tempfile
+import threading
+import time
+import uuid
+import weakref
+import zlib
 from toil.lib.bioio import absSymPath
+from toil.lib import inotify, transfer
 from toil.jobStores.abstractJobStore import AbstractJobStore, NoSuchJobException, \
-    NoSuchFileException
+    NoSuchFileException, RangeReader
 from toil.batchJob import BatchJob
 
 logger = logging.getLogger( __name__ )
@@ -25,17 +39,70 @@ class FileJobStore(AbstractJobStore):
         self.jobStoreDir = absSymPath(jobStoreDir)
         logger.info("Jobstore directory is: %s", self.jobStoreDir)
         self.tempFilesDir = os.path.join(self.jobStoreDir, "tmp")
-        if not os.path.exists(self.jobStoreDir):
+        #The index of the jobs in the store, see jobs
+        self.jobIndex = _JobIndex(os.path.join(self.jobStoreDir, "jobIndex"))
+        #The stats/logging files, see writeStatsAndLogging
+        self.statsSpool = _StatsSpool(os.path.join(self.jobStoreDir, "stats"))
+        #The file listing the shards other than self.tempFilesDir, see _reshard
+        self.shardsPath = os.path.join(self.jobStoreDir, "shards")
+        created = not os.path.exists(self.jobStoreDir)
+        if created:
             os.mkdir(self.jobStoreDir)
             os.mkdir(self.tempFilesDir)
+            self.jobIndex.create()
+            self.statsSpool.create()
         #Parameters for creating temporary files
         self.validDirs = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
-        self.levels = 2
+        #Map of the jobStoreIDs of the large batchjob records loaded or updated
+        #by this instance to their _RecordStates, see update
+        self.recordStates = {}
+        #See getTransferStats
+        self.transferStats = dict.fromkeys(transfer.strategies, 0)
+        #The threads loading batchjobs in jobs, started by its first call
+        self.loadPool = None
+        #The thread compacting packs of small files, see _compactPack
+        self.compactionPool = None
+        #Whether load repairs the records of batchjobs, see clean
+        self.repairRecords = False
+        #The directories of the hierarchy in self.tempFilesDir known to exist,
+        #which are never removed, see _getTempSharedDir
+        self.knownDirs = set()
         super( FileJobStore, self ).__init__( config=config )
+        #The stats of immutable files, see _getFileStat
+        self.attributeCache = _AttributeCache(float(self.config.attrib.get("attribute_cache_ttl", 0)))
+        #How updates of batchjobs are made durable, one of durabilityModes, see update
+        self.durability = self.config.attrib.get("durability", "none")
+        self.jobIndex.sync = self.durability == "fsync"
+        #The journal of the updates, which is replayed by clean whatever the
+        #durability, as it may have been different before the restart
+        self.journal = _Journal.get(os.path.join(self.jobStoreDir, "journal"), self._syncJobFiles)
+        #The directories of batchjobs are spread over shards, see _getShardPath
+        self._loadShards()
+        if created:
+            self._reshard()
+    
+    #Updates are left to the operating system to write back ("none"), are
+    #flushed to disk each ("fsync"), or are written to a journal flushed once
+    #for the updates made at the same time ("group"), see _Journal
+    durabilityModes = ("none", "fsync", "group")
+    
+    #Files are opened or removed without checking that they exist first, and
+    #missing files are told by the error, as every check is a round trip to the
+    #server of a network file system
+    _missingErrnos = (errno.ENOENT, errno.ENOTDIR)
         
     def deleteJobStore(self):
-        if os.path.exists(self.jobStoreDir):
+        self.jobIndex.close()
+        self.statsSpool.close()
+        self.journal.close()
+        for name, path in self.shards.iteritems():
+            if path != self.tempFilesDir:
+                shutil.rmtree(path, ignore_errors=True)
+        try:
             shutil.rmtree(self.jobStoreDir)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
     
     ##########################################
     #The following methods deal with creating/loading/updating/writing/checking for the
@@ -44,13 +111,28 @@ class FileJobStore(AbstractJobStore):
     
     def create(self, command, memory, cpu, disk, updateID=None,
                predecessorNumber=0):
-        #The absolute path to the batchjob directory.
-        absJobDir = tempfile.mkdtemp(prefix="batchjob", dir=self._getTempSharedDir())
+        #The absolute path to the batchjob directory. Its name is chosen first,
+        #as it places the directory in a shard.
+        while True:
+            name = "batchjob" + uuid.uuid4().hex[:12]
+            absJobDir = os.path.join(self._getTempSharedDir(self._getShardPath(name)), name)
+            try:
+                os.mkdir(absJobDir)
+                break
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        if self.durability == "fsync":
+            _fsyncDir(os.path.dirname(absJobDir))
+        jobStoreID = self._getRelativePath(absJobDir)
+        #The batchjob is indexed before it is written, so that the index has
+        #every batchjob, see jobs
+        self.jobIndex.add(jobStoreID)
         #Sub directory to put temporary files associated with the batchjob in
         os.mkdir(os.path.join(absJobDir, "g"))
         #Make the batchjob
         batchjob = BatchJob(command=command, memory=memory, cpu=cpu, disk=disk,
-                  jobStoreID=self._getRelativePath(absJobDir), 
+                  jobStoreID=jobStoreID, 
                   remainingRetryCount=self._defaultTryCount( ), 
                   updateID=updateID,
                   predecessorNumber=predecessorNumber)
@@ -63,11 +145,14 @@ class FileJobStore(AbstractJobStore):
     
     def getPublicUrl( self,  jobStoreFileID):
         self._checkJobStoreFileID(jobStoreFileID)
-        jobStorePath = self._getAbsPath(jobStoreFileID)
-        if os.path.exists(jobStorePath):
-            return 'file:'+jobStorePath
-        else:
-            raise NoSuchFileException(jobStoreFileID)
+        data = self._getPacked(jobStoreFileID)
+        if data is not None:
+            #The URL is of a file, so a packed file is promoted to the file at
+            #the path of its ID
+            with open(self._getAbsPath(jobStoreFileID), 'w') as f:
+                f.write(data)
+            self._removePacked(jobStoreFileID)
+        return 'file:'+self._getAbsPath(jobStoreFileID)
 
     def getSharedPublicUrl( self,  FileName):
         jobStorePath = self.jobStoreDir+'/'+FileName
@@ -77,89 +162,308 @@ class FileJobStore(AbstractJobStore):
             raise NoSuchFileException(FileName)
 
     def load(self, jobStoreID):
-        self._checkJobStoreId(jobStoreID)
         #Load a valid version of the batchjob
         jobFile = self._getJobFileName(jobStoreID)
-        with open(jobFile, 'r') as fileHandle:
-            batchjob = BatchJob.fromDict(pickler.load(fileHandle))
+        try:
+            fileHandle = open(jobFile, 'r')
+        except IOError as e:
+            if e.errno in self._missingErrnos:
+                raise NoSuchJobException(jobStoreID)
+            raise
+        fileKey = None
+        with fileHandle:
+            data = fileHandle.read()
+            batchjob, snapshotSize, logSize, recordSize = self._decodeRecord(data)
+            if snapshotSize >= self.minLoggedSnapshotSize:
+                fileKey = self._getFileKey(os.fstat(fileHandle.fileno()))
+        failed = False
+        if recordSize < len(data):
+            #The worker failed while appending to the log of the record, the
+            #incomplete update is dropped. A worker could as well still be 
+            #appending to it, so the record is only repaired while the jobStore
+            #is cleaned, else it is rewritten by the next update
+            logger.warn("There was an incomplete update of the batchjob: %s", jobStoreID)
+            if self.repairRecords:
+                with open(jobFile, 'r+') as fileHandle:
+                    fileHandle.truncate(recordSize)
+                    fileKey = self._getFileKey(os.fstat(fileHandle.fileno()))
+            else:
+                fileKey = None
+            failed = True
+        if fileKey is not None:
+            self.recordStates[jobStoreID] = _RecordState(fileKey, self._digestAttributes(batchjob),
+                                                         snapshotSize, logSize)
+        else:
+            self.recordStates.pop(jobStoreID, None)
         #The following cleans up any issues resulting from the failure of the 
         #batchjob during writing by the batch system.
-        if os.path.isfile(jobFile + ".new"):
-            logger.warn("There was a .new file for the batchjob: %s", jobStoreID)
+        try:
             os.remove(jobFile + ".new")
+        except OSError as e:
+            if e.errno not in self._missingErrnos:
+                raise
+        else:
+            logger.warn("There was a .new file for the batchjob: %s", jobStoreID)
+            failed = True
+        if failed:
             batchjob.setupJobAfterFailure(self.config)
         return batchjob
     
     def update(self, batchjob):
+        #Records of large batchjobs are a snapshot of the batchjob followed by
+        #a log of updates, each holding the attributes that changed since the
+        #batchjob was last loaded or updated by this instance. Updates are
+        #appended to the log while it is smaller than the snapshot and the
+        #record hasn't been changed by others, else the record is compacted
+        #by rewriting the snapshot. The cost of an update is thereby
+        #proportional to what changed, except for digesting the attributes.
+        jobFile = self._getJobFileName(batchjob.jobStoreID)
+        state = self.recordStates.get(batchjob.jobStoreID)
+        digests = None
+        if state is not None:
+            digests = self._digestAttributes(batchjob)
+            changed = dict((name, getattr(batchjob, name)) 
+                           for name, newDigest, oldDigest in izip(BatchJob.__slots__, digests,
+                                                                  state.digests)
+                           if newDigest != oldDigest)
+            entry = self._encodeLogEntry(changed)
+            try:
+                fileKey = self._getFileKey(os.stat(jobFile))
+            except OSError:
+                fileKey = None
+            if fileKey == state.fileKey and state.logSize + len(entry) <= state.snapshotSize:
+                if len(changed) > 0:
+                    offset = self._recordHeader.size + state.snapshotSize + state.logSize
+                    with self._journaled(batchjob.jobStoreID, offset, entry):
+                        with open(jobFile, 'a') as f:
+                            f.write(entry)
+                            f.flush()
+                            if self.durability == "fsync":
+                                os.fdatasync(f.fileno())
+                            state.fileKey = self._getFileKey(os.fstat(f.fileno()))
+                    state.logSize += len(entry)
+                    state.digests = digests
+                return
         #The batchjob is serialised to a file suffixed by ".new"
         #The file is then moved to its correct path.
         #Atomicity guarantees use the fact the underlying file systems "move"
         #function is atomic. 
-        with open(self._getJobFileName(batchjob.jobStoreID) + ".new", 'w') as f:
-            pickler.dump(batchjob.toDict(), f)
-        #This should be atomic for the file system
-        os.rename(self._getJobFileName(batchjob.jobStoreID) + ".new", self._getJobFileName(batchjob.jobStoreID))
+        snapshot = batchjob.toBytes()
+        data = self._recordHeader.pack(self._recordMagic, len(snapshot)) + snapshot
+        with self._journaled(batchjob.jobStoreID, 0, data):
+            with open(jobFile + ".new", 'w') as f:
+                f.write(data)
+                if self.durability == "fsync":
+                    f.flush()
+                    os.fsync(f.fileno())
+            #This should be atomic for the file system
+            os.rename(jobFile + ".new", jobFile)
+            if self.durability == "fsync":
+                _fsyncDir(os.path.dirname(jobFile))
+        if len(snapshot) >= self.minLoggedSnapshotSize:
+            if digests is None:
+                digests = self._digestAttributes(batchjob)
+            fileKey = self._getFileKey(os.stat(jobFile))
+            self.recordStates[batchjob.jobStoreID] = _RecordState(fileKey, digests,
+                                                                  len(snapshot), 0)
+        else:
+            self.recordStates.pop(batchjob.jobStoreID, None)
     
     def delete(self, jobStoreID):
         #The jobStoreID is the relative path to the directory containing the batchjob,
         #removing this directory deletes the batchjob.
-        if self.exists(jobStoreID):
-            shutil.rmtree(self._getAbsPath(jobStoreID))
+        self.recordStates.pop(jobStoreID, None)
+        absJobDir = self._getAbsPath(jobStoreID)
+        try:
+            with self._journaled(jobStoreID, 0, None):
+                shutil.rmtree(absJobDir)
+        except OSError as e:
+            if e.errno not in self._missingErrnos:
+                raise
+        else:
+            if self.durability == "fsync":
+                _fsyncDir(os.path.dirname(absJobDir))
+            self.jobIndex.remove(jobStoreID)
+    
+    def clean(self):
+        #The batchjobs are moved to the shards of the config first, as the
+        #journal is replayed to their new directories
+        self._reshard()
+        #Updates that were journaled, but whose batchjob files may not have
+        #reached the disk before a crash, are replayed before the batchjobs
+        #are read
+        indexed = self.jobIndex.read()
+        replayed = self.journal.replay(partial(self._replayChanges,
+                                               set(indexed) if indexed is not None else None))
+        if len(replayed) > 0:
+            logger.info("Replayed the journaled updates of %i batchjobs", len(replayed))
+        #No worker runs while the jobStore is cleaned, so the incomplete updates
+        #of batchjobs can be removed from their records, see load
+        self.repairRecords = True
+        try:
+            super(FileJobStore, self).clean()
+        finally:
+            self.repairRecords = False
+    
+    #The number of threads loading batchjobs in jobs, and the number of 
+    #batchjobs each loads at a time
+    loadThreads = 16
+    loadBatchSize = 64
  
     def jobs(self):
-        #Walk through list of temporary directories searching for jobs
-        for tempDir in self._tempDirectories():
-            for i in os.listdir(tempDir):
-                if i.startswith( 'batchjob' ):
-                    yield self.load(self._getRelativePath(os.path.join(tempDir, i)))
+        #The batchjobs are loaded in parallel. Which batchjobs there are is read
+        #from the index, rather than by listing the directories of the 
+        #hierarchy in self.tempFilesDir.
+        jobStoreIDs = self.jobIndex.read()
+        if jobStoreIDs is None:
+            #A store created by an earlier version of toil, which has no index,
+            #its directories are listed in parallel
+            tasks = [ partial(self._loadJobsInDir, tempDir) for tempDir in self._tempDirectories() ]
+        else:
+            #Sorted, so that the batchjobs of a directory are loaded together
+            jobStoreIDs.sort()
+            tasks = [ partial(self._loadJobs, jobStoreIDs[i:i + self.loadBatchSize])
+                      for i in xrange(0, len(jobStoreIDs), self.loadBatchSize) ]
+        #The pool is kept for later calls, as stopping it takes a while
+        if self.loadPool is None:
+            self.loadPool = ThreadPool(self.loadThreads)
+        #Only a few batches are loaded ahead of the caller, so that not every
+        #batchjob is held in memory at once
+        tasks = iter(tasks)
+        results = deque(self.loadPool.apply_async(task) 
+                        for task in islice(tasks, 2 * self.loadThreads))
+        while len(results) > 0:
+            batchjobs = results.popleft().get()
+            task = next(tasks, None)
+            if task is not None:
+                results.append(self.loadPool.apply_async(task))
+            for batchjob in batchjobs:
+                yield batchjob
  
     ##########################################
     #Functions that deal with temporary files associated with jobs
     ##########################################    
     
-    def writeFile(self, jobStoreID, localFilePath):
-        self._checkJobStoreId(jobStoreID)
-        fd, absPath = self._getJobTempFile(jobStoreID)
-        shutil.copyfile(localFilePath, absPath)
-        os.close(fd)
+    def writeFile(self, jobStoreID, localFilePath, immutable=False):
+        fd, absPath = self._getJobTempFile(jobStoreID, immutable)
+        if immutable:
+            os.close(fd)
+            self._copyFile(localFilePath, absPath, allowLink=True)
+        else:
+            #The new file is copied to through its descriptor, as copying to
+            #its path would check whether it is a link
+            with os.fdopen(fd, 'wb') as dst:
+                with open(localFilePath, 'rb') as src:
+                    strategy = transfer.copyFileObject(src, dst)
+            self._countTransfer(localFilePath, absPath, strategy)
         return self._getRelativePath(absPath)
 
-    def updateFile(self, jobStoreFileID, localFilePath):
+    def updateFile(self, jobStoreFileID, localFilePath, immutable=False):
         self._checkJobStoreFileID(jobStoreFileID)
-        shutil.copyfile(localFilePath, self._getAbsPath(jobStoreFileID))
+        self._copyFile(localFilePath, self._getAbsPath(jobStoreFileID), immutable)
+        if self._isPacked(jobStoreFileID):
+            #A packed file is promoted to the file at the path of its ID
+            self._removePacked(jobStoreFileID)
     
-    def readFile(self, jobStoreFileID, localFilePath):
+    def readFile(self, jobStoreFileID, localFilePath, byteRange=None):
+        data = self._getPacked(jobStoreFileID) if byteRange is None else None
+        if data is not None:
+            with open(localFilePath, 'w') as localFile:
+                localFile.write(data)
+        elif byteRange is None:
+            #The local copy may be modified, so it is never a link
+            absPath = self._getAbsPath(jobStoreFileID)
+            try:
+                self._copyFile(absPath, localFilePath)
+            except EnvironmentError as e:
+                if e.filename == absPath and e.errno in self._missingErrnos + (errno.EISDIR,):
+                    raise NoSuchFileException(jobStoreFileID)
+                raise
+        else:
+            with self.readFileStream(jobStoreFileID, *byteRange) as f:
+                with open(localFilePath, 'w') as localFile:
+                    shutil.copyfileobj(f, localFile)
+    
+    def getLocalFilePath(self, jobStoreFileID):
+        if self._isLivePacked(jobStoreFileID):
+            #Packed files have no file of their own
+            return None
         self._checkJobStoreFileID(jobStoreFileID)
-        shutil.copyfile(self._getAbsPath(jobStoreFileID), localFilePath)
+        return self._getAbsPath(jobStoreFileID)
     
     def deleteFile(self, jobStoreFileID):
-        if not self.fileExists(jobStoreFileID):
+        if self._isPacked(jobStoreFileID) and self._removePacked(jobStoreFileID):
             return
-        os.remove(self._getAbsPath(jobStoreFileID))
+        absPath = self._getAbsPath(jobStoreFileID)
+        self.attributeCache.pop(absPath)
+        try:
+            os.remove(absPath)
+        except OSError as e:
+            if e.errno in self._missingErrnos:
+                return
+            if e.errno == errno.EISDIR:
+                raise NoSuchFileException("Path %s is not a file in the jobStore" % jobStoreFileID)
+            raise
         
     def fileExists(self, jobStoreFileID):
-        absPath = self._getAbsPath(jobStoreFileID)
-        if not os.path.exists(absPath):
-            return False
-        if not os.path.isfile(absPath):
-            raise NoSuchFileException("Path %s is not a file in the jobStore" % jobStoreFileID) 
-        return True
+        return self._isLivePacked(jobStoreFileID) or self._getFileStat(jobStoreFileID) is not None
+    
+    #Files written by writeFileStream that are no larger than this are packed
+    #together with the other small files of their batchjob, see _ObjectPack
+    maxPackedSize = 16 * 1024
+    _packedSuffix = ".packed"
     
     @contextmanager
     def writeFileStream(self, jobStoreID):
-        self._checkJobStoreId(jobStoreID)
-        fd, absPath =  self._getJobTempFile(jobStoreID)
-        with open(absPath, 'w') as f:
-            yield f, self._getRelativePath(absPath)
-        os.close(fd) #Close the os level file descript
+        #The file is held in memory until it outgrows maxPackedSize, when it
+        #is written to the path of its ID instead of being packed
+        name = uuid.uuid4().hex
+        jobStoreFileID = os.path.join(jobStoreID, "g", name + self._packedSuffix)
+        absPath = self._getAbsPath(jobStoreFileID)
+        writer = _PackingWriter(absPath, self.maxPackedSize)
+        try:
+            try:
+                yield writer, jobStoreFileID
+            finally:
+                data = writer.close()
+            if data is not None:
+                _ObjectPack.forPath(os.path.dirname(absPath)).put(name, data)
+        except EnvironmentError as e:
+            if (e.filename is not None and os.path.dirname(e.filename) == os.path.dirname(absPath)
+                and e.errno in self._missingErrnos):
+                raise NoSuchJobException(jobStoreID)
+            raise
 
     @contextmanager
     def updateFileStream(self, jobStoreFileID):
-        self._checkJobStoreFileID(jobStoreFileID)
+        if self._isLivePacked(jobStoreFileID):
+            #The file stays packed unless it outgrows maxPackedSize, when it is
+            #promoted to the file at the path of its ID
+            absPath = self._getAbsPath(jobStoreFileID)
+            writer = _PackingWriter(absPath, self.maxPackedSize)
+            try:
+                yield writer
+            finally:
+                data = writer.close()
+            if data is None:
+                self._removePacked(jobStoreFileID)
+            else:
+                pack = _ObjectPack.forPath(os.path.dirname(absPath))
+                pack.put(self._getPackedName(jobStoreFileID), data, replace=True)
+                self._scheduleCompaction(pack)
+            return
+        fileStat = self._getFileStat(jobStoreFileID, useCache=False)
+        if fileStat is None:
+            raise NoSuchFileException("File %s does not exist in jobStore" % jobStoreFileID)
+        absPath = self._getAbsPath(jobStoreFileID)
+        if fileStat.st_nlink > 1:
+            #The file is a link to the file it was written from, see writeFile,
+            #which mustn't change
+            os.remove(absPath)
         # File objects are context managers (CM) so we could simply return what open returns.
         # However, it is better to wrap it in another CM so as to prevent users from accessing
         # the file object directly, without a with statement.
-        with open(self._getAbsPath(jobStoreFileID), 'w') as f:
+        with open(absPath, 'w') as f:
             yield f
     
     def getEmptyFileStoreID(self, jobStoreID):
@@ -167,10 +471,38 @@ class FileJobStore(AbstractJobStore):
             return jobStoreFileID
     
     @contextmanager
-    def readFileStream(self, jobStoreFileID):
-        self._checkJobStoreFileID(jobStoreFileID)
-        with open(self._getAbsPath(jobStoreFileID), 'r') as f:
-            yield f
+    def readFileStream(self, jobStoreFileID, offset=0, length=None):
+        data = self._getPacked(jobStoreFileID)
+        if data is not None:
+            yield StringIO(data[offset:] if length is None else data[offset:offset + length])
+            return
+        try:
+            f = open(self._getAbsPath(jobStoreFileID), 'r')
+        except IOError as e:
+            if e.errno in self._missingErrnos + (errno.EISDIR,):
+                raise NoSuchFileException(jobStoreFileID)
+            raise
+        with f:
+            if offset == 0 and length is None:
+                yield f
+            else:
+                yield RangeReader(f, offset, length)
+
+    def waitForFileDeletion(self, jobStoreFileIDs, timeout=None):
+        if not inotify.isAvailable():
+            return super(FileJobStore, self).waitForFileDeletion(jobStoreFileIDs, timeout)
+        #Watch the directories containing the files, so that we are woken up as
+        #soon as a file is deleted by a process on this host. Deletions by other
+        #hosts of a network file system are not reported, so we keep polling
+        #with backoff, too.
+        with inotify.INotify() as watcher:
+            #Packed files are deleted by appending to the index of their pack
+            for dirPath in set(os.path.dirname(self._getAbsPath(i)) for i in jobStoreFileIDs):
+                watcher.addWatch(dirPath, inotify.IN_DELETE | inotify.IN_MOVED_FROM |
+                                 inotify.IN_DELETE_SELF | inotify.IN_MODIFY, ignoreMissing=True)
+            return self._waitForFileDeletion(jobStoreFileIDs, timeout,
+                                             lambda ids: [ i for i in ids if self._isLivePacked(i) or self._getFileStat(i, useCache=False) is not None ],
+                                             watcher.wait)
             
     ##########################################
     #The following methods deal with shared files, i.e. files not associated 
@@ -188,48 +520,361 @@ class FileJobStore(AbstractJobStore):
         assert self._validateSharedFileName( sharedFileName )
         with open(os.path.join(self.jobStoreDir, sharedFileName), 'r') as f:
             yield f
+
+    def deleteSharedFile(self, sharedFileName):
+        assert self._validateSharedFileName( sharedFileName )
+        try:
+            os.remove(os.path.join(self.jobStoreDir, sharedFileName))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
              
     def writeStatsAndLogging(self, statsAndLoggingString):
-        #Temporary files are placed in the set of temporary files/directoies
-        fd, tempStatsFile = tempfile.mkstemp(prefix="stats", suffix=".new", dir=self._getTempSharedDir())
-        with open(tempStatsFile, "w") as f:
-            f.write(statsAndLoggingString)
-        os.close(fd)
-        os.rename(tempStatsFile, tempStatsFile[:-4]) #This operation is atomic
+        #The files are written to a spool directory, rather than to the 
+        #hierarchy of directories in self.tempFilesDir, so that reading them
+        #takes time proportional to the number of files written since the
+        #last read, see _StatsSpool
+        self.statsSpool.write(statsAndLoggingString)
         
     def readStatsAndLogging( self, statsAndLoggingCallBackFn):
+        numberOfFilesProcessed = self.statsSpool.read(statsAndLoggingCallBackFn)
+        if numberOfFilesProcessed is None:
+            #A store created by an earlier version of toil, which wrote the 
+            #files to the hierarchy
+            numberOfFilesProcessed = self._readStatsAndLoggingInTempDirs(statsAndLoggingCallBackFn)
+        return numberOfFilesProcessed
+    
+    def waitForStatsAndLogging(self, timeout):
+        return self.statsSpool.wait(timeout)
+    
+    def getTransferStats(self):
+        return dict((strategy, count) for strategy, count in self.transferStats.iteritems() if count > 0)
+    
+    ##########################################
+    #Private methods
+    ##########################################   
+    
+    def _copyFile(self, srcPath, dstPath, allowLink=False):
+        """
+        Copies a file between the store and a local path, in the cheapest way
+        the file systems support, see toil.lib.transfer.
+        """
+        self._countTransfer(srcPath, dstPath, transfer.copyFile(srcPath, dstPath, allowLink))
+    
+    def _countTransfer(self, srcPath, dstPath, strategy):
+        logger.debug("Copied %s to %s using %s", srcPath, dstPath, strategy)
+        self.transferStats[strategy] += 1
+    
+    #Batchjob records start with a header of a magic string and the size of
+    #the snapshot, the entries of the log with one of their size and checksum
+    _recordMagic = 'TJBR'
+    _recordHeader = struct.Struct('<4sI')
+    _logEntryHeader = struct.Struct('<Ii')
+    #The records of batchjobs with smaller snapshots are always rewritten, as
+    #is cheap, so that no state is kept for them
+    minLoggedSnapshotSize = 4096
+    
+    @contextmanager
+    def _journaled(self, jobStoreID, offset, data):
+        """
+        Context manager to change the file of the batchjob in, which journals
+        the change first if the durability is "group", see _Journal.commit.
+        """
+        if self.durability == "group":
+            with self.journal.commit(jobStoreID, offset, data):
+                yield
+        else:
+            yield
+    
+    def _replayChanges(self, indexed, jobStoreID, changes):
+        """
+        Applies the journaled changes of a batchjob to its file, see _Journal.replay,
+        adding the batchjob to the index unless it is in the given set of the indexed 
+        jobStoreIDs, or None.
+        """
+        self.recordStates.pop(jobStoreID, None)
+        absJobDir = self._getAbsPath(jobStoreID)
+        if changes[-1][1] is None:
+            #The batchjob was deleted
+            shutil.rmtree(absJobDir, ignore_errors=True)
+            return
+        jobFile = self._getJobFileName(jobStoreID)
+        for offset, data in changes:
+            if data is None:
+                continue
+            if offset == 0:
+                #The directory may not have reached the disk either
+                try:
+                    os.makedirs(os.path.join(absJobDir, "g"))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                with open(jobFile, 'w') as f:
+                    f.write(data)
+            else:
+                try:
+                    f = open(jobFile, 'r+')
+                except IOError as e:
+                    if e.errno not in self._missingErrnos:
+                        raise
+                    logger.warn("The journaled update of the batchjob %s was lost", jobStoreID)
+                    continue
+                with f:
+                    f.seek(offset)
+                    f.write(data)
+                    f.truncate()
+        #The batchjob may have been created after the index last reached the disk
+        if indexed is not None and jobStoreID not in indexed:
+            self.jobIndex.add(jobStoreID)
+    
+    def _syncJobFiles(self, jobStoreIDs):
+        """
+        Flushes the files of the batchjobs with the given jobStoreIDs and the entries of their
+        directories to disk, see _Journal. The files are flushed one by one, rather than by
+        syncing the file system, so that the changes of other hosts of a network file system
+        are flushed, too.
+        """
+        dirPaths = set()
+        for jobStoreID in jobStoreIDs:
+            absJobDir = self._getAbsPath(jobStoreID)
+            try:
+                fd = os.open(self._getJobFileName(jobStoreID), os.O_RDONLY)
+            except OSError as e:
+                if e.errno not in self._missingErrnos:
+                    raise
+            else:
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                dirPaths.add(absJobDir)
+            #The batchjob's directory may have been created or removed
+            dirPaths.add(os.path.dirname(absJobDir))
+        for dirPath in dirPaths:
+            try:
+                _fsyncDir(dirPath)
+            except OSError as e:
+                if e.errno not in self._missingErrnos:
+                    raise
+    
+    def _decodeRecord(self, data):
+        """
+        Returns the batchjob in the given contents of a batchjob file, the sizes
+        of its snapshot and of its log and the size of the complete part of 
+        the record.
+        """
+        if not data.startswith(self._recordMagic):
+            #A batchjob written by an earlier version of toil, which is 
+            #rewritten on its next update
+            return BatchJob.fromBytes(data), 0, 0, len(data)
+        magic, snapshotSize = self._recordHeader.unpack_from(data)
+        logStart = offset = self._recordHeader.size + snapshotSize
+        batchjob = BatchJob.fromBytes(data[self._recordHeader.size:offset])
+        while offset + self._logEntryHeader.size <= len(data):
+            size, checksum = self._logEntryHeader.unpack_from(data, offset)
+            start = offset + self._logEntryHeader.size
+            payload = data[start:start + size]
+            if len(payload) < size or zlib.crc32(payload) != checksum:
+                break
+            for name, value in marshal.loads(payload).iteritems():
+                setattr(batchjob, name, value)
+            offset = start + size
+        return batchjob, snapshotSize, offset - logStart, offset
+    
+    def _encodeLogEntry(self, changed):
+        """
+        Returns the entry of the log of a batchjob record for the given 
+        dictionary of changed attributes.
+        """
+        payload = marshal.dumps(changed)
+        return self._logEntryHeader.pack(len(payload), zlib.crc32(payload)) + payload
+    
+    @staticmethod
+    def _digestAttributes(batchjob):
+        """
+        Returns digests of the marshalled attributes of the batchjob, to tell 
+        which have changed. Unlike hashes, the digests of different values 
+        don't collide in practice, which would lose the update.
+        """
+        return tuple(hashlib.sha1(marshal.dumps(getattr(batchjob, name))).digest()
+                     for name in BatchJob.__slots__)
+    
+    @staticmethod
+    def _getFileKey(stat):
+        """
+        Returns what identifies the version of a file, given its stat.
+        """
+        return stat.st_ino, stat.st_size, stat.st_mtime, stat.st_ctime
+        
+    def _readStatsAndLoggingInTempDirs(self, statsAndLoggingCallBackFn):
+        """
+        Reads the stats/logging files in the hierarchy of directories in self.tempFilesDir, 
+        see readStatsAndLogging.
+        """
         numberOfFilesProcessed = 0
         for tempDir in self._tempDirectories():
             for tempFile in os.listdir(tempDir):
-                if tempFile.startswith( 'stats' ):
+                #Files ending in .new are still being written by a worker
+                if tempFile.startswith( 'stats' ) and not tempFile.endswith( '.new' ):
                     absTempFile = os.path.join(tempDir, tempFile)
-                    if not tempFile.endswith( '.new' ):
-                        with open(absTempFile, 'r') as fH:
-                            statsAndLoggingCallBackFn(fH)
-                        numberOfFilesProcessed += 1
+                    with open(absTempFile, 'r') as fH:
+                        statsAndLoggingCallBackFn(fH)
+                    numberOfFilesProcessed += 1
                     os.remove(absTempFile)
         return numberOfFilesProcessed
     
-    ##########################################
-    #Private methods
-    ##########################################   
+    def _loadJobs(self, jobStoreIDs):
+        """
+        Returns the list of the batchjobs with the given jobStoreIDs that exist.
+        """
+        batchjobs = []
+        for jobStoreID in jobStoreIDs:
+            try:
+                batchjobs.append(self.load(jobStoreID))
+            except NoSuchJobException:
+                #Deleted, or its creation failed
+                pass
+        return batchjobs
+    
+    def _loadJobsInDir(self, tempDir):
+        """
+        Returns the list of the batchjobs in the given directory of the hierarchy in
+        self.tempFilesDir.
+        """
+        return self._loadJobs([ self._getRelativePath(os.path.join(tempDir, i)) 
+                                for i in os.listdir(tempDir) if i.startswith('batchjob') ])
         
     def _getAbsPath(self, relativePath):
         """
         :rtype : string, string is the absolute path to a file path relative
-        to the self.tempFilesDir.
+        to the shard it is in.
         """
-        return os.path.join(self.tempFilesDir, relativePath)
+        if len(self.shards) == 1:
+            return os.path.join(self.tempFilesDir, relativePath)
+        return os.path.join(self._getShardPath(self._getJobDirName(relativePath)), relativePath)
     
     def _getRelativePath(self, absPath):
         """
         absPath  is the absolute path to a file in the store,.
         
         :rtype : string, string is the path to the absPath file relative to the 
-        self.tempFilesDir
+        shard it is in
         
         """
-        return absPath[len(self.tempFilesDir)+1:]
+        if len(self.shards) == 1:
+            return absPath[len(self.tempFilesDir)+1:]
+        for shardPath in self.shards.itervalues():
+            if absPath.startswith(shardPath + "/"):
+                return absPath[len(shardPath)+1:]
+        raise RuntimeError("Path %s is not in a shard of the jobStore" % absPath)
+    
+    @staticmethod
+    def _getJobDirName(relativePath):
+        """
+        Returns the name of the directory of the batchjob the given path relative to a shard
+        is in, which is hashed to place the directory, see _getShardPath.
+        """
+        for name in relativePath.split("/"):
+            if name.startswith("batchjob"):
+                return name
+        return relativePath
+    
+    def _getShardPath(self, jobDirName):
+        """
+        Returns the shard the directory of a batchjob with the given name is in.
+        """
+        if len(self.shards) == 1:
+            return self.tempFilesDir
+        return self.shards[self.shardRing.get(jobDirName)]
+    
+    def _loadShards(self):
+        """
+        Reads the shards the store is spread over: self.tempFilesDir and those
+        in the shards file, lines of their names and paths.
+        """
+        shards = {"tmp": self.tempFilesDir}
+        try:
+            with open(self.shardsPath, 'r') as f:
+                for line in f.read().splitlines():
+                    name, path = line.split("\t", 1)
+                    shards[name] = path
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.shards = shards
+        self.shardRing = _ShardRing(shards.keys())
+    
+    def _reshard(self):
+        """
+        Spreads the store over the shard_roots of the config, in addition to
+        self.tempFilesDir, if they have changed. A shard is a directory with a
+        unique name in its root. The directories of the batchjobs placed in
+        another shard are moved, those are about the share of the shards added
+        and the batchjobs of the shards removed, see _ShardRing. Must not be
+        called while the store is being used by others.
+        """
+        roots = set(absSymPath(root) for root in 
+                    self.config.attrib.get("shard_roots", "").split(",") if root)
+        shards = dict((name, path) for name, path in self.shards.iteritems()
+                      if name == "tmp" or os.path.dirname(path) in roots)
+        for root in roots - set(os.path.dirname(path) for path in shards.itervalues()):
+            name = "shard-" + uuid.uuid4().hex
+            os.makedirs(os.path.join(root, name))
+            shards[name] = os.path.join(root, name)
+        if shards == self.shards:
+            return
+        ring = _ShardRing(shards.keys())
+        moved = 0
+        for jobStoreID in self._getJobStoreIDs():
+            absJobDir = self._getAbsPath(jobStoreID)
+            newJobDir = os.path.join(shards[ring.get(self._getJobDirName(jobStoreID))], jobStoreID)
+            if absJobDir != newJobDir and self._moveJobDir(absJobDir, newJobDir):
+                moved += 1
+        with open(self.shardsPath + ".new", 'w') as f:
+            for name, path in shards.iteritems():
+                if name != "tmp":
+                    f.write("%s\t%s\n" % (name, path))
+        os.rename(self.shardsPath + ".new", self.shardsPath)
+        removed = [ path for name, path in self.shards.iteritems() if name not in shards ]
+        self.shards, self.shardRing = shards, ring
+        self.knownDirs.clear()
+        for path in removed:
+            shutil.rmtree(path, ignore_errors=True)
+        logger.info("Spread the jobStore over %i shards, moving %i batchjobs", len(shards), moved)
+    
+    def _getJobStoreIDs(self):
+        """
+        Returns the list of the jobStoreIDs of the batchjobs in the store, from the index if 
+        there is one.
+        """
+        jobStoreIDs = self.jobIndex.read()
+        if jobStoreIDs is None:
+            jobStoreIDs = [ self._getRelativePath(os.path.join(tempDir, i))
+                            for tempDir in self._tempDirectories() 
+                            for i in os.listdir(tempDir) if i.startswith('batchjob') ]
+        return jobStoreIDs
+    
+    def _moveJobDir(self, absJobDir, newJobDir):
+        """
+        Moves the directory of a batchjob to another shard, returning False if it doesn't
+        exist.
+        """
+        try:
+            os.makedirs(os.path.dirname(newJobDir))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        try:
+            os.rename(absJobDir, newJobDir)
+        except OSError as e:
+            if e.errno in self._missingErrnos:
+                return False
+            if e.errno != errno.EXDEV:
+                raise
+            #The shards are on different file systems
+            shutil.copytree(absJobDir, newJobDir, symlinks=True)
+            shutil.rmtree(absJobDir)
+        return True
     
     def _getJobFileName(self, jobStoreID):
         """
@@ -238,44 +883,131 @@ class FileJobStore(AbstractJobStore):
         """
         return os.path.join(self._getAbsPath(jobStoreID), "batchjob")
 
-    def _getJobTempFile(self, jobStoreID):
+    #The suffix of the files written as immutable, see _getFileStat
+    _immutableSuffix = ".immutable.tmp"
+
+    def _getJobTempFile(self, jobStoreID, immutable=False):
         """
         :rtype : file-descriptor, string, string is absolute path to a temporary file within
         the given batchjob's (referenced by jobStoreID's) temporary file directory. The file-descriptor
         is integer pointing to open operating system file handle. Should be closed using os.close()
-        after writing some material to the file.
+        after writing some material to the file. Raises a NoSuchJobException if the batchjob
+        does not exist.
         """
-        fD, absPath = tempfile.mkstemp(suffix=".tmp", 
-                                dir=os.path.join(self._getAbsPath(jobStoreID), "g"))
+        try:
+            fD, absPath = tempfile.mkstemp(suffix=self._immutableSuffix if immutable else ".tmp", 
+                                           dir=os.path.join(self._getAbsPath(jobStoreID), "g"))
+        except OSError as e:
+            if e.errno in self._missingErrnos:
+                raise NoSuchJobException(jobStoreID)
+            raise
         return fD, absPath
     
-    def _checkJobStoreId(self, jobStoreID):
+    def _getFileStat(self, jobStoreFileID, useCache=True):
         """
-        Raises a NoSuchJobException if the jobStoreID does not exist.
+        Returns the stat of the file with the given jobStoreFileID, or None if it does not 
+        exist. Raises NoSuchFileException if the path is not a file. The stats of files written
+        as immutable are cached for the attribute_cache_ttl of the config, if it is set, so that
+        files deleted by others may seem to exist for that long.
         """
-        if not self.exists(jobStoreID):
-            raise NoSuchJobException("JobStoreID %s does not exist" % jobStoreID)
+        absPath = self._getAbsPath(jobStoreFileID)
+        useCache = useCache and jobStoreFileID.endswith(self._immutableSuffix)
+        fileStat = self.attributeCache.get(absPath) if useCache else None
+        if fileStat is None:
+            try:
+                fileStat = os.stat(absPath)
+            except OSError as e:
+                if e.errno in self._missingErrnos:
+                    return None
+                raise
+            if not stat.S_ISREG(fileStat.st_mode):
+                raise NoSuchFileException("Path %s is not a file in the jobStore" % jobStoreFileID)
+            if useCache:
+                self.attributeCache.put(absPath, fileStat)
+        return fileStat
     
     def _checkJobStoreFileID(self, jobStoreFileID):
         """
         Raises NoSuchFileException if the jobStoreFileID does not exist or is not a file.
         """
-        absPath = os.path.join(self.tempFilesDir, jobStoreFileID)
-        if not os.path.exists(absPath):
+        if not self.fileExists(jobStoreFileID):
             raise NoSuchFileException("File %s does not exist in jobStore" % jobStoreFileID)
-        if not os.path.isfile(absPath):
-            raise NoSuchFileException("Path %s is not a file in the jobStore" % jobStoreFileID) 
     
-    def _getTempSharedDir(self):
+    def _isPacked(self, jobStoreFileID):
+        """
+        Returns whether the file with the given ID was written to be packed, see 
+        writeFileStream, in which case it is packed unless it has been promoted to the file
+        at the path of its ID.
+        """
+        return jobStoreFileID.endswith(self._packedSuffix)
+    
+    def _getPackedName(self, jobStoreFileID):
+        return os.path.basename(jobStoreFileID)[:-len(self._packedSuffix)]
+    
+    def _getPack(self, jobStoreFileID):
+        return _ObjectPack.forPath(os.path.dirname(self._getAbsPath(jobStoreFileID)))
+    
+    def _getPacked(self, jobStoreFileID):
+        """
+        Returns the data of the file with the given ID if it is packed, else None.
+        """
+        if not self._isPacked(jobStoreFileID):
+            return None
+        return self._getPack(jobStoreFileID).get(self._getPackedName(jobStoreFileID))
+    
+    def _isLivePacked(self, jobStoreFileID):
+        return (self._isPacked(jobStoreFileID) and 
+                self._getPack(jobStoreFileID).contains(self._getPackedName(jobStoreFileID)))
+    
+    def _removePacked(self, jobStoreFileID):
         """
-        Gets a temporary directory in the hierarchy of directories in self.tempFilesDir.
+        Removes the file with the given ID from its pack, returning False if it wasn't packed.
+        """
+        pack = self._getPack(jobStoreFileID)
+        removed = pack.remove(self._getPackedName(jobStoreFileID))
+        self._scheduleCompaction(pack)
+        return removed
+    
+    def _scheduleCompaction(self, pack):
+        """
+        Compacts the given pack in the background if its dead space is due to be reclaimed.
+        """
+        if pack.compactionDue:
+            if self.compactionPool is None:
+                self.compactionPool = ThreadPool(1)
+            self.compactionPool.apply_async(self._compactPack, (pack,))
+    
+    @staticmethod
+    def _compactPack(pack):
+        #Errors of tasks of the pool are otherwise only raised by their results
+        try:
+            pack.compact()
+        except:
+            logger.exception("Failed to compact the pack %s", pack.path)
+    
+    #The hierarchy of directories in a shard is deepened as the store grows,
+    #so that its directories hold about this many batchjobs at most
+    maxJobsPerDir = 256
+    minLevels = 1
+    
+    def _getTempSharedDir(self, shardPath):
+        """
+        Gets a temporary directory in the hierarchy of directories in the given shard.
         This directory may contain multiple shared jobs/files.
         
         :rtype : string, path to temporary directory in which to place files/directories.
         """
-        tempDir = self.tempFilesDir
-        for i in xrange(self.levels):
+        #The depth of the hierarchy of a directory is told by its path, so
+        #directories of different depths can be in a shard
+        jobsPerShard = self.jobIndex.estimateLength() / len(self.shards)
+        levels = self.minLevels
+        while len(self.validDirs) ** levels * self.maxJobsPerDir < jobsPerShard:
+            levels += 1
+        tempDir = shardPath
+        for i in xrange(levels):
             tempDir = os.path.join(tempDir, random.choice(self.validDirs))
+            if tempDir in self.knownDirs:
+                continue
             if not os.path.exists(tempDir):
                 try:
                     os.mkdir(tempDir)
@@ -283,19 +1015,992 @@ class FileJobStore(AbstractJobStore):
                     if not os.path.exists(tempDir): #In the case that a collision occurs and
                         #it is created while we wait then we ignore
                         raise
+                else:
+                    if self.durability == "fsync":
+                        _fsyncDir(os.path.dirname(tempDir))
+            self.knownDirs.add(tempDir)
         return tempDir
      
     def _tempDirectories(self):
         """
         :rtype : an iterator to the temporary directories containing jobs/stats files
-        in the hierarchy of directories in self.tempFilesDir
+        in the hierarchies of directories in the shards
         """
-        def _dirs(path, levels):
-            if levels > 0:
-                for subPath in os.listdir(path):
-                    for i in _dirs(os.path.join(path, subPath), levels-1):
+        def _dirs(path):
+            yield path
+            for subPath in os.listdir(path):
+                #The directories of the hierarchy are named by a character
+                if len(subPath) == 1:
+                    for i in _dirs(os.path.join(path, subPath)):
                         yield i
+        for shardPath in self.shards.values():
+            for tempDir in _dirs(shardPath):
+                yield tempDir
+
+def _fsyncDir(path):
+    """
+    Flushes the entries of the directory at the given path to disk.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class _RecordState(object):
+    """
+    What a FileJobStore knows about the record of a large batchjob it has
+    loaded or updated, see FileJobStore.update.
+    """
+    __slots__ = ('fileKey', 'digests', 'snapshotSize', 'logSize')
+    
+    def __init__(self, fileKey, digests, snapshotSize, logSize):
+        #The version of the record file, see FileJobStore._getFileKey
+        self.fileKey = fileKey
+        #The digests of the attributes of the batchjob in the record
+        self.digests = digests
+        self.snapshotSize = snapshotSize
+        self.logSize = logSize
+
+class _AttributeCache(object):
+    """
+    The stats of paths, each kept for ttl seconds, see FileJobStore._getFileStat. Nothing is
+    kept if the ttl is 0.
+    """
+    #The cache is emptied when it reaches this many paths
+    maxSize = 100000
+    
+    def __init__(self, ttl):
+        self.ttl = ttl
+        #Map of paths to the time their stat expires and the stat
+        self.entries = {}
+    
+    def get(self, path):
+        entry = self.entries.get(path)
+        if entry is not None:
+            if time.time() < entry[0]:
+                return entry[1]
+            self.entries.pop(path, None)
+        return None
+    
+    def put(self, path, fileStat):
+        if self.ttl > 0:
+            if len(self.entries) >= self.maxSize:
+                self.entries.clear()
+            self.entries[path] = (time.time() + self.ttl, fileStat)
+    
+    def pop(self, path):
+        self.entries.pop(path, None)
+
+class _ShardRing(object):
+    """
+    Consistent hashing of the names of the directories of batchjobs onto the names of the
+    shards of a FileJobStore. Each shard has replicas points on a ring of hashes, and a name
+    is placed in the shard of the first point at or after its hash. Adding a shard thereby
+    moves only the names that it takes over, about its share of them, and removing a shard
+    only moves its names.
+    """
+    replicas = 64
+    
+    def __init__(self, shardNames):
+        points = sorted((self._hash("%s-%i" % (shardName, i)), shardName)
+                        for shardName in shardNames for i in xrange(self.replicas))
+        self.hashes = [ point[0] for point in points ]
+        self.shardNames = [ point[1] for point in points ]
+    
+    @staticmethod
+    def _hash(name):
+        #The hash must be the same in every process
+        return struct.unpack('<Q', hashlib.md5(name).digest()[:8])[0]
+    
+    def get(self, name):
+        return self.shardNames[bisect(self.hashes, self._hash(name)) % len(self.hashes)]
+
+class _PackingWriter(object):
+    """
+    A file-like object to write a file of a FileJobStore to, which holds what is written in 
+    memory while it is no larger than maxSize, so that it can be packed, see _ObjectPack, and
+    else writes it to the given path.
+    """
+    def __init__(self, path, maxSize):
+        self.path = path
+        self.maxSize = maxSize
+        self.buffer = StringIO()
+        self.file = None
+    
+    def write(self, data):
+        if self.file is None:
+            if self.buffer.tell() + len(data) <= self.maxSize:
+                self.buffer.write(data)
+                return
+            self.file = open(self.path, 'w')
+            self.file.write(self.buffer.getvalue())
+            self.buffer = None
+        self.file.write(data)
+    
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+    
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+    
+    def tell(self):
+        return self.buffer.tell() if self.file is None else self.file.tell()
+    
+    def close(self):
+        """
+        Returns what was written if it is held in memory, else closes the file and returns None.
+        """
+        if self.file is None:
+            return self.buffer.getvalue()
+        self.file.close()
+        return None
+
+class _ObjectPack(object):
+    """
+    The small files of a batchjob in a FileJobStore, packed in its directory of files, see
+    FileJobStore.writeFileStream. The data of an object is appended to the current segment
+    file, then an entry of its name, offset, size and whether it is live is appended to the
+    index; the last entry of a name counts. The index starts with a header of the generation
+    of the current segment and the space taken by live and by dead objects and entries. 
+    Changes are serialised by a lock on the index. Once the dead space is larger than both 
+    minCompactionSize and the live space, the pack is compacted: the live objects are copied
+    to a segment of the next generation, a new index replaces the old one by a rename, and
+    the old segment is removed. Readers take no locks, but read the index again if its 
+    segment was removed since they read it.
+    
+    The threads of a process share one instance per pack, see forPath, which keeps the 
+    entries of the index last read, so that only the entries appended since are read again.
+    """
+    minCompactionSize = 64 * 1024
+    _magic = 'TPAK'
+    _header = struct.Struct('<4sIQQ')
+    _entry = struct.Struct('<32sQI?')
+    #The packs in use by this process, and those used most recently, which are kept, with 
+    #their entries, once they are no longer in use
+    maxRecentPacks = 256
+    _packs = weakref.WeakValueDictionary()
+    _recentPacks = OrderedDict()
+    _packsLock = threading.Lock()
+    
+    @classmethod
+    def forPath(cls, path):
+        """
+        Returns the pack in the directory at the given path.
+        """
+        with cls._packsLock:
+            pack = cls._packs.get(path)
+            if pack is None:
+                pack = cls._packs[path] = cls(path)
+            cls._recentPacks.pop(path, None)
+            cls._recentPacks[path] = pack
+            if len(cls._recentPacks) > cls.maxRecentPacks:
+                cls._recentPacks.popitem(last=False)
+            return pack
+    
+    def __init__(self, path):
+        self.path = path
+        self.indexPath = os.path.join(path, "packIndex")
+        #Whether the last change left the pack due to be compacted
+        self.compactionDue = False
+        #Serialises the changes and reads of the threads of this process, as the lock on the 
+        #index is held by the process and released when any descriptor of the index is closed
+        self.lock = threading.Lock()
+        #The inode and generation of the index last read, the size of its part read and its
+        #entries, see _readIndex
+        self.cachedIndex = None
+    
+    def get(self, name):
+        """
+        Returns the data of the live object with the given name, or None.
+        """
+        missingGeneration = None
+        with self.lock:
+            while True:
+                generation, liveSize, deadSize, entries = self._readIndex()
+                entry = entries.get(name)
+                if entry is None or not entry[2]:
+                    return None
+                offset, size = entry[0], entry[1]
+                if size == 0:
+                    return ""
+                try:
+                    f = open(self._getSegmentPath(generation), 'rb')
+                except IOError as e:
+                    #The pack was compacted since the index was read, unless the segment
+                    #was already missing
+                    if e.errno != errno.ENOENT or generation == missingGeneration:
+                        raise
+                    missingGeneration = generation
+                    continue
+                with f:
+                    f.seek(offset)
+                    return f.read(size)
+    
+    def contains(self, name):
+        with self.lock:
+            entry = self._readIndex()[3].get(name)
+        return entry is not None and entry[2]
+    
+    def put(self, name, data, replace=False):
+        """
+        Packs an object with the given name and data, replacing the object with that name if 
+        replace is True.
+        """
+        with self._locked(create=True) as fd:
+            generation, liveSize, deadSize, entries = self._readIndex(fd)
+            oldEntry = entries.get(name)
+            if oldEntry is not None and oldEntry[2]:
+                liveSize -= self._getSpace(oldEntry[1])
+                deadSize += self._getSpace(oldEntry[1])
+            offset = 0
+            if len(data) > 0:
+                segmentFd = os.open(self._getSegmentPath(generation), os.O_WRONLY | os.O_CREAT)
+                try:
+                    offset = os.lseek(segmentFd, 0, os.SEEK_END)
+                    os.write(segmentFd, data)
+                finally:
+                    os.close(segmentFd)
+            self._append(fd, name, offset, len(data), True, generation, 
+                         liveSize + self._getSpace(len(data)), deadSize)
+    
+    def remove(self, name):
+        """
+        Removes the object with the given name, returning False if there is no live object
+        with that name.
+        """
+        try:
+            with self._locked(create=False) as fd:
+                generation, liveSize, deadSize, entries = self._readIndex(fd)
+                entry = entries.get(name)
+                if entry is None or not entry[2]:
+                    return False
+                space = self._getSpace(entry[1])
+                self._append(fd, name, entry[0], entry[1], False, generation, 
+                             liveSize - space, deadSize + space + self._entry.size)
+                return True
+        except EnvironmentError as e:
+            #The pack or its batchjob doesn't exist
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            return False
+    
+    def compact(self):
+        """
+        Copies the live objects to a new segment, if the pack is still due to be compacted.
+        """
+        try:
+            with self._locked(create=False) as fd:
+                generation, liveSize, deadSize, entries = self._readIndex(fd)
+                if not self._isCompactionDue(liveSize, deadSize):
+                    return
+                segment = None
+                newEntries = []
+                with open(self._getSegmentPath(generation + 1), 'wb') as newSegment:
+                    for name, (offset, size, live) in entries.iteritems():
+                        if not live:
+                            continue
+                        data = ""
+                        if size > 0:
+                            if segment is None:
+                                segment = open(self._getSegmentPath(generation), 'rb')
+                            segment.seek(offset)
+                            data = segment.read(size)
+                        newEntries.append(self._entry.pack(name, newSegment.tell(), size, True))
+                        newSegment.write(data)
+                    liveSize = newSegment.tell() + len(newEntries) * self._entry.size
+                if segment is not None:
+                    segment.close()
+                with open(self.indexPath + ".new", 'wb') as f:
+                    f.write(self._header.pack(self._magic, generation + 1, liveSize, 0))
+                    f.write("".join(newEntries))
+                os.rename(self.indexPath + ".new", self.indexPath)
+                try:
+                    os.remove(self._getSegmentPath(generation))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+        except EnvironmentError as e:
+            #The batchjob was deleted
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+    
+    def _getSegmentPath(self, generation):
+        return os.path.join(self.path, "pack%i" % generation)
+    
+    def _getSpace(self, size):
+        return size + self._entry.size
+    
+    def _isCompactionDue(self, liveSize, deadSize):
+        return deadSize >= self.minCompactionSize and deadSize > liveSize
+    
+    @contextmanager
+    def _locked(self, create):
+        """
+        Context manager yielding a descriptor of the index with the lock held. The index is 
+        created if create is True, else an error is raised if it doesn't exist.
+        """
+        with self.lock:
+            while True:
+                fd = os.open(self.indexPath, os.O_RDWR | (os.O_CREAT if create else 0))
+                try:
+                    fcntl.lockf(fd, fcntl.LOCK_EX)
+                    #The index may have been replaced by a compaction while waiting
+                    if os.fstat(fd).st_ino == os.stat(self.indexPath).st_ino:
+                        break
+                except:
+                    os.close(fd)
+                    raise
+                os.close(fd)
+            try:
+                if os.fstat(fd).st_size == 0:
+                    os.write(fd, self._header.pack(self._magic, 0, 0, 0))
+                yield fd
+            finally:
+                #Closing the descriptor releases the lock
+                os.close(fd)
+    
+    def _append(self, fd, name, offset, size, live, generation, liveSize, deadSize):
+        """
+        Appends an entry to the index and updates its header. Must be called with the lock held.
+        """
+        os.lseek(fd, 0, os.SEEK_END)
+        os.write(fd, self._entry.pack(name, offset, size, live))
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, self._header.pack(self._magic, generation, liveSize, deadSize))
+        self.compactionDue = self._isCompactionDue(liveSize, deadSize)
+    
+    def _readIndex(self, fd=None):
+        """
+        Returns the generation, the live and dead space and the entries of the index, a dict
+        of names to tuples of the offset, size and liveness of objects, from the given 
+        descriptor if it is not None. The entries are those last read, updated with the
+        entries appended since, and must not be changed. Must be called with self.lock held.
+        """
+        if fd is None:
+            try:
+                fd = os.open(self.indexPath, os.O_RDONLY)
+            except OSError as e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+                return 0, 0, 0, {}
+            try:
+                return self._readIndex(fd)
+            finally:
+                os.close(fd)
+        os.lseek(fd, 0, os.SEEK_SET)
+        data = os.read(fd, self._header.size)
+        #An index whose header is still being written is empty
+        if len(data) < self._header.size:
+            return 0, 0, 0, {}
+        magic, generation, liveSize, deadSize = self._header.unpack(data)
+        #A compaction replaces the index by one of the next generation, else entries are 
+        #only appended
+        indexStat = os.fstat(fd)
+        inode = indexStat.st_ino
+        if (self.cachedIndex is not None and self.cachedIndex[:2] == (inode, generation)
+                and self.cachedIndex[2] <= indexStat.st_size):
+            readSize, entries = self.cachedIndex[2:]
+        else:
+            readSize, entries = self._header.size, {}
+        os.lseek(fd, readSize, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(fd, 1024 * 1024)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        data = "".join(chunks)
+        #An entry that is still being appended is read next time
+        end = len(data) - len(data) % self._entry.size
+        for offset in xrange(0, end, self._entry.size):
+            name, objectOffset, size, live = self._entry.unpack_from(data, offset)
+            entries[name] = (objectOffset, size, live)
+        self.cachedIndex = (inode, generation, readSize + end, entries)
+        return generation, liveSize, deadSize, entries
+
+class _JobIndex(object):
+    """
+    The jobStoreIDs of the batchjobs in a FileJobStore, see FileJobStore.jobs. The index is an
+    append-only manifest, a line per created ("+jobStoreID") or deleted ("-jobStoreID") 
+    batchjob. Appends are serialised by a lock on a separate lock file. The manifest is
+    compacted, by replacing it with the lines of the batchjobs that exist, once it has doubled
+    in size since it was last compacted, the size it was compacted to is kept in the lock file.
+    Batchjobs whose creation failed may be listed, but every batchjob that exists is.
+    """
+    #The manifest is compacted no sooner than it reaches this size
+    minCompactionSize = 1024 * 1024
+    
+    def __init__(self, path):
+        self.path = path
+        self.lockPath = path + ".lock"
+        #The descriptors of the manifest and the lock file, opened by the first append
+        self.fd = None
+        self.lockFd = None
+        #The inode of the manifest opened, as it is replaced when compacted
+        self.inode = None
+        #The size the manifest is compacted at
+        self.compactionSize = None
+        #Whether the store has an index, which those created by earlier versions of toil lack
+        self.enabled = True
+        #Whether appends are flushed to disk, see FileJobStore.durabilityModes
+        self.sync = False
+        #The size of the manifest as of the last append of this process, see estimateLength
+        self.size = None
+        #Serialises the appends of the threads of this process, as the lock on the lock file
+        #is held by the process
+        self.threadLock = threading.Lock()
+    
+    def create(self):
+        with open(self.path, 'w'):
+            pass
+    
+    def close(self):
+        with self.threadLock:
+            for fd in (self.fd, self.lockFd):
+                if fd is not None:
+                    os.close(fd)
+            self.fd = self.lockFd = None
+    
+    def add(self, jobStoreID):
+        self._append("+%s\n" % jobStoreID)
+    
+    def remove(self, jobStoreID):
+        self._append("-%s\n" % jobStoreID)
+    
+    #The size of a line of the manifest assumed by estimateLength
+    estimatedLineSize = 32
+    
+    def estimateLength(self):
+        """
+        Returns an estimate of the number of lines of the manifest, which counts the batchjobs
+        deleted since it was compacted, from its size as of the last append of this process,
+        or else as of the first call.
+        """
+        if self.size is None:
+            try:
+                self.size = os.stat(self.path).st_size
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self.size = 0
+        return self.size / self.estimatedLineSize
+    
+    def read(self):
+        """
+        Returns the list of the jobStoreIDs in the index, or None if there is no index.
+        """
+        try:
+            with open(self.path, 'r') as f:
+                data = f.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        return self._parse(data)
+    
+    @staticmethod
+    def _parse(data):
+        #A jobStoreID is counted rather than added to a set, as a name may be
+        #reused once its batchjob has been deleted. The last line is ignored if
+        #it is still being appended.
+        counts = defaultdict(int)
+        for line in data.split("\n")[:-1]:
+            counts[line[1:]] += 1 if line[0] == "+" else -1
+        return [ jobStoreID for jobStoreID, count in counts.iteritems() if count > 0 ]
+    
+    def _append(self, line):
+        if not self.enabled:
+            return
+        with self.threadLock:
+            if self.lockFd is None:
+                self.lockFd = os.open(self.lockPath, os.O_RDWR | os.O_CREAT)
+            fcntl.lockf(self.lockFd, fcntl.LOCK_EX)
+            try:
+                if not self._open():
+                    return
+                os.write(self.fd, line)
+                if self.sync:
+                    os.fdatasync(self.fd)
+                self.size = os.lseek(self.fd, 0, os.SEEK_END)
+                if self.size >= self.compactionSize:
+                    self._compact()
+            finally:
+                fcntl.lockf(self.lockFd, fcntl.LOCK_UN)
+    
+    def _open(self):
+        """
+        Opens the manifest, unless this process has it open and it hasn't been compacted since.
+        Returns False if there is no index. Must be called with the lock held.
+        """
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.enabled = False
+            return False
+        if inode != self.inode:
+            if self.fd is not None:
+                os.close(self.fd)
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+            self.inode = inode
+            os.lseek(self.lockFd, 0, os.SEEK_SET)
+            compactedSize = os.read(self.lockFd, 32)
+            self.compactionSize = max(self.minCompactionSize, 2 * int(compactedSize or 0))
+        return True
+    
+    def _compact(self):
+        """
+        Replaces the manifest with the lines of the batchjobs that exist. Must be called with
+        the lock held.
+        """
+        with open(self.path, 'r') as f:
+            data = "".join("+%s\n" % i for i in self._parse(f.read()))
+        with open(self.path + ".new", 'w') as f:
+            f.write(data)
+            if self.sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.rename(self.path + ".new", self.path)
+        if self.sync:
+            _fsyncDir(os.path.dirname(self.path))
+        os.ftruncate(self.lockFd, 0)
+        os.lseek(self.lockFd, 0, os.SEEK_SET)
+        os.write(self.lockFd, str(len(data)))
+        self._open()
+
+class _StatsSpool(object):
+    """
+    The stats/logging files of a FileJobStore, in a spool directory. Each file is named by a
+    number taken from a counter, incremented under a lock on the counter's file, and written
+    under its name suffixed by ".new" before being renamed. The reader lists the spool, reads
+    the files in the order of their numbers and then removes them. It persists a cursor, the
+    number of the first file it hasn't read or given up on, before removing files, so that 
+    files read before it was stopped are not read again. The reader waits gapTimeout seconds
+    for a missing number before giving up on it, as its writer may have failed.
+    """
+    gapTimeout = 60
+    
+    def __init__(self, path):
+        self.path = path
+        self.counterPath = path + ".counter"
+        self.cursorPath = path + ".cursor"
+        #The descriptor of the counter, opened by the first write
+        self.counterFd = None
+        #Serialises the writes of the threads of this process, as the lock on 
+        #the counter is held by the process
+        self.threadLock = threading.Lock()
+        #The cursor, loaded by the first read
+        self.cursor = None
+        #The numbers of the files at or after the cursor that have been read
+        self.readNumbers = set()
+        #Map of the missing numbers after the cursor to when they were first missed
+        self.gaps = {}
+        #Wakes the reader when a file is written, see wait
+        self.watcher = None
+    
+    def create(self):
+        try:
+            os.mkdir(self.path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    
+    def close(self):
+        with self.threadLock:
+            if self.counterFd is not None:
+                os.close(self.counterFd)
+                self.counterFd = None
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+    
+    def write(self, data):
+        path = self._getPath(self._nextNumber())
+        try:
+            f = open(path + ".new", 'w')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            #A store created by an earlier version of toil
+            self.create()
+            f = open(path + ".new", 'w')
+        with f:
+            f.write(data)
+        try:
+            os.rename(path + ".new", path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            logger.warn("The stats/logging file %s took too long to write and was dropped", path)
+    
+    def read(self, callback):
+        """
+        Calls the callback with a file handle for each file written since the last call, 
+        returning the number of files read, or None if there is no spool, in which case it
+        is created.
+        """
+        if self.cursor is None:
+            try:
+                with open(self.cursorPath, 'r') as f:
+                    self.cursor = int(f.read())
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self.cursor = 0
+        try:
+            names = os.listdir(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.create()
+            return None
+        #Other names, e.g. of the files NFS renames removed files that are 
+        #still open to, are ignored
+        numbers = sorted(int(name) for name in names if name.isdigit())
+        writing = [ int(name[:-4]) for name in names 
+                    if name.endswith(".new") and name[:-4].isdigit() ]
+        numberOfFilesRead = 0
+        for number in numbers:
+            if number >= self.cursor and number not in self.readNumbers:
+                with open(self._getPath(number), 'r') as f:
+                    callback(f)
+                self.readNumbers.add(number)
+                numberOfFilesRead += 1
+        #Advance the cursor past the numbers read and those given up on
+        cursor = self.cursor
+        known = numbers + writing + list(self.readNumbers)
+        end = max(known) + 1 if len(known) > 0 else cursor
+        now = time.time()
+        for number in xrange(cursor, end):
+            if number not in self.readNumbers:
+                self.gaps.setdefault(number, now)
+        while cursor < end:
+            if cursor in self.readNumbers:
+                self.readNumbers.remove(cursor)
+            elif now - self.gaps[cursor] >= self.gapTimeout:
+                logger.warn("Gave up on stats/logging file %i, which was not written within "
+                            "%s seconds", cursor, self.gapTimeout)
             else:
-                yield path
-        for tempDir in _dirs(self.tempFilesDir, self.levels):
-            yield tempDir
+                break
+            self.gaps.pop(cursor, None)
+            cursor += 1
+        if cursor != self.cursor:
+            with open(self.cursorPath + ".new", 'w') as f:
+                f.write(str(cursor))
+            os.rename(self.cursorPath + ".new", self.cursorPath)
+            self.cursor = cursor
+        #Files before the cursor that weren't read by this call were read 
+        #before the reader was stopped, or given up on
+        for number in numbers:
+            if number < cursor or number in self.readNumbers:
+                os.remove(self._getPath(number))
+        for number in writing:
+            if number < cursor:
+                os.remove(self._getPath(number) + ".new")
+        return numberOfFilesRead
+    
+    def wait(self, timeout):
+        """
+        Blocks until a file is written or timeout seconds have passed, returning True in the
+        former case. Files written by other hosts of a network file system are not noticed.
+        """
+        if not inotify.isAvailable():
+            time.sleep(timeout)
+            return False
+        if self.watcher is None:
+            self.create()
+            self.watcher = inotify.INotify()
+            self.watcher.addWatch(self.path, inotify.IN_MOVED_TO)
+        return self.watcher.wait(timeout)
+    
+    def _getPath(self, number):
+        return os.path.join(self.path, "%020i" % number)
+    
+    def _nextNumber(self):
+        with self.threadLock:
+            if self.counterFd is None:
+                self.counterFd = os.open(self.counterPath, os.O_RDWR | os.O_CREAT)
+            fcntl.lockf(self.counterFd, fcntl.LOCK_EX)
+            try:
+                os.lseek(self.counterFd, 0, os.SEEK_SET)
+                number = int(os.read(self.counterFd, 20) or 0)
+                #The counter has a fixed width, so it is simply overwritten
+                os.lseek(self.counterFd, 0, os.SEEK_SET)
+                os.write(self.counterFd, "%020i" % (number + 1))
+            finally:
+                fcntl.lockf(self.counterFd, fcntl.LOCK_UN)
+        return number
+
+class _Journal(object):
+    """
+    The journal of the updates of the batchjobs of a FileJobStore whose durability is "group",
+    see FileJobStore.durabilityModes. An update is appended to the journal, which is flushed
+    to disk before the batchjob file is changed, so that the journal holds every change that
+    may have reached the disk. The journal is a single log shared by the processes using the
+    store, on any host. Records are appended under a lock, so their order in the log is the
+    order of the changes, whatever the clocks of the hosts. Flushes are made under a second
+    lock, and the lock file holds the size of the log that has been flushed: a process that 
+    waited for the lock while another flushed finds that its records have been flushed with
+    the others, so the updates made at the same time by the leader and the workers share one
+    fdatasync. The threads of a process wait for each other's flushes instead of taking the
+    lock in turn.
+    
+    The log is emptied once it reaches maxSize, a checkpoint, after the files of the 
+    batchjobs it has records of have been flushed to disk. Updates are made under a shared
+    lock and checkpoints under an exclusive one, so that those files have been written when
+    they are flushed. Each checkpoint starts a new epoch, kept in the lock file with the 
+    flushed size, so that sizes flushed before it are not taken for sizes of the emptied
+    log. The records in the log are replayed in order when the workflow is restarted, see 
+    replay.
+    """
+    #The log is emptied once it reaches this size
+    maxSize = 64 * 1024 * 1024
+    _entryHeader = struct.Struct('<Ii')
+    #The bytes of the lock file locked to make updates or checkpoints, to append records and
+    #to flush the log
+    _updateLock = 0
+    _appendLock = 1
+    _flushLock = 2
+    #The epoch and the flushed size of the log, at the start of the lock file
+    _stateFormat = "%020i %020i"
+    _stateSize = 41
+    #The journals of this process, by path, see get
+    _journals = {}
+    _journalsLock = threading.Lock()
+    
+    @classmethod
+    def get(cls, path, syncFn):
+        """
+        Returns the journal at the given path, which is shared by the FileJobStores of this
+        process, as the locks are held by the process. syncFn is called with a list of 
+        jobStoreIDs to flush the files of those batchjobs to disk.
+        """
+        with cls._journalsLock:
+            journal = cls._journals.get(path)
+            if journal is None:
+                journal = cls._journals[path] = cls(path, syncFn)
+            return journal
+    
+    def __init__(self, path, syncFn):
+        self.path = path
+        self.syncFn = syncFn
+        self.logPath = os.path.join(path, "log")
+        self.lockPath = os.path.join(path, "lock")
+        #The descriptors of the log and of the lock file, opened by the first commit
+        self.fd = None
+        self.lockFd = None
+        #The size of the log after the last append of this process
+        self.size = 0
+        #The epoch of the updates in flight, and the epoch and size of the log known to have
+        #been flushed
+        self.epoch = None
+        self.flushed = (-1, 0)
+        #Whether a thread is flushing the log
+        self.flushing = False
+        #The number of threads of this process that are in a commit
+        self.inFlight = 0
+        #Whether a thread of this process is making a checkpoint, which blocks commits
+        self.checkpointing = False
+        self.condition = threading.Condition()
+    
+    def close(self):
+        with self.condition:
+            for fd in (self.fd, self.lockFd):
+                if fd is not None:
+                    os.close(fd)
+            self.fd = self.lockFd = None
+    
+    @contextmanager
+    def commit(self, jobStoreID, offset, data):
+        """
+        Journals a change of the file of the batchjob with the given jobStoreID: the data
+        written at the offset, replacing the rest of the file, or the deletion of the batchjob
+        if data is None. Returns a context manager to make the change in, which is entered
+        once the record is on disk.
+        """
+        with self.condition:
+            while self.checkpointing:
+                self.condition.wait()
+            if self.fd is None:
+                self._open()
+            if self.inFlight == 0:
+                self._lock(fcntl.LOCK_SH, self._updateLock)
+                #No checkpoint can be made while the shared lock is held
+                self.epoch = self._readState()[0]
+            self.inFlight += 1
+            try:
+                payload = marshal.dumps((jobStoreID, offset, data))
+                entry = self._entryHeader.pack(len(payload), zlib.crc32(payload)) + payload
+                self._lock(fcntl.LOCK_EX, self._appendLock)
+                try:
+                    os.write(self.fd, entry)
+                    self.size = os.lseek(self.fd, 0, os.SEEK_CUR)
+                finally:
+                    self._lock(fcntl.LOCK_UN, self._appendLock)
+                self._flush(self.size)
+            except:
+                self._leave()
+                raise
+        try:
+            yield
+        finally:
+            with self.condition:
+                self._leave()
+                if self.size >= self.maxSize and not self.checkpointing:
+                    self._checkpoint()
+    
+    def replay(self, apply):
+        """
+        Calls apply with each jobStoreID the journal has records of and the list of its 
+        changes, pairs of an offset and data as passed to commit, in the order they were made,
+        then empties the journal. Returns the list of the jobStoreIDs. Must not be called 
+        while the store is being updated.
+        """
+        with self.condition:
+            if self.fd is None:
+                self._open()
+            self._lock(fcntl.LOCK_EX, self._updateLock)
+            try:
+                changes = OrderedDict()
+                for jobStoreID, offset, data in self._readRecords():
+                    changes.setdefault(jobStoreID, []).append((offset, data))
+                for jobStoreID, jobChanges in changes.iteritems():
+                    apply(jobStoreID, jobChanges)
+                if len(changes) > 0:
+                    self._empty(changes.keys())
+            finally:
+                self._lock(fcntl.LOCK_UN, self._updateLock)
+            return changes.keys()
+    
+    def _readRecords(self):
+        """
+        Returns the records in the log, tuples of the jobStoreID, offset and data of a change,
+        up to the first that is incomplete.
+        """
+        with open(self.logPath, 'rb') as f:
+            data = f.read()
+        records = []
+        offset = 0
+        while offset + self._entryHeader.size <= len(data):
+            size, checksum = self._entryHeader.unpack_from(data, offset)
+            start = offset + self._entryHeader.size
+            payload = data[start:start + size]
+            if len(payload) < size or zlib.crc32(payload) != checksum:
+                break
+            records.append(marshal.loads(payload))
+            offset = start + size
+        return records
+    
+    def _open(self):
+        """
+        Opens the log and the lock file. Must be called with the condition held.
+        """
+        try:
+            os.mkdir(self.path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.lockFd = os.open(self.lockPath, os.O_RDWR | os.O_CREAT)
+        self.fd = os.open(self.logPath, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    
+    def _lock(self, operation, byte):
+        while True:
+            try:
+                fcntl.lockf(self.lockFd, operation, 1, byte)
+                return
+            except IOError as e:
+                #The locks are held by processes, so the kernel takes a thread waiting
+                #for one lock while another thread of its process holds another for a
+                #deadlock, although the locks are only held briefly
+                if e.errno != errno.EDEADLK:
+                    raise
+                time.sleep(0.001)
+    
+    def _readState(self):
+        """
+        Returns the epoch and the flushed size of the log from the lock file.
+        """
+        os.lseek(self.lockFd, 0, os.SEEK_SET)
+        state = os.read(self.lockFd, self._stateSize)
+        if len(state) < self._stateSize:
+            return 0, 0
+        epoch, flushed = state.split()
+        return int(epoch), int(flushed)
+    
+    def _writeState(self, epoch, flushed):
+        os.lseek(self.lockFd, 0, os.SEEK_SET)
+        os.write(self.lockFd, self._stateFormat % (epoch, flushed))
+    
+    def _flush(self, end):
+        """
+        Returns once the log is on disk up to the given end of a record appended by this 
+        process, flushing it unless it has been flushed that far by another process, or is
+        being flushed by another thread. Must be called with the condition held, in a commit.
+        """
+        epoch = self.epoch
+        while self.flushed < (epoch, end):
+            if self.flushing:
+                self.condition.wait()
+                continue
+            self.flushing = True
+            self.condition.release()
+            try:
+                self._lock(fcntl.LOCK_EX, self._flushLock)
+                try:
+                    #The epoch can't change while the shared lock is held
+                    flushed = self._readState()[1]
+                    if flushed < end:
+                        #Everything appended so far is flushed, by any process
+                        flushed = os.fstat(self.fd).st_size
+                        os.fdatasync(self.fd)
+                        self._writeState(epoch, flushed)
+                finally:
+                    self._lock(fcntl.LOCK_UN, self._flushLock)
+            finally:
+                self.condition.acquire()
+                self.flushing = False
+                self.condition.notify_all()
+            self.flushed = max(self.flushed, (epoch, flushed))
+    
+    def _leave(self):
+        """
+        Ends a commit. Must be called with the condition held.
+        """
+        self.inFlight -= 1
+        if self.inFlight == 0:
+            self._lock(fcntl.LOCK_UN, self._updateLock)
+            self.condition.notify_all()
+    
+    def _checkpoint(self):
+        """
+        Empties the log, unless another process has. Must be called with the condition held.
+        """
+        self.checkpointing = True
+        try:
+            while self.inFlight > 0:
+                self.condition.wait()
+            self._lock(fcntl.LOCK_EX, self._updateLock)
+            try:
+                if os.fstat(self.fd).st_size >= self.maxSize:
+                    self._empty(set(record[0] for record in self._readRecords()))
+            finally:
+                self._lock(fcntl.LOCK_UN, self._updateLock)
+        finally:
+            self.checkpointing = False
+            self.condition.notify_all()
+    
+    def _empty(self, jobStoreIDs):
+        """
+        Flushes the files of the batchjobs with the given jobStoreIDs, those the log has 
+        records of, and empties the log, starting a new epoch. Must be called with the 
+        exclusive lock held.
+        """
+        self.syncFn(jobStoreIDs)
+        self._writeState(self._readState()[0] + 1, 0)
+        os.ftruncate(self.fd, 0)
+        os.fdatasync(self.fd)
+        self.size = 0
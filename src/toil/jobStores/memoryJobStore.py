@@ -0,0 +1,269 @@
+from contextlib import contextmanager
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from cStringIO import StringIO
+from toil.jobStores.abstractJobStore import AbstractJobStore, NoSuchJobException, \
+    NoSuchFileException
+from toil.batchJob import BatchJob
+
+logger = logging.getLogger( __name__ )
+
+class MemoryJobStore(AbstractJobStore):
+    """Keeps the jobs and files of a toil in the memory of the process, see
+    Job.Runner.runLocal. The instances created with the same name share their
+    contents, so the store can be used by the leader and by workers running in
+    threads of the leader's process, but not by other processes. For doc-strings
+    of functions see AbstractJobStore.
+    """
+
+    #Map of the names of the stores of this process to their contents
+    _stores = {}
+    _storesLock = threading.Lock()
+
+    def __init__(self, name, config=None):
+        self.name = name
+        with self._storesLock:
+            if name not in self._stores:
+                self._stores[name] = _Contents()
+            self.contents = self._stores[name]
+        super( MemoryJobStore, self ).__init__( config=config )
+
+    @classmethod
+    def isProcessLocal(cls):
+        return True
+
+    def deleteJobStore(self):
+        with self._storesLock:
+            self._stores.pop(self.name, None)
+        with self.contents.lock:
+            if self.contents.urlDir is not None:
+                shutil.rmtree(self.contents.urlDir)
+                self.contents.urlDir = None
+
+    ##########################################
+    #The following methods deal with creating/loading/updating/writing/checking for the
+    #existence of jobs
+    ##########################################
+
+    def create(self, command, memory, cpu, disk, updateID=None,
+               predecessorNumber=0):
+        batchjob = BatchJob(command=command, memory=memory, cpu=cpu, disk=disk,
+                  jobStoreID="batchjob" + uuid.uuid4().hex,
+                  remainingRetryCount=self._defaultTryCount( ),
+                  updateID=updateID,
+                  predecessorNumber=predecessorNumber)
+        with self.contents.lock:
+            self.contents.jobFiles[batchjob.jobStoreID] = set()
+        self.update(batchjob)
+        return batchjob
+
+    def exists(self, jobStoreID):
+        return jobStoreID in self.contents.jobs
+
+    def getPublicUrl( self,  jobStoreFileID):
+        with self.contents.lock:
+            return self._writeUrlFile(self._getFile(jobStoreFileID))
+
+    def getSharedPublicUrl( self,  FileName):
+        with self.contents.lock:
+            if FileName not in self.contents.sharedFiles:
+                raise NoSuchFileException(FileName)
+            return self._writeUrlFile(self.contents.sharedFiles[FileName])
+
+    def load(self, jobStoreID):
+        #The batchjob is kept serialised, so that changes to the loaded copy
+        #are only seen by others once it is updated, as with the other stores
+        try:
+            data = self.contents.jobs[jobStoreID]
+        except KeyError:
+            raise NoSuchJobException(jobStoreID)
+        return BatchJob.fromBytes(data)
+
+    def update(self, batchjob):
+        data = batchjob.toBytes()
+        with self.contents.lock:
+            if batchjob.jobStoreID not in self.contents.jobFiles:
+                raise NoSuchJobException(batchjob.jobStoreID)
+            self.contents.jobs[batchjob.jobStoreID] = data
+
+    def delete(self, jobStoreID):
+        #Deleting the batchjob deletes its files
+        with self.contents.lock:
+            self.contents.jobs.pop(jobStoreID, None)
+            for jobStoreFileID in self.contents.jobFiles.pop(jobStoreID, ()):
+                self.contents.files.pop(jobStoreFileID, None)
+            self.contents.deleted.notify_all()
+
+    def jobs(self):
+        for jobStoreID in self.contents.jobs.keys():
+            try:
+                yield self.load(jobStoreID)
+            except NoSuchJobException:
+                #Deleted since the IDs were listed
+                pass
+
+    ##########################################
+    #Functions that deal with temporary files associated with jobs
+    ##########################################
+
+    def writeFile(self, jobStoreID, localFilePath, immutable=False):
+        with open(localFilePath, 'r') as f:
+            data = f.read()
+        with self.contents.lock:
+            jobStoreFileID = self._newFileID(jobStoreID)
+            self.contents.files[jobStoreFileID] = data
+        return jobStoreFileID
+
+    def updateFile(self, jobStoreFileID, localFilePath, immutable=False):
+        with open(localFilePath, 'r') as f:
+            self._setFile(jobStoreFileID, f.read())
+
+    def readFile(self, jobStoreFileID, localFilePath, byteRange=None):
+        with self.readFileStream(jobStoreFileID, *(byteRange or ())) as f:
+            with open(localFilePath, 'w') as localFile:
+                shutil.copyfileobj(f, localFile)
+
+    def deleteFile(self, jobStoreFileID):
+        with self.contents.lock:
+            if self.contents.files.pop(jobStoreFileID, None) is not None:
+                self.contents.jobFiles[self._getJobStoreID(jobStoreFileID)].discard(jobStoreFileID)
+                self.contents.deleted.notify_all()
+
+    def fileExists(self, jobStoreFileID):
+        return jobStoreFileID in self.contents.files
+
+    @contextmanager
+    def writeFileStream(self, jobStoreID):
+        with self.contents.lock:
+            jobStoreFileID = self._newFileID(jobStoreID)
+        f = StringIO()
+        yield f, jobStoreFileID
+        self._setFile(jobStoreFileID, f.getvalue())
+
+    @contextmanager
+    def updateFileStream(self, jobStoreFileID):
+        with self.contents.lock:
+            self._getFile(jobStoreFileID)
+        f = StringIO()
+        yield f
+        self._setFile(jobStoreFileID, f.getvalue())
+
+    def getEmptyFileStoreID(self, jobStoreID):
+        with self.contents.lock:
+            return self._newFileID(jobStoreID)
+
+    @contextmanager
+    def readFileStream(self, jobStoreFileID, offset=0, length=None):
+        with self.contents.lock:
+            data = self._getFile(jobStoreFileID)
+        #Only the requested range is copied
+        end = None if length is None else offset + length
+        yield StringIO(data if offset == 0 and end is None else data[offset:end])
+
+    def waitForFileDeletion(self, jobStoreFileIDs, timeout=None):
+        #Deletions are notified, so we are woken up as soon as a file is deleted
+        def waitFn(interval):
+            with self.contents.lock:
+                self.contents.deleted.wait(interval)
+        return self._waitForFileDeletion(jobStoreFileIDs, timeout,
+                                         lambda ids: filter(self.fileExists, ids), waitFn)
+
+    ##########################################
+    #The following methods deal with shared files, i.e. files not associated
+    #with specific jobs.
+    ##########################################
+
+    @contextmanager
+    def writeSharedFileStream(self, sharedFileName):
+        assert self._validateSharedFileName( sharedFileName )
+        f = StringIO()
+        yield f
+        #Readers see the previous version until the new one is complete
+        with self.contents.lock:
+            self.contents.sharedFiles[sharedFileName] = f.getvalue()
+
+    @contextmanager
+    def readSharedFileStream(self, sharedFileName):
+        assert self._validateSharedFileName( sharedFileName )
+        try:
+            data = self.contents.sharedFiles[sharedFileName]
+        except KeyError:
+            raise NoSuchFileException(sharedFileName)
+        yield StringIO(data)
+
+    def deleteSharedFile(self, sharedFileName):
+        assert self._validateSharedFileName( sharedFileName )
+        with self.contents.lock:
+            self.contents.sharedFiles.pop(sharedFileName, None)
+
+    def writeStatsAndLogging(self, statsAndLoggingString):
+        with self.contents.lock:
+            self.contents.statsAndLogging.append(statsAndLoggingString)
+
+    def readStatsAndLogging( self, statsAndLoggingCallBackFn):
+        with self.contents.lock:
+            statsAndLoggingStrings = self.contents.statsAndLogging
+            self.contents.statsAndLogging = []
+        for statsAndLoggingString in statsAndLoggingStrings:
+            statsAndLoggingCallBackFn(StringIO(statsAndLoggingString))
+        return len(statsAndLoggingStrings)
+
+    ##########################################
+    #Private methods, called holding the lock of the contents
+    ##########################################
+
+    def _newFileID(self, jobStoreID):
+        if jobStoreID not in self.contents.jobFiles:
+            raise NoSuchJobException(jobStoreID)
+        #The ID of a file records the batchjob it belongs to
+        jobStoreFileID = "%s/%s" % (jobStoreID, uuid.uuid4().hex)
+        self.contents.jobFiles[jobStoreID].add(jobStoreFileID)
+        self.contents.files[jobStoreFileID] = ""
+        return jobStoreFileID
+
+    @staticmethod
+    def _getJobStoreID(jobStoreFileID):
+        return jobStoreFileID.split("/", 1)[0]
+
+    def _getFile(self, jobStoreFileID):
+        try:
+            return self.contents.files[jobStoreFileID]
+        except KeyError:
+            raise NoSuchFileException(jobStoreFileID)
+
+    def _setFile(self, jobStoreFileID, data):
+        with self.contents.lock:
+            self._getFile(jobStoreFileID)
+            self.contents.files[jobStoreFileID] = data
+
+    def _writeUrlFile(self, data):
+        #The URL is of a copy of the file, which is kept until the store is deleted
+        if self.contents.urlDir is None:
+            self.contents.urlDir = tempfile.mkdtemp(prefix="toil-memoryJobStore-")
+        fd, path = tempfile.mkstemp(dir=self.contents.urlDir)
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        return 'file:' + path
+
+class _Contents(object):
+    """
+    The jobs and files of a MemoryJobStore.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        #Notified when a file is deleted, see waitForFileDeletion
+        self.deleted = threading.Condition(self.lock)
+        #Map of jobStoreIDs to the serialised batchjobs
+        self.jobs = {}
+        #Map of jobStoreIDs to the IDs of their files
+        self.jobFiles = {}
+        #Map of the IDs of files to their contents
+        self.files = {}
+        self.sharedFiles = {}
+        self.statsAndLogging = []
+        #The directory of the copies of files made by getPublicUrl
+        self.urlDir = None
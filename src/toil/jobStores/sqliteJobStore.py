@@ -0,0 +1,529 @@
+from contextlib import contextmanager
+from cStringIO import StringIO
+import errno
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from toil.lib.bioio import absSymPath
+from toil.lib import transfer
+from toil.jobStores.abstractJobStore import AbstractJobStore, NoSuchJobException, \
+    NoSuchFileException, RangeReader
+from toil.batchJob import BatchJob
+
+logger = logging.getLogger( __name__ )
+
+class SQLiteJobStore(AbstractJobStore):
+    """Keeps the batchjobs, the metadata of files, the names of shared files
+    and the stats/logging strings of a toil in an SQLite database in WAL mode,
+    and the contents of files in a directory next to it, the blob directory.
+    A workflow of many small jobs thereby creates a row per batchjob rather
+    than a directory. The processes using the store must run on one host, as
+    WAL mode doesn't work across the hosts of a network file system. For
+    doc-strings of functions see AbstractJobStore.
+    """
+
+    #How long, in seconds, a write waits for those of other processes
+    busyTimeout = 600
+    #The number of rows read at a time by jobs and readStatsAndLogging
+    pageSize = 1000
+
+    def __init__(self, dbPath, config=None):
+        self.dbPath = absSymPath(dbPath)
+        logger.info("Jobstore database is: %s", self.dbPath)
+        self.filesDir = self.dbPath + ".files"
+        #The connection of each thread, see _getConnection, and its state
+        self.local = threading.local()
+        #All connections, so that deleteJobStore can close them
+        self.connections = []
+        self.connectionsLock = threading.Lock()
+        #The synchronous setting of the connections, see durability below
+        self.synchronous = "NORMAL"
+        #The directories of the blob directory known to exist
+        self.knownDirs = set()
+        #See getTransferStats
+        self.transferStats = dict.fromkeys(transfer.strategies, 0)
+        self._createSchema()
+        super( SQLiteJobStore, self ).__init__( config=config )
+        #In WAL mode transactions are atomic and consistent without flushing
+        #the log on every commit, only the last ones may be lost by a crash
+        #of the host. Durable commits are flushed.
+        if self.config.attrib.get("durability", "none") != "none":
+            self.synchronous = "FULL"
+            self._getConnection().execute("PRAGMA synchronous=FULL")
+
+    def deleteJobStore(self):
+        with self.connectionsLock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+        self.local = threading.local()
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            try:
+                os.remove(self.dbPath + suffix)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        shutil.rmtree(self.filesDir, ignore_errors=True)
+
+    ##########################################
+    #The following methods deal with creating/loading/updating/writing/checking for the
+    #existence of jobs
+    ##########################################
+
+    def create(self, command, memory, cpu, disk, updateID=None,
+               predecessorNumber=0):
+        #The key of the row is chosen at random rather than by the database,
+        #so that the row can be inserted at the end of a batch
+        rowID = random.getrandbits(62) + 1
+        batchjob = BatchJob(command=command, memory=memory, cpu=cpu, disk=disk,
+                  jobStoreID="batchjob%i" % rowID,
+                  remainingRetryCount=self._defaultTryCount( ),
+                  updateID=updateID,
+                  predecessorNumber=predecessorNumber)
+        record = buffer(batchjob.toBytes())
+        self._write(lambda connection:
+                    connection.execute("INSERT INTO jobs (id, record) VALUES (?, ?)",
+                                       (rowID, record)))
+        return batchjob
+
+    def exists(self, jobStoreID):
+        return self._query("SELECT 1 FROM jobs WHERE id = ?",
+                           self._getRowID(jobStoreID)) is not None
+
+    def getPublicUrl( self,  jobStoreFileID):
+        self._checkFile(jobStoreFileID)
+        return 'file:' + self._getBlobPath(jobStoreFileID)
+
+    def getSharedPublicUrl( self,  FileName):
+        blobID = self._query("SELECT file FROM sharedFiles WHERE name = ?", FileName)
+        if blobID is None:
+            raise NoSuchFileException(FileName)
+        return 'file:' + self._getBlobPath(blobID)
+
+    def load(self, jobStoreID):
+        record = self._query("SELECT record FROM jobs WHERE id = ?", self._getRowID(jobStoreID))
+        if record is None:
+            raise NoSuchJobException(jobStoreID)
+        return BatchJob.fromBytes(str(record))
+
+    def update(self, batchjob):
+        jobStoreID = batchjob.jobStoreID
+        record = buffer(batchjob.toBytes())
+        def change(connection):
+            if connection.execute("UPDATE jobs SET record = ? WHERE id = ?",
+                                  (record, self._getRowID(jobStoreID))).rowcount == 0:
+                raise NoSuchJobException(jobStoreID)
+        self._write(change)
+
+    def delete(self, jobStoreID):
+        #Deleting the batchjob deletes its files
+        rowID = self._getRowID(jobStoreID)
+        def change(connection):
+            blobIDs = [ row[0] for row in
+                        connection.execute("SELECT id FROM files WHERE job = ?", (rowID,)) ]
+            connection.execute("DELETE FROM files WHERE job = ?", (rowID,))
+            connection.execute("DELETE FROM jobs WHERE id = ?", (rowID,))
+            for blobID in blobIDs:
+                self._removeBlob(blobID)
+        self._write(change)
+
+    def jobs(self):
+        #The batchjobs are read a page at a time in the order of the primary
+        #key, so that the caller may update them while iterating
+        lastRowID = 0
+        while True:
+            rows = self._getConnection().execute(
+                "SELECT id, record FROM jobs WHERE id > ? ORDER BY id LIMIT ?",
+                (lastRowID, self.pageSize)).fetchall()
+            if len(rows) == 0:
+                return
+            for rowID, record in rows:
+                yield BatchJob.fromBytes(str(record))
+            lastRowID = rows[-1][0]
+
+    @contextmanager
+    def batch(self):
+        #The changes to the database are collected and made in one transaction
+        #at the end, so that the write lock isn't held while the contents of
+        #files are written. The blobs created by a batch that fails are removed.
+        self._getConnection()
+        if self.local.changes is not None:
+            yield
+            return
+        self.local.changes = []
+        try:
+            yield
+            changes = self.local.changes
+            self.local.changes = None
+            with self._transaction() as connection:
+                for change in changes:
+                    change(connection)
+        except:
+            for blobID in self.local.createdBlobIDs:
+                self._deleteBlobFile(blobID)
+            raise
+        finally:
+            self.local.changes = None
+            self.local.createdBlobIDs = []
+
+    ##########################################
+    #Functions that deal with temporary files associated with jobs
+    ##########################################
+
+    def writeFile(self, jobStoreID, localFilePath, immutable=False):
+        blobID = self._newBlobID()
+        absPath = self._getBlobPath(blobID, create=True)
+        self._copyFile(localFilePath, absPath, allowLink=immutable)
+        self._addFile(jobStoreID, blobID)
+        return blobID
+
+    def updateFile(self, jobStoreFileID, localFilePath, immutable=False):
+        self._checkFile(jobStoreFileID)
+        self._copyFile(localFilePath, self._getBlobPath(jobStoreFileID), immutable)
+
+    def readFile(self, jobStoreFileID, localFilePath, byteRange=None):
+        if byteRange is None:
+            absPath = self._getBlobPath(jobStoreFileID)
+            try:
+                self._copyFile(absPath, localFilePath)
+            except EnvironmentError as e:
+                if e.filename == absPath and e.errno == errno.ENOENT:
+                    raise NoSuchFileException(jobStoreFileID)
+                raise
+        else:
+            with self.readFileStream(jobStoreFileID, *byteRange) as f:
+                with open(localFilePath, 'w') as localFile:
+                    shutil.copyfileobj(f, localFile)
+
+    def getLocalFilePath(self, jobStoreFileID):
+        self._checkFile(jobStoreFileID)
+        return self._getBlobPath(jobStoreFileID)
+
+    def deleteFile(self, jobStoreFileID):
+        def change(connection):
+            if connection.execute("DELETE FROM files WHERE id = ?",
+                                  (jobStoreFileID,)).rowcount > 0:
+                self._removeBlob(jobStoreFileID)
+        self._write(change)
+
+    def fileExists(self, jobStoreFileID):
+        return self._query("SELECT 1 FROM files WHERE id = ?", jobStoreFileID) is not None
+
+    @contextmanager
+    def writeFileStream(self, jobStoreID):
+        jobStoreFileID = self.getEmptyFileStoreID(jobStoreID)
+        with open(self._getBlobPath(jobStoreFileID), 'w') as f:
+            yield f, jobStoreFileID
+
+    @contextmanager
+    def updateFileStream(self, jobStoreFileID):
+        self._checkFile(jobStoreFileID)
+        absPath = self._getBlobPath(jobStoreFileID)
+        try:
+            if os.stat(absPath).st_nlink > 1:
+                #The file is a link to the file it was written from, see
+                #writeFile, which mustn't change
+                os.remove(absPath)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        with open(absPath, 'w') as f:
+            yield f
+
+    def getEmptyFileStoreID(self, jobStoreID):
+        blobID = self._newBlobID()
+        with open(self._getBlobPath(blobID, create=True), 'w'):
+            pass
+        self._addFile(jobStoreID, blobID)
+        return blobID
+
+    @contextmanager
+    def readFileStream(self, jobStoreFileID, offset=0, length=None):
+        try:
+            f = open(self._getBlobPath(jobStoreFileID), 'r')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise NoSuchFileException(jobStoreFileID)
+            raise
+        with f:
+            if offset == 0 and length is None:
+                yield f
+            else:
+                yield RangeReader(f, offset, length)
+
+    def waitForFileDeletion(self, jobStoreFileIDs, timeout=None):
+        #Which of the files exist is checked by one query
+        return self._waitForFileDeletion(jobStoreFileIDs, timeout, self._getExistingFiles,
+                                         time.sleep)
+
+    ##########################################
+    #The following methods deal with shared files, i.e. files not associated
+    #with specific jobs.
+    ##########################################
+
+    @contextmanager
+    def writeSharedFileStream(self, sharedFileName):
+        assert self._validateSharedFileName( sharedFileName )
+        #The file is written to a new blob, and the name pointed to it once it
+        #is complete, so readers see the previous version until then
+        blobID = self._newBlobID()
+        try:
+            with open(self._getBlobPath(blobID, create=True), 'w') as f:
+                yield f
+        except:
+            self._deleteBlobFile(blobID)
+            raise
+        def change(connection):
+            row = connection.execute("SELECT file FROM sharedFiles WHERE name = ?",
+                                     (sharedFileName,)).fetchone()
+            connection.execute("INSERT OR REPLACE INTO sharedFiles (name, file) VALUES (?, ?)",
+                               (sharedFileName, blobID))
+            if row is not None:
+                self._removeBlob(row[0])
+        self._write(change)
+
+    @contextmanager
+    def readSharedFileStream(self, sharedFileName):
+        assert self._validateSharedFileName( sharedFileName )
+        while True:
+            blobID = self._query("SELECT file FROM sharedFiles WHERE name = ?", sharedFileName)
+            if blobID is None:
+                raise NoSuchFileException(sharedFileName)
+            try:
+                f = open(self._getBlobPath(blobID), 'r')
+                break
+            except IOError as e:
+                #The file was replaced since its blob was looked up
+                if e.errno != errno.ENOENT:
+                    raise
+        with f:
+            yield f
+
+    def deleteSharedFile(self, sharedFileName):
+        assert self._validateSharedFileName( sharedFileName )
+        def change(connection):
+            row = connection.execute("SELECT file FROM sharedFiles WHERE name = ?",
+                                     (sharedFileName,)).fetchone()
+            if row is not None:
+                connection.execute("DELETE FROM sharedFiles WHERE name = ?", (sharedFileName,))
+                self._removeBlob(row[0])
+        self._write(change)
+
+    def writeStatsAndLogging(self, statsAndLoggingString):
+        self._getConnection().execute("INSERT INTO stats (data) VALUES (?)",
+                                      (buffer(statsAndLoggingString),))
+
+    def readStatsAndLogging( self, statsAndLoggingCallBackFn):
+        #Writes are serialised by the database, so the strings are committed
+        #in the order of their keys and those read can be deleted by range
+        numberOfFilesRead = 0
+        while True:
+            rows = self._getConnection().execute(
+                "SELECT id, data FROM stats ORDER BY id LIMIT ?", (self.pageSize,)).fetchall()
+            if len(rows) == 0:
+                return numberOfFilesRead
+            for rowID, data in rows:
+                statsAndLoggingCallBackFn(StringIO(str(data)))
+            self._getConnection().execute("DELETE FROM stats WHERE id <= ?", (rows[-1][0],))
+            numberOfFilesRead += len(rows)
+
+    def getTransferStats(self):
+        return dict((strategy, count) for strategy, count in self.transferStats.iteritems() if count > 0)
+
+    ##########################################
+    #Private methods
+    ##########################################
+
+    def _getConnection(self):
+        """
+        Returns the connection of the calling thread, as connections can't be
+        shared by threads.
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            #Transactions are begun and ended explicitly, see _transaction.
+            #Connections are only closed by other threads.
+            connection = sqlite3.connect(self.dbPath, timeout=self.busyTimeout,
+                                         isolation_level=None, check_same_thread=False)
+            connection.text_factory = str
+            connection.execute("PRAGMA synchronous=%s" % self.synchronous)
+            self.local.connection = connection
+            #The nesting of the transactions of the thread, and the blobs of
+            #the files deleted by the current transaction
+            self.local.depth = 0
+            self.local.removedBlobIDs = []
+            #The changes of the current batch and the blobs it created, see
+            #batch
+            self.local.changes = None
+            self.local.createdBlobIDs = []
+            with self.connectionsLock:
+                self.connections.append(connection)
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Context manager yielding the connection of the calling thread in a
+        transaction. Nested transactions are part of the outermost one, the
+        blobs of files deleted are removed once it is committed.
+        """
+        connection = self._getConnection()
+        if self.local.depth > 0:
+            self.local.depth += 1
+            try:
+                yield connection
+            finally:
+                self.local.depth -= 1
+            return
+        #The write lock is taken at once, so that committing never has to
+        #wait for other writers
+        connection.execute("BEGIN IMMEDIATE")
+        self.local.depth = 1
+        try:
+            yield connection
+        except:
+            self.local.depth = 0
+            self.local.removedBlobIDs = []
+            connection.execute("ROLLBACK")
+            raise
+        self.local.depth = 0
+        connection.execute("COMMIT")
+        blobIDs, self.local.removedBlobIDs = self.local.removedBlobIDs, []
+        for blobID in blobIDs:
+            self._deleteBlobFile(blobID)
+
+    def _write(self, change):
+        """
+        Calls change with the connection of the calling thread in a 
+        transaction, or once the current batch ends, see batch.
+        """
+        self._getConnection()
+        if self.local.changes is not None:
+            self.local.changes.append(change)
+        else:
+            with self._transaction() as connection:
+                change(connection)
+
+    def _query(self, sql, *args):
+        """
+        Returns the first column of the first row of the given query, or None.
+        """
+        row = self._getConnection().execute(sql, args).fetchone()
+        return None if row is None else row[0]
+
+    def _createSchema(self):
+        connection = self._getConnection()
+        if connection.execute("PRAGMA user_version").fetchone()[0] != 0:
+            return
+        #The journal mode is kept by the database, it can't be changed in a
+        #transaction
+        journalMode = connection.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        if journalMode.lower() != "wal":
+            logger.warn("The database %s does not support WAL mode, using %s mode",
+                        self.dbPath, journalMode)
+        with self._transaction():
+            if connection.execute("PRAGMA user_version").fetchone()[0] != 0:
+                #Created by another process in the meantime
+                return
+            connection.execute("CREATE TABLE jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                               "record BLOB NOT NULL)")
+            connection.execute("CREATE TABLE files (id TEXT PRIMARY KEY, job INTEGER NOT NULL)")
+            connection.execute("CREATE INDEX filesByJob ON files (job)")
+            connection.execute("CREATE TABLE sharedFiles (name TEXT PRIMARY KEY, "
+                               "file TEXT NOT NULL)")
+            connection.execute("CREATE TABLE stats (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                               "data BLOB NOT NULL)")
+            connection.execute("PRAGMA user_version = 1")
+
+    @staticmethod
+    def _getRowID(jobStoreID):
+        """
+        Returns the key of the row of the batchjob with the given jobStoreID,
+        or None if it isn't one of this store.
+        """
+        if jobStoreID.startswith("batchjob") and jobStoreID[8:].isdigit():
+            return int(jobStoreID[8:])
+        return None
+
+    def _addFile(self, jobStoreID, blobID):
+        """
+        Adds the file of the given blob to the files of the given batchjob,
+        removing the blob if the batchjob doesn't exist.
+        """
+        def change(connection):
+            cursor = connection.execute("INSERT INTO files (id, job) "
+                                        "SELECT ?, id FROM jobs WHERE id = ?",
+                                        (blobID, self._getRowID(jobStoreID)))
+            if cursor.rowcount == 0:
+                self._deleteBlobFile(blobID)
+                raise NoSuchJobException(jobStoreID)
+        self._write(change)
+
+    def _newBlobID(self):
+        """
+        Returns the ID of a new blob, which is removed if the current batch
+        fails.
+        """
+        blobID = uuid.uuid4().hex
+        self._getConnection()
+        if self.local.changes is not None:
+            self.local.createdBlobIDs.append(blobID)
+        return blobID
+
+    def _removeBlob(self, blobID):
+        """
+        Removes the given blob once the current transaction is committed.
+        """
+        self.local.removedBlobIDs.append(blobID)
+
+    def _deleteBlobFile(self, blobID):
+        try:
+            os.remove(self._getBlobPath(blobID))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _checkFile(self, jobStoreFileID):
+        """
+        Raises NoSuchFileException if the jobStoreFileID does not exist.
+        """
+        if not self.fileExists(jobStoreFileID):
+            raise NoSuchFileException("File %s does not exist in jobStore" % jobStoreFileID)
+
+    def _getExistingFiles(self, jobStoreFileIDs):
+        existing = set()
+        #The number of parameters of a statement is limited
+        for i in xrange(0, len(jobStoreFileIDs), 500):
+            chunk = jobStoreFileIDs[i:i + 500]
+            existing.update(row[0] for row in self._getConnection().execute(
+                "SELECT id FROM files WHERE id IN (%s)" % ", ".join("?" * len(chunk)), chunk))
+        return [ i for i in jobStoreFileIDs if i in existing ]
+
+    def _getBlobPath(self, blobID, create=False):
+        """
+        Returns the path of the blob with the given ID, in a directory named by
+        the first two characters of the ID, which is created if create is True.
+        """
+        blobDir = os.path.join(self.filesDir, blobID[:2])
+        if create and blobDir not in self.knownDirs:
+            try:
+                os.makedirs(blobDir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            self.knownDirs.add(blobDir)
+        return os.path.join(blobDir, blobID)
+
+    def _copyFile(self, srcPath, dstPath, allowLink=False):
+        """
+        Copies a file between the store and a local path, in the cheapest way
+        the file systems support, see toil.lib.transfer.
+        """
+        strategy = transfer.copyFile(srcPath, dstPath, allowLink)
+        logger.debug("Copied %s to %s using %s", srcPath, dstPath, strategy)
+        self.transferStats[strategy] += 1
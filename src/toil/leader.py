@@ -28,10 +28,16 @@ import sys
 import os.path
 import time
 import xml.etree.cElementTree as ET
+from Queue import Empty, Queue as ThreadQueue
+from threading import Thread
 
 from toil import Process, Queue
 from toil.lib.bioio import getTotalCpuTime, logStream
 from toil.common import toilPackageDirPath
+from toil.batchJob import killedExitStatuses
+from toil.resourcePredictor import ResourcePredictor
+from toil.broadcast import removeBroadcastDir, markWorkflowFinished, markWorkflowRunning
+from toil.accumulator import AccumulatorMerger, UsedCheck as AccumulatorsUsedCheck
 
 logger = logging.getLogger( __name__ )
 
@@ -39,14 +45,25 @@ logger = logging.getLogger( __name__ )
 ##Stats/logging aggregation
 ####################################################
 
-def statsAndLoggingAggregatorProcess(jobStore, stop):
+def statsAndLoggingAggregatorProcess(jobStore, stop, flush, flushed):
     """
     The following function is used for collating stats/reporting log messages from the workers.
     Works inside of a separate process, collates as long as the stop flag is not True.
+    
+    Also merges the additions to accumulators sent by the workers. When a message is put in 
+    the flush queue, the records written so far are collated and the values of the 
+    accumulators written before a message is put in the flushed queue, see 
+    flushStatsAndLogging.
     """
     #Overall timing
     startTime = time.time()
     startClock = getTotalCpuTime()
+    #Learns the resource requirements of jobs from their stats, if requested
+    if jobStore.config.attrib.has_key("predict_resources"):
+        resourcePredictor = ResourcePredictor()
+    else:
+        resourcePredictor = None
+    accumulatorMerger = AccumulatorMerger(jobStore)
 
     #Start off the stats file
     with jobStore.writeSharedFileStream("statsAndLogging.xml") as fileHandle:
@@ -58,26 +75,78 @@ def statsAndLoggingAggregatorProcess(jobStore, stop):
             for message in node.find("messages").findall("message"):
                 logger.warn("Got message from batchjob at time: %s : %s",
                                     time.strftime("%m-%d-%Y %H:%M:%S"), message.text)
+            if resourcePredictor is not None:
+                resourcePredictor.addStats(node)
+            accumulatorMerger.addStats(node)
             ET.ElementTree(node).write(fileHandle)
         
+        #Wakes the main loop when stats/logging strings are written, if the
+        #jobStore can tell, by putting False in the flush queue
+        def watchStatsAndLogging():
+            while stop.empty():
+                if jobStore.waitForStatsAndLogging(1):
+                    flush.put(False)
+        watcher = Thread(target=watchStatsAndLogging)
+        watcher.daemon = True
+        watcher.start()
+        
         #The main loop
         timeSinceOutFileLastFlushed = time.time()
+        timeSincePredictionsLastWritten = time.time()
+        flushRequested = False
         while True:
             if not stop.empty(): #This is a indirect way of getting a message to
                 #the process to exit
                 jobStore.readStatsAndLogging(statsAndLoggingCallBackFn)
                 break
-            if jobStore.readStatsAndLogging(statsAndLoggingCallBackFn) == 0:
-                time.sleep(0.5) #Avoid cycling too fast
+            filesProcessed = jobStore.readStatsAndLogging(statsAndLoggingCallBackFn)
+            if flushRequested:
+                accumulatorMerger.writeValues(jobStore)
+                flushed.put(True)
+                flushRequested = False
+            try:
+                #Wait for a flush request or for strings to be written, rather
+                #than sleeping, to avoid cycling too fast
+                flushRequested = flush.get(timeout=0.5 if filesProcessed == 0 else 0.01) or flushRequested
+            except Empty:
+                pass
             if time.time() - timeSinceOutFileLastFlushed > 60: #Flush the
                 #results file every minute
                 fileHandle.flush()
                 timeSinceOutFileLastFlushed = time.time()
+            if resourcePredictor is not None and \
+                    time.time() - timeSincePredictionsLastWritten > ResourcePredictor.writeInterval:
+                #Update the predictions read by the workers every ten seconds
+                resourcePredictor.writePredictions(jobStore)
+                timeSincePredictionsLastWritten = time.time()
+        if resourcePredictor is not None:
+            resourcePredictor.writePredictions(jobStore)
+        accumulatorMerger.writeValues(jobStore)
 
         #Finish the stats file
         fileHandle.write("<total_time time='%s' clock='%s'/></stats>" % \
                          (str(time.time() - startTime), str(getTotalCpuTime() - startClock)))
 
+def flushStatsAndLogging(flush, flushed, timeout=60):
+    """
+    Waits for the stats/logging aggregator process to collate the records written so far, 
+    so that the values of accumulators it writes include the additions of the jobs that 
+    have finished.
+    """
+    #Drop the answer to an earlier request that timed out, which would
+    #otherwise be taken for the answer to this one
+    while True:
+        try:
+            flushed.get_nowait()
+        except Empty:
+            break
+    flush.put(True)
+    try:
+        flushed.get(timeout=timeout)
+    except Empty:
+        logger.warn("The stats/logging aggregator did not collate the records written "
+                    "within %s seconds", timeout)
+
 ####################################################
 ##Following encapsulates interactions with the batch system class.
 ####################################################
@@ -96,6 +165,19 @@ class JobBatcher:
         self.jobsIssued = 0
         self.workerPath = os.path.join(toilPackageDirPath(), "worker.py")
         self.reissueMissingJobs_missingHash = {} #Hash to store number of observed misses
+        #Gangs waiting for the batch system to have capacity for all their
+        #members, see issueGang
+        self.gangsAwaitingResources = []
+        #Jobs running the clients of services, held back until the services
+        #have started, as lists of (job, startFileStoreIDs, time of the next
+        #check of the start files, interval between the checks)
+        self.jobsAwaitingServices = []
+        #Map of the jobStoreIDs of the clients jobs of issued gangs to the
+        #resources set aside for the clients while their services start
+        self.reservedResources = {}
+        #The batch system IDs of the jobs killed by killJobs that are still 
+        #issued, i.e. whose processes may still be running
+        self.jobsBeingKilled = set()
 
     def issueJob(self, jobStoreID, memory, cpu, disk):
         """
@@ -117,6 +199,107 @@ class JobBatcher:
         for jobStoreID, memory, cpu, disk in jobs:
             self.issueJob(jobStoreID, memory, cpu, disk)
 
+    def issueGang(self, jobs, clientsJobStoreID, startFileStoreIDs):
+        """
+        Issues a gang, i.e. a list of jobs, each represented as a tuple of
+        (jobStoreID, memory, cpu, disk), that consists of services and the job,
+        identified by clientsJobStoreID, that runs their clients. The services
+        may also be the producers of pipes, and the clients their consumer,
+        see Job.addPipe.
+
+        The services are only issued once the batch system reports enough
+        free resources for the services and the clients together, so that
+        started services never wait on clients that can't be scheduled. The
+        clients are then held back in the leader, not occupying a slot, until
+        the services have deleted the files given by startFileStoreIDs.
+        """
+        services = [ job for job in jobs if job[0] != clientsJobStoreID ]
+        clientsJob, = [ job for job in jobs if job[0] == clientsJobStoreID ]
+        #The resources of the gang are those of the services plus those of
+        #the clients, which are the successors of the clients job
+        clientsJobResources = self._sumResources([clientsJob])
+        clientsBatchjob = self.jobStore.load(clientsJobStoreID)
+        if len(clientsBatchjob.stack) > 0:
+            clientsResources = self._sumResources(clientsBatchjob.stack[-1])
+            clientsResources = tuple(map(max, clientsResources, clientsJobResources))
+        else:
+            clientsResources = clientsJobResources
+        logger.debug("Gang of %i services with clients job %s needs memory: %i, cpu: %i, "
+                     "disk: %i for its clients", len(services), clientsJobStoreID,
+                     *clientsResources)
+        self.gangsAwaitingResources.append((services, clientsJob, startFileStoreIDs,
+                                            clientsResources))
+        self.issueWaitingGangs()
+
+    def issueWaitingGangs(self):
+        """
+        Issues the services of gangs for which there are now sufficient
+        resources and the clients jobs whose services have started.
+        """
+        for gang in list(self.gangsAwaitingResources):
+            services, clientsJob, startFileStoreIDs, clientsResources = gang
+            required = tuple(map(sum, zip(self._sumResources(services), clientsResources)))
+            if not self._hasResources(required):
+                continue
+            self.gangsAwaitingResources.remove(gang)
+            self.reservedResources[clientsJob[0]] = clientsResources
+            self.issueJobs(services)
+            interval = self.jobStore.minDeletionPollInterval
+            self.jobsAwaitingServices.append([clientsJob, startFileStoreIDs,
+                                              time.time() + interval, interval])
+        #The start files of a gang are checked by one query, with the interval
+        #between the checks doubling while the services are starting
+        now = time.time()
+        for awaiting in list(self.jobsAwaitingServices):
+            clientsJob, startFileStoreIDs, nextCheck, interval = awaiting
+            if now < nextCheck:
+                continue
+            if self.jobStore.waitForFileDeletion(startFileStoreIDs, timeout=0):
+                logger.debug("Services of batchjob %s have started, issuing it", clientsJob[0])
+                self.jobsAwaitingServices.remove(awaiting)
+                self.issueJob(*clientsJob)
+            else:
+                interval = min(interval * 2, self.jobStore.maxDeletionPollInterval)
+                awaiting[2:] = [now + interval, interval]
+
+    def hasWaitingGangs(self):
+        """
+        Returns true if there are gangs waiting for resources or services
+        to start.
+        """
+        return len(self.gangsAwaitingResources) + len(self.jobsAwaitingServices) > 0
+
+    def _hasResources(self, required):
+        """
+        Returns true if the batch system can run jobs needing the given
+        (memory, cpu, disk), on top of the resources reserved for the clients
+        of issued gangs.
+        """
+        available = self.batchSystem.getAvailableResources()
+        if available is None:
+            return True
+        #Available is (cpu, memory, disk), reorder it to match the jobs
+        cpu, memory, disk = available
+        available = (memory, cpu, disk)
+        reserved = map(sum, zip((0, 0, 0), *self.reservedResources.values()))
+        if all(r + s <= a for r, s, a in zip(required, reserved, available)):
+            return True
+        if self.getNumberOfJobsIssued() == 0:
+            #Nothing is running that could free up resources, so waiting
+            #would deadlock
+            logger.warn("The batch system reports insufficient resources for a gang of "
+                        "services and their clients, issuing it anyway")
+            return True
+        return False
+
+    @staticmethod
+    def _sumResources(jobs):
+        """
+        Sums the (memory, cpu, disk) of the given jobs, which are tuples
+        starting with jobStoreID, memory, cpu and disk.
+        """
+        return tuple(map(sum, zip((0, 0, 0), *[ job[1:4] for job in jobs ])))
+
     def getNumberOfJobsIssued(self):
         """
         Gets number of jobs that have been added by issueJob(s) and not
@@ -154,12 +337,19 @@ class JobBatcher:
     
     def killJobs(self, jobsToKill):
         """
-        Kills the given set of jobs and then sends them for processing
+        Kills the given set of jobs and then sends them for processing as failed.
+        A batchjob the batch system still has issued may still be running, e.g. 
+        checkpointing in its kill grace period, so it is only processed once the 
+        batch system returns it as updated, see processFinishedJob.
         """
         if len(jobsToKill) > 0:
             self.batchSystem.killBatchJobs(jobsToKill)
+            issuedJobs = set(self.batchSystem.getIssuedBatchJobIDs())
             for jobBatchSystemID in jobsToKill:
-                self.processFinishedJob(jobBatchSystemID, 1)
+                if jobBatchSystemID in issuedJobs:
+                    self.jobsBeingKilled.add(jobBatchSystemID)
+                else:
+                    self.processFinishedJob(jobBatchSystemID, 1)
     
     #Following functions handle error cases for when jobs have gone awry with the batch system.
 
@@ -167,7 +357,8 @@ class JobBatcher:
         """
         Check each issued batchjob - if it is running for longer than desirable
         issue a kill instruction.
-        Wait for the batchjob to die then we pass the batchjob to processFinishedJob.
+        The batchjob is passed to processFinishedJob once the batch system reports
+        that it has died, see killJobs.
         """
         maxJobDuration = float(self.config.attrib["max_job_duration"])
         idealJobTime = float(self.config.attrib["job_time"])
@@ -181,7 +372,8 @@ class JobBatcher:
             # time is more than 16 weeks.
             runningJobs = self.batchSystem.getRunningBatchJobIDs()
             for jobBatchSystemID in runningJobs.keys():
-                if runningJobs[jobBatchSystemID] > maxJobDuration:
+                if (runningJobs[jobBatchSystemID] > maxJobDuration 
+                    and jobBatchSystemID not in self.jobsBeingKilled):
                     logger.warn("The batchjob: %s has been running for: %s seconds, more than the "
                                 "max batchjob duration: %s, we'll kill it",
                                 str(self.getJob(jobBatchSystemID)),
@@ -228,7 +420,14 @@ class JobBatcher:
         """
         Function reads a processed batchjob file and updates it state.
         """    
+        if jobBatchSystemID in self.jobsBeingKilled:
+            #A killed batchjob failed, whatever its exit value
+            self.jobsBeingKilled.remove(jobBatchSystemID)
+            resultStatus = resultStatus or 1
         jobStoreID = self.removeJobID(jobBatchSystemID)
+        #The clients of the gang will be issued directly, so their reservation
+        #is no longer needed
+        self.reservedResources.pop(jobStoreID, None)
         if self.jobStore.exists(jobStoreID):
             batchjob = self.jobStore.load(jobStoreID)
             if batchjob.logJobStoreFileID is not None:
@@ -239,7 +438,11 @@ class JobBatcher:
             if resultStatus != 0:
                 if batchjob.logJobStoreFileID is None:
                     logger.warn("No log file is present, despite batchjob failing: %s", jobStoreID)
-                batchjob.setupJobAfterFailure(self.config)
+                #A worker killed without leaving a log was most likely killed
+                #for running out of memory
+                batchjob.setupJobAfterFailure(self.config, outOfMemory=
+                                              batchjob.logJobStoreFileID is None and
+                                              resultStatus in killedExitStatuses)
             self.toilState.updatedJobs.add(batchjob) #Now we know the
             #batchjob is done we can add it to the list of updated batchjob files
             logger.debug("Added batchjob: %s to active jobs", jobStoreID)
@@ -326,6 +529,10 @@ def mainLoop(config, batchSystem, jobStore, rootJob):
 
     toilState = ToilState(jobStore, rootJob)
 
+    #A restarted workflow is no longer finished, so its broadcast files are
+    #kept by the workers of other workflows
+    markWorkflowRunning(config, jobStore)
+
     ##########################################
     #Load the jobBatcher class - used to track jobs submitted to the batch-system
     ##########################################
@@ -342,9 +549,19 @@ def mainLoop(config, batchSystem, jobStore, rootJob):
     #Start the stats/logging aggregation process
     ##########################################
 
-    stopStatsAndLoggingAggregatorProcess = Queue() #When this is s
-    worker = Process(target=statsAndLoggingAggregatorProcess,
-                     args=(jobStore, stopStatsAndLoggingAggregatorProcess))
+    if jobStore.isProcessLocal():
+        #The jobStore can't be read by another process, so the aggregator
+        #runs in a thread
+        AggregatorProcess, AggregatorQueue = Thread, ThreadQueue
+    else:
+        AggregatorProcess, AggregatorQueue = Process, Queue
+    stopStatsAndLoggingAggregatorProcess = AggregatorQueue() #When this is s
+    #Used to have the aggregator collate the records written, see flushStatsAndLogging
+    flushStatsAndLoggingQueue = AggregatorQueue()
+    flushedStatsAndLoggingQueue = AggregatorQueue()
+    worker = AggregatorProcess(target=statsAndLoggingAggregatorProcess,
+                     args=(jobStore, stopStatsAndLoggingAggregatorProcess,
+                           flushStatsAndLoggingQueue, flushedStatsAndLoggingQueue))
     worker.start() 
     try:
 
@@ -356,6 +573,8 @@ def mainLoop(config, batchSystem, jobStore, rootJob):
         timeSinceJobsLastRescued = time.time()
         #Number of jobs that can not be completed successful after exhausting retries
         totalFailedJobs = 0
+        #Whether the workers send additions to accumulators, see accumulator.markUsed
+        accumulatorsUsed = AccumulatorsUsedCheck(jobStore)
         logger.info("Starting the main loop")
         while True:
 
@@ -367,6 +586,14 @@ def mainLoop(config, batchSystem, jobStore, rootJob):
                 logger.debug("Built the jobs list, currently have %i jobs to update and %i jobs issued",
                              len(toilState.updatedJobs), jobBatcher.getNumberOfJobsIssued())
 
+                #Successors must see the additions to accumulators of the jobs that
+                #have finished, so the aggregator collates the records written so far,
+                #if there are any
+                if any(batchjob.command == None and len(batchjob.stack) > 0
+                       for batchjob in toilState.updatedJobs) and \
+                       accumulatorsUsed():
+                    flushStatsAndLogging(flushStatsAndLoggingQueue, flushedStatsAndLoggingQueue)
+
                 for batchjob in toilState.updatedJobs:
                     #If the batchjob has a command it must be run before any successors
                     if batchjob.command != None:
@@ -387,6 +614,9 @@ def mainLoop(config, batchSystem, jobStore, rootJob):
                         toilState.successorCounts[batchjob] = len(batchjob.stack[-1])
                         #List of successors to schedule
                         successors = []
+                        #Gangs of services, or of the producers of pipes, and their
+                        #clients in the batchjob
+                        gangs = dict((gang[0], gang[1:]) for gang in batchjob.gangs)
                         #For each successor schedule if all predecessors have been
                         #completed
                         for successorJobStoreID, memory, cpu, disk, predecessorID in batchjob.stack.pop():
@@ -409,6 +639,17 @@ def mainLoop(config, batchSystem, jobStore, rootJob):
                                 if len(job2.predecessorsFinished) < job2.predecessorNumber:
                                     continue
                             successors.append((successorJobStoreID, memory, cpu, disk))
+                        #Issue the gangs whose clients are ready, then the other successors
+                        successorJobStoreIDs = set(successor[0] for successor in successors)
+                        for clientsJobStoreID, (startFileStoreIDs, members) in gangs.iteritems():
+                            if clientsJobStoreID not in successorJobStoreIDs:
+                                continue
+                            members = set(members)
+                            members.add(clientsJobStoreID)
+                            gang = filter(lambda successor : successor[0] in members, successors)
+                            successors = filter(lambda successor : successor[0] not in members,
+                                                successors)
+                            jobBatcher.issueGang(gang, clientsJobStoreID, startFileStoreIDs)
                         jobBatcher.issueJobs(successors)
 
                     #There are no remaining tasks to schedule within the batchjob, but
@@ -431,11 +672,21 @@ def mainLoop(config, batchSystem, jobStore, rootJob):
 
                 toilState.updatedJobs = set() #We've considered them all, so reset
 
+            ##########################################
+            #Issue the members of gangs that are ready to run
+            ##########################################
+
+            if jobBatcher.hasWaitingGangs():
+                jobBatcher.issueWaitingGangs()
+
             ##########################################
             #The exit criterion
             ##########################################
 
             if jobBatcher.getNumberOfJobsIssued() == 0:
+                if len(jobBatcher.jobsAwaitingServices) > 0:
+                    logger.warn("The services of %i batchjobs failed to start",
+                                len(jobBatcher.jobsAwaitingServices))
                 logger.info("Only failed jobs and their dependents (%i total) are remaining, so exiting.", totalFailedJobs)
                 break
 
@@ -445,7 +696,8 @@ def mainLoop(config, batchSystem, jobStore, rootJob):
 
             #Asks the batch system what jobs have been completed,
             #give
-            updatedJob = batchSystem.getUpdatedBatchJob(10)
+            #If services are starting check on them more frequently
+            updatedJob = batchSystem.getUpdatedBatchJob(1 if jobBatcher.hasWaitingGangs() else 10)
             if updatedJob != None:
                 jobBatchSystemID, result = updatedJob
                 if jobBatcher.hasJob(jobBatchSystemID):
@@ -499,4 +751,11 @@ def mainLoop(config, batchSystem, jobStore, rootJob):
         worker.join()
         logger.info("Stats/logging finished collating in %s seconds", time.time() - startTime)
 
+        #Remove the broadcast files on this node, those on other nodes are
+        #removed by the workers of later workflows once the workflow is marked 
+        #as finished. This is done however the leader exits, a restart of the
+        #workflow fetches the files again, see markWorkflowRunning
+        removeBroadcastDir(config)
+        markWorkflowFinished(config, jobStore)
+
     return totalFailedJobs #Returns number of failed jobs
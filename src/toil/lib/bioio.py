@@ -193,9 +193,20 @@ def getTotalCpuTimeAndMemoryUsage():
     me = resource.getrusage(resource.RUSAGE_SELF)
     childs = resource.getrusage(resource.RUSAGE_CHILDREN)
     totalCpuTime = me.ru_utime+me.ru_stime+childs.ru_utime+childs.ru_stime
-    totalMemoryUsage = me.ru_maxrss+ me.ru_maxrss
+    totalMemoryUsage = me.ru_maxrss+ childs.ru_maxrss
     return totalCpuTime, totalMemoryUsage
 
+def getDirSize(dirPath):
+    """Gives the total size in bytes of the files in the given directory, recursively.
+    """
+    totalSize = 0
+    for root, dirs, files in os.walk(dirPath):
+        for name in files:
+            path = os.path.join(root, name)
+            if not os.path.islink(path):
+                totalSize += os.path.getsize(path)
+    return totalSize
+
 def getTotalCpuTime():
     """Gives the total cpu time, including the children.
     """
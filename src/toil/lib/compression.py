@@ -0,0 +1,264 @@
+"""
+Streaming compression of files in the job store using the codecs of the standard library.
+
+A compressed file starts with a header naming the codec it was compressed with, so that
+readers can decompress it transparently, whatever the codec, and pass through files that were
+stored uncompressed. The lzma codec requires the lzma module, which is part of the standard
+library from Python 3.3, or its backport.
+"""
+import bz2
+import os
+import tempfile
+import zlib
+from contextlib import contextmanager
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# Identifies a compressed file. The newline and non-ASCII byte make it very unlikely that an
+# uncompressed file starts with it
+magic = "\x89toilz\r\n"
+
+# The size of the chunks read from the underlying file handles
+chunkSize = 64 * 1024
+
+# Map of codec names to pairs of functions creating a compressor and a decompressor
+_codecs = {
+    "zlib": (lambda: zlib.compressobj(6), zlib.decompressobj),
+    "bz2": (lambda: bz2.BZ2Compressor(9), bz2.BZ2Decompressor) }
+if lzma is not None:
+    _codecs["lzma"] = (lzma.LZMACompressor, lzma.LZMADecompressor)
+
+# The codec names that can be given to select no compression
+codecNames = ("none", "zlib", "bz2", "lzma")
+
+# The maximum size of the header of a compressed file
+maxHeaderSize = len(magic) + max(map(len, codecNames)) + 1
+
+def getCodec(name):
+    """
+    Checks the given codec name is one of codecNames and that the codec is available.
+
+    :rtype : the name of the codec, or None if the name selects no compression
+    """
+    if name is None or name == "none":
+        return None
+    if name not in codecNames:
+        raise ValueError("Unknown compression codec '%s', expected one of %s" %
+                         (name, ", ".join(codecNames)))
+    if name not in _codecs:
+        raise ValueError("The compression codec '%s' is not available, install the lzma "
+                         "module" % name)
+    return name
+
+class CompressingWriter(object):
+    """
+    A writable file-like object compressing the data written to it into the given file
+    handle. The compressed stream is only complete once close has been called, which does not
+    close the underlying file handle.
+    """
+    def __init__(self, fileHandle, codec):
+        self.fileHandle = fileHandle
+        self.compressor = _codecs[getCodec(codec)][0]()
+        self.closed = False
+        self.fileHandle.write(magic + codec + "\n")
+
+    def write(self, data):
+        self.fileHandle.write(self.compressor.compress(data))
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        #The compressor's internal buffer is only written by close, flushing it earlier would
+        #hurt the compression ratio
+        self.fileHandle.flush()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.fileHandle.write(self.compressor.flush())
+
+class DecompressingReader(object):
+    """
+    A readable file-like object decompressing the data read from the given file handle, see
+    openDecompressed.
+    """
+    def __init__(self, fileHandle, codec):
+        self.fileHandle = fileHandle
+        self.decompressor = _codecs[getCodec(codec)][1]()
+        #The data decompressed but not yet read are those of the buffer from the offset on,
+        #reads advance the offset rather than slicing the buffer
+        self.buffer = ""
+        self.offset = 0
+        self.eof = False
+
+    def _fill(self):
+        """
+        Replaces the buffer, which has been read, with the next chunk of the underlying file,
+        decompressed.
+        """
+        data = self.fileHandle.read(chunkSize)
+        if data:
+            self.buffer = self.decompressor.decompress(data)
+        else:
+            self.eof = True
+            #zlib keeps data back until flushed, the other codecs have no flush
+            self.buffer = self.decompressor.flush() if hasattr(self.decompressor, "flush") else ""
+        self.offset = 0
+
+    def _read(self, size, toLineEnd):
+        """
+        Returns up to size bytes, or all the remaining bytes if size is negative, stopping
+        after the first newline if toLineEnd is True.
+        """
+        chunks = []
+        while size != 0:
+            if self.offset == len(self.buffer):
+                if self.eof:
+                    break
+                self._fill()
+                continue
+            end = len(self.buffer)
+            if toLineEnd:
+                end = self.buffer.find("\n", self.offset) + 1 or end
+            if size > 0:
+                end = min(end, self.offset + size)
+                size -= end - self.offset
+            chunks.append(self.buffer[self.offset:end])
+            self.offset = end
+            if toLineEnd and chunks[-1].endswith("\n"):
+                break
+        return "".join(chunks)
+
+    def read(self, size=-1):
+        return self._read(size, False)
+
+    def readline(self, size=-1):
+        return self._read(size, True)
+
+    def readlines(self):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, "")
+
+    def close(self):
+        pass
+
+class _PrefixedReader(DecompressingReader):
+    """
+    Passes through the data of an uncompressed file handle that can't be rewound, starting
+    with the bytes already read from it to check for the header.
+    """
+    def __init__(self, fileHandle, prefix):
+        self.fileHandle = fileHandle
+        self.buffer = prefix
+        self.offset = 0
+        self.eof = False
+
+    def _fill(self):
+        self.buffer = self.fileHandle.read(chunkSize)
+        self.offset = 0
+        if not self.buffer:
+            self.eof = True
+
+def _readHeader(fileHandle):
+    """
+    Reads the header from the given file handle.
+
+    :rtype : a tuple of the codec of the file, or None if the file is not compressed, and the
+    bytes read from the file handle if it is not compressed.
+    """
+    prefix = fileHandle.read(len(magic))
+    if prefix != magic:
+        return None, prefix
+    return fileHandle.readline()[:-1], ""
+
+def getStreamCodec(fileHandle):
+    """
+    Reads the header, if any, from the given file handle, which needs to yield no more than
+    maxHeaderSize bytes.
+
+    :rtype : the codec the file was compressed with, or None if it is not compressed
+    """
+    return _readHeader(fileHandle)[0]
+
+def getFileCodec(filePath):
+    """
+    :rtype : the codec the file at the given path was compressed with, or None if it is not
+    compressed
+    """
+    with open(filePath, 'r') as fileHandle:
+        return getStreamCodec(fileHandle)
+
+def openDecompressed(fileHandle):
+    """
+    Returns a readable file-like object yielding the decompressed data of the given file
+    handle, or the file handle itself, rewound, if the file is not compressed.
+    """
+    codec, prefix = _readHeader(fileHandle)
+    if codec is not None:
+        return DecompressingReader(fileHandle, codec)
+    try:
+        fileHandle.seek(0)
+    except (AttributeError, IOError):
+        return _PrefixedReader(fileHandle, prefix)
+    return fileHandle
+
+@contextmanager
+def compressedWriteStream(fileHandle, codec):
+    """
+    A context manager yielding a writable file-like object that compresses the data written
+    to it into the given file handle with the given codec. If codec is None the file handle
+    itself is yielded.
+    """
+    if codec is None:
+        yield fileHandle
+    else:
+        writer = CompressingWriter(fileHandle, codec)
+        yield writer
+        writer.close()
+
+@contextmanager
+def decompressedReadStream(fileHandle):
+    """
+    A context manager yielding openDecompressed(fileHandle).
+    """
+    yield openDecompressed(fileHandle)
+
+def copyStream(source, target):
+    """
+    Copies the remaining data from one file-like object to another.
+    """
+    while True:
+        data = source.read(chunkSize)
+        if not data:
+            break
+        target.write(data)
+
+def decompressFile(filePath):
+    """
+    Decompresses the file at the given path in place, if it is compressed.
+
+    :rtype : True if the file was compressed, else False
+    """
+    with open(filePath, 'r') as fileHandle:
+        codec, _ = _readHeader(fileHandle)
+        if codec is None:
+            return False
+        fd, tempPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filePath)))
+        try:
+            with os.fdopen(fd, 'w') as tempFileHandle:
+                copyStream(DecompressingReader(fileHandle, codec), tempFileHandle)
+            os.rename(tempPath, filePath)
+        except:
+            os.remove(tempPath)
+            raise
+    return True
@@ -0,0 +1,97 @@
+"""
+A minimal binding to the Linux inotify API, used to wake up processes waiting on changes to the
+file system rather than polling it. The binding uses ctypes so it has no dependencies beyond
+the C library. On systems without inotify isAvailable() returns False.
+
+Note that inotify only reports changes made through the local kernel. Changes made on another
+host to a network file system are not reported, so callers must still poll, albeit
+infrequently.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+
+_libc = None
+
+def _getLibc():
+    """
+    :rtype : the C library if it provides inotify, else None
+    """
+    global _libc
+    if _libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            libc.inotify_init
+            libc.inotify_add_watch
+        except (OSError, AttributeError):
+            _libc = False
+        else:
+            _libc = libc
+    return _libc or None
+
+def isAvailable():
+    """
+    Returns True if inotify can be used on this system, else False.
+    """
+    return _getLibc() is not None
+
+class INotify(object):
+    """
+    An inotify instance, i.e. a set of watched paths and a file descriptor which becomes
+    readable when an event occurs on any of them.
+    """
+    def __init__(self):
+        libc = _getLibc()
+        assert libc is not None
+        self.libc = libc
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            _raiseErrno()
+
+    def addWatch(self, path, mask, ignoreMissing=False):
+        """
+        Watches the given path for the events in mask, a bitwise or of the IN_* constants.
+        Raises OSError with errno ENOENT if the path does not exist, unless ignoreMissing is
+        True.
+        """
+        if self.libc.inotify_add_watch(self.fd, path, mask) < 0:
+            if not (ignoreMissing and ctypes.get_errno() == errno.ENOENT):
+                _raiseErrno(path)
+
+    def wait(self, timeout):
+        """
+        Blocks until an event occurs on a watched path or timeout seconds have passed.
+        Returns True if an event occurred. Pending events are discarded, the caller is expected
+        to inspect the file system for what changed.
+        """
+        readable = select.select([ self.fd ], [], [], timeout)[0]
+        if readable:
+            os.read(self.fd, 65536)
+            return True
+        return False
+
+    def close(self):
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+def _raiseErrno(path=None):
+    e = ctypes.get_errno()
+    if path is None:
+        raise OSError(e, os.strerror(e))
+    raise OSError(e, os.strerror(e), path)
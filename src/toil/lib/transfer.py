@@ -0,0 +1,165 @@
+"""
+Copying files with the cheapest mechanism the file systems involved support, see copyFile. In
+order of preference, a file is hard linked, if the caller allows it, cloned with the FICLONE
+ioctl on file systems supporting reflinks, copied in the kernel with copy_file_range or
+sendfile, or else copied through a buffer. The system calls are made through ctypes so there
+are no dependencies beyond the C library.
+"""
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import shutil
+import uuid
+
+# The ways a file can be copied, cheapest first, as returned by copyFile
+LINK = 'link'
+REFLINK = 'reflink'
+COPY_FILE_RANGE = 'copy_file_range'
+SENDFILE = 'sendfile'
+COPY = 'copy'
+
+strategies = ( LINK, REFLINK, COPY_FILE_RANGE, SENDFILE, COPY )
+
+# The ioctl cloning a file, as supported by e.g. btrfs and XFS
+FICLONE = 0x40049409
+
+# The most bytes copied by one call of copy_file_range or sendfile
+_maxChunkSize = 0x40000000
+
+# The errors meaning that a mechanism doesn't support the given files, as opposed to the copy
+# failing
+_unsupportedErrnos = frozenset( ( errno.EXDEV, errno.EPERM, errno.EACCES, errno.EMLINK,
+                                  errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS, errno.ENOTTY,
+                                  errno.EBADF ) )
+
+# The ( strategy, source device, destination device ) triples known not to be supported, so that
+# they aren't tried again
+_unsupported = set( )
+
+_libc = None
+
+def _getLibc( ):
+    """
+    :rtype : the C library, or None if it can't be loaded
+    """
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL( ctypes.util.find_library( 'c' ), use_errno=True )
+        except OSError:
+            _libc = False
+    return _libc or None
+
+def _getFunction( name, argtypes ):
+    """
+    Returns the function of the C library with the given name, returning an ssize_t, or None if
+    the C library doesn't provide it.
+    """
+    libc = _getLibc( )
+    function = getattr( libc, name, None ) if libc is not None else None
+    if function is not None:
+        function.argtypes = argtypes
+        function.restype = ctypes.c_ssize_t
+    return function
+
+def copyFile( srcPath, dstPath, allowLink=False ):
+    """
+    Copies the file at srcPath to dstPath, replacing dstPath if it exists, and returns how, one
+    of the strategies. If allowLink is True dstPath may become a hard link to srcPath, so the
+    caller must modify neither file afterwards.
+    """
+    if allowLink:
+        # The link is made under a temporary name and renamed, so that dstPath is replaced
+        tempPath = "%s.%s.link" % ( dstPath, uuid.uuid4( ).hex )
+        try:
+            os.link( srcPath, tempPath )
+        except OSError as e:
+            if e.errno not in _unsupportedErrnos:
+                raise
+        else:
+            os.rename( tempPath, dstPath )
+            return LINK
+    try:
+        if os.stat( dstPath ).st_nlink > 1:
+            # Writing to a file hard linked to by copyFile would change the other links, too
+            os.remove( dstPath )
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    with open( srcPath, 'rb' ) as src:
+        with open( dstPath, 'wb' ) as dst:
+            return copyFileObject( src, dst )
+
+def copyFileObject( src, dst ):
+    """
+    Copies the rest of the file src, from its current position, to the empty file dst, both
+    file objects, and returns how, one of the strategies but LINK.
+    """
+    srcFd, dstFd = src.fileno( ), dst.fileno( )
+    start = src.tell( )
+    srcStat = os.fstat( srcFd )
+    size = srcStat.st_size - start
+    devices = ( srcStat.st_dev, os.fstat( dstFd ).st_dev )
+    for strategy, copyFn in ( ( REFLINK, _reflink ),
+                              ( COPY_FILE_RANGE, _copyFileRange ),
+                              ( SENDFILE, _sendfile ) ):
+        if ( strategy, ) + devices in _unsupported:
+            continue
+        try:
+            if copyFn( srcFd, dstFd, start, size ):
+                return strategy
+        # The ioctl raises IOError rather than OSError
+        except EnvironmentError as e:
+            if e.errno not in _unsupportedErrnos:
+                raise
+            _unsupported.add( ( strategy, ) + devices )
+            if strategy != REFLINK:
+                # Start over, in case some of the file was copied
+                os.ftruncate( dstFd, 0 )
+                os.lseek( dstFd, 0, os.SEEK_SET )
+    src.seek( start )
+    shutil.copyfileobj( src, dst, 1024 * 1024 )
+    return COPY
+
+def _reflink( srcFd, dstFd, start, size ):
+    if start != 0:
+        return False
+    fcntl.ioctl( dstFd, FICLONE, srcFd )
+    return True
+
+def _copyInChunks( function, size ):
+    """
+    Calls the given function with the number of bytes left to copy until the size bytes have
+    been copied or the source ends.
+    """
+    while size > 0:
+        copied = function( min( size, _maxChunkSize ) )
+        if copied < 0:
+            e = ctypes.get_errno( )
+            raise OSError( e, os.strerror( e ) )
+        if copied == 0:
+            break
+        size -= copied
+
+def _copyFileRange( srcFd, dstFd, start, size ):
+    copyFileRange = _getFunction( 'copy_file_range',
+                                  [ ctypes.c_int, ctypes.POINTER( ctypes.c_int64 ), ctypes.c_int,
+                                    ctypes.POINTER( ctypes.c_int64 ), ctypes.c_size_t,
+                                    ctypes.c_uint ] )
+    if copyFileRange is None:
+        return False
+    offset = ctypes.c_int64( start )
+    _copyInChunks( lambda n: copyFileRange( srcFd, ctypes.byref( offset ), dstFd, None, n, 0 ),
+                   size )
+    return True
+
+def _sendfile( srcFd, dstFd, start, size ):
+    sendfile = _getFunction( 'sendfile', [ ctypes.c_int, ctypes.c_int,
+                                           ctypes.POINTER( ctypes.c_int64 ), ctypes.c_size_t ] )
+    if sendfile is None:
+        return False
+    offset = ctypes.c_int64( start )
+    _copyInChunks( lambda n: sendfile( dstFd, srcFd, ctypes.byref( offset ), n ), size )
+    return True
@@ -0,0 +1,197 @@
+"""
+Pipes: streams from a producer job to a consumer job that bypass the job store, see Job.addPipe
+and Job.FileStore.openPipe.
+
+The producer and the consumer are siblings scheduled as a gang, see leader.JobBatcher.issueGang:
+the leader issues the producer, and issues the consumer once the producer has started. The
+stream is a FIFO in the temporary directory of the node. The producer waits up to the pipe's
+timeout for the consumer to open the FIFO. If it doesn't, because the consumer runs on another
+node or hasn't started in time, the producer writes the stream to a global file instead, the
+fallback file, and the consumer reads that. If the consumer fails while reading the stream,
+the producer fails too, and its retry falls back to the global file unless the consumer's
+retry opens the FIFO in time.
+
+The end of the FIFO is only the end of the stream if the producer has finished, so a consumer
+that reads the FIFO to its end waits for the producer to delete the done file, and fails if the
+producer fails or doesn't finish within the pipe's timeout. The consumer must therefore read
+the stream to its end. A stream sent through the FIFO is not kept: if the consumer fails after
+it has been sent, its retries fail too, as does the workflow unless the producer is rerun.
+"""
+import errno
+import fcntl
+import logging
+import os
+import select
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger( __name__ )
+
+class Pipe( object ):
+    """
+    A stream from a producer job to a consumer job, see Job.addPipe. Pipes can be passed to
+    jobs like any other argument. The timeout is how long, in seconds, the producer waits for the
+    consumer to open the pipe before falling back to a global file.
+    """
+    def __init__( self, timeout=60 ):
+        self.name = uuid.uuid4( ).hex
+        self.timeout = timeout
+        # The files of the pipe, created when the job graph is serialised, see createFiles:
+        # deleted when the producer starts, so that the leader issues the consumer
+        self.startFileStoreID = None
+        # the fallback file
+        self.fileStoreID = None
+        # deleted once the fallback file has been written
+        self.readyFileStoreID = None
+        # deleted once the producer has finished writing, to the FIFO or the fallback file
+        self.doneFileStoreID = None
+
+    def createFiles( self, jobStore, jobStoreID ):
+        """
+        Creates the files of the pipe as files of the batchjob with the given jobStoreID.
+        """
+        if self.startFileStoreID is None:
+            self.startFileStoreID = jobStore.getEmptyFileStoreID( jobStoreID )
+            self.fileStoreID = jobStore.getEmptyFileStoreID( jobStoreID )
+            self.readyFileStoreID = jobStore.getEmptyFileStoreID( jobStoreID )
+            self.doneFileStoreID = jobStore.getEmptyFileStoreID( jobStoreID )
+
+    def _getFifoPath( self ):
+        return os.path.join( tempfile.gettempdir( ), "toil-pipe-" + self.name )
+
+    def _makeFifo( self ):
+        fifoPath = self._getFifoPath( )
+        try:
+            os.mkfifo( fifoPath, 0600 )
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        return fifoPath
+
+    def _removeFifo( self ):
+        try:
+            os.remove( self._getFifoPath( ) )
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+# The interval between the attempts of the producer to open the FIFO
+pollInterval = 0.1
+# The interval between the checks of the consumer for the files of the pipe in the job store
+checkInterval = 1
+
+@contextmanager
+def openProducer( pipe, fileStore ):
+    """
+    Returns a context manager yielding a file handle to write the stream of the given pipe to,
+    see Job.FileStore.openPipe.
+    """
+    fifoPath = pipe._makeFifo( )
+    deadline = time.time( ) + pipe.timeout
+    while True:
+        try:
+            # Opening the FIFO without blocking fails until the consumer has opened it
+            fd = os.open( fifoPath, os.O_WRONLY | os.O_NONBLOCK )
+            break
+        except OSError as e:
+            if e.errno not in ( errno.ENXIO, errno.ENOENT ):
+                raise
+            if e.errno == errno.ENOENT:
+                # Removed by a consumer that has given up on an earlier attempt
+                pipe._makeFifo( )
+            if time.time( ) > deadline:
+                fd = None
+                break
+            time.sleep( pollInterval )
+    if fd is None:
+        logger.info( "The consumer of pipe %s did not open it within %s seconds, writing the "
+                     "stream to a global file", pipe.name, pipe.timeout )
+        pipe._removeFifo( )
+        with fileStore.updateGlobalFileStream( pipe.fileStoreID ) as fileHandle:
+            yield fileHandle
+        fileStore.jobStore.deleteFile( pipe.readyFileStoreID )
+    else:
+        logger.debug( "Streaming pipe %s to its consumer", pipe.name )
+        fcntl.fcntl( fd, fcntl.F_SETFL, fcntl.fcntl( fd, fcntl.F_GETFL ) & ~os.O_NONBLOCK )
+        # Writes fail with EPIPE if the consumer fails, which fails the producer
+        with os.fdopen( fd, 'w' ) as fileHandle:
+            yield fileHandle
+    fileStore.jobStore.deleteFile( pipe.doneFileStoreID )
+
+@contextmanager
+def openConsumer( pipe, fileStore ):
+    """
+    Returns a context manager yielding a file handle to read the stream of the given pipe from,
+    see Job.FileStore.openPipe.
+    """
+    jobStore = fileStore.jobStore
+    fd = os.open( pipe._makeFifo( ), os.O_RDONLY | os.O_NONBLOCK )
+    try:
+        while True:
+            # The FIFO becomes readable once the producer has opened it and written to it, or
+            # closed it
+            if select.select( [ fd ], [ ], [ ], checkInterval )[ 0 ]:
+                fcntl.fcntl( fd, fcntl.F_SETFL, fcntl.fcntl( fd, fcntl.F_GETFL ) & ~os.O_NONBLOCK )
+                with os.fdopen( fd, 'r' ) as fileHandle:
+                    fd = None
+                    yield fileHandle
+                _checkProducerFinished( pipe, jobStore )
+                break
+            if not jobStore.fileExists( pipe.readyFileStoreID ):
+                with fileStore.readGlobalFileStream( pipe.fileStoreID ) as fileHandle:
+                    yield fileHandle
+                break
+            if not jobStore.fileExists( pipe.doneFileStoreID ):
+                # The producer finished without falling back, check that the stream did not
+                # reach the FIFO in the meantime
+                if select.select( [ fd ], [ ], [ ], 0 )[ 0 ]:
+                    continue
+                raise RuntimeError( "The stream of pipe %s was read by an earlier attempt of "
+                                    "its consumer" % pipe.name )
+    finally:
+        if fd is not None:
+            os.close( fd )
+        pipe._removeFifo( )
+
+def _checkProducerFinished( pipe, jobStore ):
+    """
+    Called once the consumer has read the FIFO of the given pipe to its end, which the producer
+    also closes when it fails. Waits for the producer to delete the done file, and raises
+    RuntimeError if the producer failed, which removes the FIFO, or didn't finish within the
+    pipe's timeout, e.g. because it was killed.
+    """
+    deadline = time.time( ) + pipe.timeout
+    while jobStore.fileExists( pipe.doneFileStoreID ):
+        if not os.path.exists( pipe._getFifoPath( ) ) or time.time( ) > deadline:
+            raise RuntimeError( "The producer of pipe %s did not finish writing its stream, "
+                                "the stream read is truncated" % pipe.name )
+        time.sleep( pollInterval )
+    if not jobStore.fileExists( pipe.readyFileStoreID ):
+        raise RuntimeError( "The producer of pipe %s failed while streaming, and its retry "
+                            "wrote the stream to the fallback file" % pipe.name )
+
+def startProducing( pipes, jobStore ):
+    """
+    Called before the producer of the given pipes runs, so that the leader issues their
+    consumers.
+    """
+    for pipe in pipes:
+        jobStore.deleteFile( pipe.startFileStoreID )
+
+def finishProducing( pipes, jobStore, succeeded ):
+    """
+    Called once the producer of the given pipes has run, whether or not it succeeded. If it
+    did, the pipes it didn't open are empty. If it failed, the FIFOs of the pipes it didn't
+    finish are removed, so that a consumer that has read such a FIFO to its end fails, see
+    _checkProducerFinished.
+    """
+    for pipe in pipes:
+        if jobStore.fileExists( pipe.doneFileStoreID ):
+            if succeeded:
+                logger.debug( "Pipe %s was not written to, its stream is empty", pipe.name )
+                jobStore.deleteFile( pipe.readyFileStoreID )
+                jobStore.deleteFile( pipe.doneFileStoreID )
+            else:
+                pipe._removeFifo( )
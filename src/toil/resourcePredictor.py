@@ -0,0 +1,113 @@
+"""
+Predicts the resource requirements of jobs that don't specify them from the
+resources used by earlier jobs of the same class, or wrapping the same function.
+"""
+import cPickle
+import logging
+import math
+import time
+from collections import deque
+
+logger = logging.getLogger( __name__ )
+
+class ResourcePredictor( object ):
+    """
+    Collects the resource usage reported in the stats of workers by job class and
+    predicts the requirements of later jobs of each class as a quantile of the observed
+    usage plus headroom. Jobs wrapping functions are told apart by the function they wrap,
+    see Job._getPredictionKey.
+
+    Used by the leader's stats/logging aggregator process, which periodically writes the
+    predictions to a shared file in the jobStore. Workers read the file when creating jobs,
+    see getResourcePredictions.
+    """
+    sharedFileName = "resourcePredictions.pickle"
+
+    # The quantile of the observed memory and disk usage to predict
+    quantile = 0.95
+
+    # The factor by which the predicted memory and disk are increased to allow for variation
+    headroom = 1.2
+
+    # The number of observations of a job class needed before predicting its requirements
+    minObservations = 5
+
+    # The number of most recent observations kept per job class
+    maxObservations = 1000
+
+    # The interval, in seconds, at which the leader writes the predictions and processes
+    # reread them
+    writeInterval = 10
+
+    def __init__( self ):
+        # Map of job class names to deques of (memory, cpu, disk) tuples
+        self.observations = { }
+
+    def addStats( self, stats ):
+        """
+        Adds the resource usage of the jobs in the given worker stats element. Memory is
+        reported in kilobytes, as the peak RSS of the worker, and disk is the size of the job's
+        local temporary directory once the job had completed.
+        """
+        for job in stats.findall( "job" ):
+            wallTime = float( job.attrib[ "time" ] )
+            cpu = float( job.attrib[ "clock" ] ) / wallTime if wallTime > 0 else 0
+            observation = ( float( job.attrib[ "memory" ] ) * 1024,
+                            cpu,
+                            float( job.attrib.get( "disk", 0 ) ) )
+            jobClass = job.attrib.get( "predictionKey", job.attrib[ "class" ] )
+            if jobClass not in self.observations:
+                self.observations[ jobClass ] = deque( maxlen=self.maxObservations )
+            self.observations[ jobClass ].append( observation )
+
+    def getPredictions( self ):
+        """
+        :rtype: dict, mapping job class names to predicted (memory, cpu, disk) requirements
+        """
+        predictions = { }
+        for jobClass, observations in self.observations.iteritems( ):
+            if len( observations ) >= self.minObservations:
+                memory, cpu, disk = map( self._quantile, zip( *observations ) )
+                # Requesting too few cores only slows a job down, so cpu has no headroom and is
+                # rounded to the nearest whole core
+                predictions[ jobClass ] = ( int( math.ceil( memory * self.headroom ) ),
+                                            max( 1, int( round( cpu ) ) ),
+                                            int( math.ceil( disk * self.headroom ) ) )
+        return predictions
+
+    def writePredictions( self, jobStore ):
+        """
+        Writes the current predictions to the shared file read by getResourcePredictions.
+        """
+        with jobStore.writeSharedFileStream( self.sharedFileName ) as fileHandle:
+            cPickle.dump( self.getPredictions( ), fileHandle, cPickle.HIGHEST_PROTOCOL )
+
+    def _quantile( self, values ):
+        values = sorted( values )
+        return values[ min( len( values ) - 1, int( math.ceil( self.quantile * len( values ) ) ) - 1 ) ]
+
+# Map of jobStore strings to the time the predictions of the jobStore were read and the
+# predictions, see getResourcePredictions
+_predictions = { }
+
+def getResourcePredictions( jobStore ):
+    """
+    Returns the predictions last written by ResourcePredictor.writePredictions. The predictions
+    are reread once they are older than the interval at which the leader writes them.
+
+    :rtype: dict, mapping job class names to predicted (memory, cpu, disk) requirements
+    """
+    jobStoreString = jobStore.config.attrib[ "job_store" ]
+    readTime, predictions = _predictions.get( jobStoreString, ( None, None ) )
+    now = time.time( )
+    if readTime is None or now - readTime >= ResourcePredictor.writeInterval:
+        try:
+            with jobStore.readSharedFileStream( ResourcePredictor.sharedFileName ) as fileHandle:
+                predictions = cPickle.load( fileHandle )
+        except Exception:
+            # The file does not exist until the first jobs have finished, and may be read while
+            # the leader is writing it. Either way, predicting nothing is safe.
+            logger.debug( "No resource predictions available", exc_info=True )
+            predictions = { }
+        _predictions[ jobStoreString ] = ( now, predictions )
+    return predictions
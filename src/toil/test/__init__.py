@@ -1,11 +1,14 @@
 import logging
 import os
 import shlex
+import shutil
+import tempfile
 import unittest
 import sys
 
 from toil.common import toilPackageDirPath
-from toil.lib.bioio import getBasicOptionParser, parseSuiteTestOptions
+from toil.job import Job
+from toil.lib.bioio import getBasicOptionParser, parseSuiteTestOptions, getTempFile
 
 log = logging.getLogger(__name__)
 
@@ -42,4 +45,31 @@ class ToilTest(unittest.TestCase):
         super(ToilTest, self).tearDown()
         log.info("Tearing down down %s", self.id())
 
+    def _createTempDir(self):
+        """
+        Returns the path of a new temporary directory, which is removed when the test ends.
+        """
+        tempDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempDir, True)
+        return tempDir
+
+    def runJobFn(self, jobFn, *args, **options):
+        """
+        Runs a toil, with the default options updated by the given ones, whose root job calls
+        the given job function with the given arguments and the path of an output file. Checks
+        that no job failed and returns what the jobs wrote to the output file.
+        """
+        tempDir = self._createTempDir()
+        outFile = getTempFile(rootDir=tempDir)
+        toilOptions = Job.Runner.getDefaultOptions()
+        toilOptions.toil = os.path.join(tempDir, "jobStore")
+        toilOptions.logLevel = "INFO"
+        for name, value in options.iteritems():
+            setattr(toilOptions, name, value)
+        t = Job.wrapJobFn(jobFn, *(args + (outFile,)))
+        self.assertEquals(Job.Runner.startToil(t, toilOptions), 0)
+        Job.Runner.cleanup(toilOptions)
+        with open(outFile, 'r') as fileHandle:
+            return fileHandle.read()
+
 
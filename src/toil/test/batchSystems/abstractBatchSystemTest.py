@@ -105,6 +105,11 @@ class hidden:
             self.wait_for_jobs()
             # self.assertEqual([0], self.batchSystem.getRunningJobIDs().keys())
             self.batchSystem.killBatchJobs([jobID])
+            # The jobs may take a moment to exit
+            for i in xrange(100):
+                if not self.batchSystem.getRunningBatchJobIDs():
+                    break
+                time.sleep(0.1)
             self.assertEqual({}, self.batchSystem.getRunningBatchJobIDs())
             # Make sure that killJob doesn't hang / raise KeyError on unknown batchjob IDs
             self.batchSystem.killBatchJobs([0])
@@ -177,3 +182,27 @@ class MesosBatchSystemTest(hidden.AbstractBatchSystemTest, MesosTestSupport):
 class SingleMachineBatchSystemTest(hidden.AbstractBatchSystemTest):
     def createBatchSystem(self):
         return SingleMachineBatchSystem(config=self.config, maxCpus=numCores, maxMemory=50, maxDisk=1001)
+
+    def testGetAvailableResources(self):
+        maxCpus = self.batchSystem.maxCpus
+        self.assertEqual((maxCpus, 50, 1001), self.batchSystem.getAvailableResources())
+        self.batchSystem.issueBatchJob('sleep 1', memory=10, cpu=.5, disk=1000)
+        self.assertEqual((maxCpus - .5, 40, 1), self.batchSystem.getAvailableResources())
+        self.wait_for_jobs(wait_for_completion=True)
+        self.batchSystem.getUpdatedBatchJob(2)
+        self.assertEqual((maxCpus, 50, 1001), self.batchSystem.getAvailableResources())
+
+    def testKilledJobStaysIssued(self):
+        """
+        Tests that a killed batchjob stays issued, holding its resources, until it has exited
+        and been returned by getUpdatedBatchJob.
+        """
+        maxCpus = self.batchSystem.maxCpus
+        jobID = self.batchSystem.issueBatchJob('sleep 100', memory=10, cpu=.5, disk=1000)
+        self.wait_for_jobs()
+        self.batchSystem.killBatchJobs([jobID])
+        self.assertEqual([jobID], self.batchSystem.getIssuedBatchJobIDs())
+        self.assertEqual((maxCpus - .5, 40, 1), self.batchSystem.getAvailableResources())
+        self.assertEqual(jobID, self.batchSystem.getUpdatedBatchJob(10)[0])
+        self.assertEqual([], self.batchSystem.getIssuedBatchJobIDs())
+        self.assertEqual((maxCpus, 50, 1001), self.batchSystem.getAvailableResources())
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""Measures the updates per second of the FileJobStore for each durability mode, see
+FileJobStore.durabilityModes. Each of a number of processes, standing in for the leader and
+the workers, runs a number of threads, each updating a small batchjob of its own. The flushes
+to disk per update are counted, too.
+"""
+from multiprocessing import Process, Queue
+from optparse import OptionParser
+import os
+import shutil
+import tempfile
+from threading import Thread
+import time
+from xml.etree.cElementTree import Element
+
+from toil.jobStores.fileJobStore import FileJobStore
+
+def countFlushes(counts):
+    """
+    Counts the calls of os.fsync and os.fdatasync of this process in the given dictionary.
+    """
+    for name in ('fsync', 'fdatasync'):
+        def counter(function):
+            def wrapper(*args):
+                counts['flushes'] += 1
+                return function(*args)
+            return wrapper
+        setattr(os, name, counter(getattr(os, name)))
+
+def updateJobs(jobStoreDir, threads, updates, results):
+    """
+    Updates a batchjob of each of the given number of threads the given number of times,
+    putting the number of flushes on the results queue.
+    """
+    jobStore = FileJobStore(jobStoreDir)
+    batchjobs = [ jobStore.create("1", 2, 3, 4, 0) for i in xrange(threads) ]
+    counts = dict(flushes=0)
+    countFlushes(counts)
+    def updateJob(batchjob):
+        for i in xrange(updates):
+            batchjob.remainingRetryCount = i
+            jobStore.update(batchjob)
+    workers = [ Thread(target=updateJob, args=(batchjob,)) for batchjob in batchjobs ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    results.put(counts['flushes'])
+
+def benchmark(durability, processes, threads, updates, rootDir):
+    """
+    Returns the updates per second and the flushes per update for the given durability mode.
+    """
+    jobStoreDir = tempfile.mkdtemp(dir=rootDir)
+    os.rmdir(jobStoreDir)
+    config = Element("config")
+    config.attrib["try_count"] = "1"
+    config.attrib["durability"] = durability
+    FileJobStore(jobStoreDir, config)
+    try:
+        results = Queue()
+        workers = [ Process(target=updateJobs, args=(jobStoreDir, threads, updates, results))
+                    for i in xrange(processes) ]
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        flushes = sum(results.get() for worker in workers)
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(jobStoreDir)
+    #Creating the batchjobs is an update each, too
+    total = processes * threads * (updates + 1)
+    return total / elapsed, float(flushes) / total
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--processes", default="1,4",
+                      help="Comma separated numbers of processes, default=%default")
+    parser.add_option("--threads", default="1,8",
+                      help="Comma separated numbers of threads per process, default=%default")
+    parser.add_option("--updates", type="int", default=200,
+                      help="The number of updates per thread, default=%default")
+    parser.add_option("--repeats", type="int", default=3,
+                      help="The best of this many runs is reported, default=%default")
+    parser.add_option("--dir", default=None,
+                      help="The directory to make the jobStores in, default=the temp dir")
+    options, args = parser.parse_args()
+    print "%-6s %9s %7s %10s %14s" % ("mode", "processes", "threads", "updates/s", "flushes/update")
+    for processes in map(int, options.processes.split(",")):
+        for threads in map(int, options.threads.split(",")):
+            for durability in FileJobStore.durabilityModes:
+                rate, flushes = max(benchmark(durability, processes, threads, options.updates,
+                                              options.dir) for i in xrange(options.repeats))
+                print "%-6s %9i %7i %10i %14.2f" % (durability, processes, threads, rate, flushes)
+
+if __name__ == '__main__':
+    main()
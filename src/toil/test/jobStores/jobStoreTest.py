@@ -1,17 +1,28 @@
+from BaseHTTPServer import HTTPServer
+from collections import Counter
+from contextlib import contextmanager
 from Queue import Queue
+from SimpleHTTPServer import SimpleHTTPRequestHandler
 from abc import abstractmethod, ABCMeta
+from functools import partial
 import hashlib
 import logging
 import os
+import shutil
 import urllib2
 import tempfile
+import time
 from threading import Thread
 import uuid
 from xml.etree.cElementTree import Element
 
 from toil.jobStores.abstractJobStore import (NoSuchJobException, NoSuchFileException)
 from toil.jobStores.awsJobStore import AWSJobStore
-from toil.jobStores.fileJobStore import FileJobStore
+from toil.jobStores.fileJobStore import FileJobStore, _Journal
+from toil.jobStores.memoryJobStore import MemoryJobStore
+from toil.jobStores.sqliteJobStore import SQLiteJobStore
+from toil.job import Job
+from toil.lib import inotify
 from toil.test import ToilTest
 
 logger = logging.getLogger( __name__ )
@@ -35,6 +46,21 @@ def urlIsValid(url):
         return httpUrl(url)
 
 
+class SimpleFileHandler( SimpleHTTPRequestHandler ):
+    """
+    Serves the files in the given directory, rather than the current one.
+    """
+    def __init__( self, rootDir, *args ):
+        self.rootDir = rootDir
+        SimpleHTTPRequestHandler.__init__( self, *args )
+
+    def translate_path( self, path ):
+        return os.path.join( self.rootDir, os.path.basename( path ) )
+
+    def log_message( self, *args ):
+        pass
+
+
 class hidden:
     """
     Hide abstract base class from unittest's test case loader
@@ -184,6 +210,18 @@ class hidden:
             with master.readSharedFileStream( "foo" ) as f:
                 self.assertEquals( "bar", f.read( ) )
 
+            # Deleting a shared file, which can't be read afterwards, is idempotent
+            with master.writeSharedFileStream( "baz" ) as f:
+                f.write( "bar" )
+            worker.deleteSharedFile( "baz" )
+            worker.deleteSharedFile( "baz" )
+
+            def readDeleted( ):
+                with master.readSharedFileStream( "baz" ) as f:
+                    f.read( )
+
+            self.assertRaises( ( NoSuchFileException, IOError ), readDeleted )
+
             #FIXME: TEST GETURL HERE.
             sharedUrl = master.getSharedPublicUrl("foo")
             self.assertTrue(urlIsValid(sharedUrl))
@@ -357,6 +395,109 @@ class hidden:
                 self.assertEquals( before, after )
             self.master.delete( batchjob.jobStoreID )
 
+        def testWaitForFileDeletion( self ):
+            batchjob = self.master.create( "1", 2, 3, 4, 0)
+            fileIDs = [ self.master.getEmptyFileStoreID( batchjob.jobStoreID ) for i in range( 3 ) ]
+            # Files that exist cause a timeout ...
+            self.assertFalse( self.master.waitForFileDeletion( fileIDs, timeout=0.5 ) )
+            # ... files deleted before the call don't block ...
+            self.master.deleteFile( fileIDs[ 0 ] )
+            self.assertTrue( self.master.waitForFileDeletion( fileIDs[ :1 ], timeout=0 ) )
+            # ... and files deleted concurrently by another instance of the store are noticed.
+            worker = self.createJobStore( )
+            def deleteFiles( ):
+                time.sleep( 1 )
+                for fileID in fileIDs[ 1: ]:
+                    worker.deleteFile( fileID )
+            thread = Thread( target=deleteFiles )
+            thread.start( )
+            try:
+                self.assertTrue( self.master.waitForFileDeletion( fileIDs, timeout=60 ) )
+            finally:
+                thread.join( )
+            self.master.delete( batchjob.jobStoreID )
+
+        def testReadFileRange( self ):
+            batchjob = self.master.create( "1", 2, 3, 4, 0)
+            data = "".join( "%04i\n" % i for i in range( 1000 ) )
+            with self.master.writeFileStream( batchjob.jobStoreID ) as ( f, fileID ):
+                f.write( data )
+            for offset, length in ( ( 0, None ), ( 0, 10 ), ( 10, None ), ( 4990, 5 ), ( 4995, 10 ),
+                                    ( 5000, None ), ( 6000, 10 ), ( 100, 0 ) ):
+                end = None if length is None else offset + length
+                with self.master.readFileStream( fileID, offset, length ) as f:
+                    self.assertEquals( f.read( ), data[ offset:end ] )
+                with self.master.readFileStream( fileID, offset, length ) as f:
+                    self.assertEquals( "".join( f ), data[ offset:end ] )
+            fd, localFilePath = tempfile.mkstemp( )
+            os.close( fd )
+            try:
+                self.master.readFile( fileID, localFilePath, ( 25, 15 ) )
+                with open( localFilePath ) as f:
+                    self.assertEquals( f.read( ), data[ 25:40 ] )
+            finally:
+                os.remove( localFilePath )
+            self.master.delete( batchjob.jobStoreID )
+
+        def testImportExportFiles( self ):
+            batchjob = self.master.create( "1", 2, 3, 4, 0)
+            tempDir = tempfile.mkdtemp( )
+            # Serve the files over HTTP too
+            server = HTTPServer( ( 'localhost', 0 ), partial( SimpleFileHandler, tempDir ) )
+            thread = Thread( target=server.serve_forever )
+            thread.start( )
+            try:
+                contents = [ os.urandom( i * 1000 ) for i in range( 10 ) ]
+                paths = [ ]
+                for i, content in enumerate( contents ):
+                    paths.append( os.path.join( tempDir, "in%i" % i ) )
+                    with open( paths[ -1 ], 'w' ) as f:
+                        f.write( content )
+                urls = [ paths[ 0 ], 'file:' + paths[ 1 ] ] + [
+                    'http://localhost:%i/in%i' % ( server.server_port, i )
+                    for i in range( 2, len( paths ) ) ]
+                fileIDs = self.master.importFiles( batchjob.jobStoreID, urls, threads=4 )
+                for fileID, content in zip( fileIDs, contents ):
+                    with self.master.readFileStream( fileID ) as f:
+                        self.assertEquals( f.read( ), content )
+                outPaths = [ os.path.join( tempDir, "out%i" % i ) for i in range( len( paths ) ) ]
+                self.master.exportFiles( fileIDs, outPaths, threads=4 )
+                for outPath, content in zip( outPaths, contents ):
+                    with open( outPath ) as f:
+                        self.assertEquals( f.read( ), content )
+                self.assertRaises( RuntimeError, self.master.importFiles, batchjob.jobStoreID,
+                                   [ 'ftp://localhost/in0' ] )
+            finally:
+                server.shutdown( )
+                thread.join( )
+                shutil.rmtree( tempDir )
+            self.master.delete( batchjob.jobStoreID )
+
+        def testUpdateLargeBatchjob( self ):
+            """
+            Tests repeated updates of a batchjob with a large stack by two instances of the batchjob
+            store, as by the leader and a worker.
+            """
+            batchjob = self.master.create( "1", 2, 3, 4, 0 )
+            batchjob.stack.append( [ ( "successor%i" % i, 1, 2, 3, None ) for i in xrange( 1000 ) ] )
+            self.master.update( batchjob )
+            worker = self.createJobStore( )
+            for i in xrange( 10 ):
+                jobOnWorker = worker.load( batchjob.jobStoreID )
+                self.assertEquals( jobOnWorker, batchjob )
+                jobOnWorker.predecessorsFinished.add( str( i ) )
+                worker.update( jobOnWorker )
+                jobOnWorker.remainingRetryCount = i
+                worker.update( jobOnWorker )
+                batchjob = self.master.load( batchjob.jobStoreID )
+                self.assertEquals( batchjob, jobOnWorker )
+                batchjob.command = str( i )
+                self.master.update( batchjob )
+            batchjob.stack.pop( )
+            self.master.update( batchjob )
+            self.assertEquals( worker.load( batchjob.jobStoreID ), batchjob )
+            self.master.delete( batchjob.jobStoreID )
+
         def testZeroLengthFiles( self ):
             batchjob = self.master.create( "1", 2, 3, 4, 0)
             nullFile = self.master.writeFile( batchjob.jobStoreID, '/dev/null' )
@@ -368,10 +509,454 @@ class hidden:
                 self.assertEquals( f.read( ), "" )
             self.master.delete( batchjob.jobStoreID )
 
+        def testUpdateImmutableFile( self ):
+            """
+            Tests that updating a file written as immutable doesn't change the local file it was
+            written from, which the store may have linked to.
+            """
+            batchjob = self.master.create( "1", 2, 3, 4, 0)
+            tempDir = tempfile.mkdtemp( )
+            self.addCleanup( shutil.rmtree, tempDir, True )
+            localPath = os.path.join( tempDir, "local" )
+            with open( localPath, 'w' ) as f:
+                f.write( "original" )
+            fileID = self.master.writeFile( batchjob.jobStoreID, localPath, immutable=True )
+            with self.createJobStore( ).updateFileStream( fileID ) as f:
+                f.write( "updated" )
+            with self.master.readFileStream( fileID ) as f:
+                self.assertEquals( f.read( ), "updated" )
+            with open( localPath, 'r' ) as f:
+                self.assertEquals( f.read( ), "original" )
+            self.master.delete( batchjob.jobStoreID )
+
 class FileJobStoreTest( hidden.AbstractJobStoreTest ):
     def createJobStore( self, config=None ):
         return FileJobStore( self.namePrefix, config )
 
+    def testDeltaUpdates( self ):
+        """
+        Tests that small changes to a large batchjob are appended to its record, which is compacted
+        once the appended updates are as large as the batchjob, and that an incomplete update is
+        dropped.
+        """
+        batchjob = self.master.create( "1", 2, 3, 4, 0 )
+        batchjob.stack.append( [ ( "successor%i" % i, 1, 2, 3, None ) for i in xrange( 1000 ) ] )
+        self.master.update( batchjob )
+        jobFile = self.master._getJobFileName( batchjob.jobStoreID )
+        snapshotSize = os.path.getsize( jobFile )
+        batchjob.command = "2"
+        self.master.update( batchjob )
+        size = os.path.getsize( jobFile )
+        self.assertTrue( size - snapshotSize < 100 )
+        # Nothing is written for an unchanged batchjob
+        self.master.update( batchjob )
+        self.assertEquals( os.path.getsize( jobFile ), size )
+        # An update interrupted while being appended is dropped, as is one interrupted while being
+        # written to a ".new" file, and the batchjob is set up to be retried
+        with open( jobFile, 'r+' ) as f:
+            f.truncate( size - 1 )
+        worker = self.createJobStore( )
+        worker.config.attrib[ "default_memory" ] = "0"
+        retriedJob = worker.load( batchjob.jobStoreID )
+        self.assertEquals( retriedJob.command, "1" )
+        self.assertEquals( retriedJob.remainingRetryCount, batchjob.remainingRetryCount - 1 )
+        # The worker may still be appending to the record, so it is only repaired by clean
+        self.assertEquals( os.path.getsize( jobFile ), size - 1 )
+        worker.clean( )
+        with open( jobFile ) as f:
+            data = f.read( )
+        self.assertEquals( worker._decodeRecord( data )[ 3 ], len( data ) )
+        # The record changed since the master updated it, so it is rewritten
+        batchjob.command = "3"
+        self.master.update( batchjob )
+        self.assertEquals( worker.load( batchjob.jobStoreID ), batchjob )
+        # Changes between values whose hashes are equal are kept
+        for retryCount in ( -1, -2 ):
+            batchjob.remainingRetryCount = retryCount
+            self.master.update( batchjob )
+        self.assertEquals( worker.load( batchjob.jobStoreID ), batchjob )
+        # The log is compacted once it reaches the size of the snapshot
+        for i in xrange( 1000 ):
+            batchjob.predecessorsFinished.add( str( i ) )
+            self.master.update( batchjob )
+            self.assertTrue( os.path.getsize( jobFile ) <= 8 + 2 * len( batchjob.toBytes( ) ) )
+        self.assertEquals( worker.load( batchjob.jobStoreID ), batchjob )
+
+    def testMetadataCalls( self ):
+        """
+        Counts the calls querying or changing the metadata of the file system per operation, each
+        of which is a round trip to the server of a network file system, and tests that the
+        stats of immutable files are cached if the config asks for it.
+        """
+        config = self._dummyConfig( )
+        config.attrib[ "attribute_cache_ttl" ] = "60"
+        master = self.createJobStore( config )
+        batchjob = master.create( "1", 2, 3, 4, 0 )
+        tempDir = tempfile.mkdtemp( )
+        self.addCleanup( shutil.rmtree, tempDir )
+        localPath = os.path.join( tempDir, "local" )
+        with open( localPath, 'w' ) as f:
+            f.write( "data" )
+
+        def readFileStream( ):
+            with master.readFileStream( fileStoreID ) as f:
+                f.read( )
+
+        fileStoreID = master.writeFile( batchjob.jobStoreID, localPath )
+        immutableFileStoreID = master.writeFile( batchjob.jobStoreID, localPath, immutable=True )
+        operations = [ ( 0, lambda: master.writeFile( batchjob.jobStoreID, localPath ) ),
+                       ( 1, lambda: master.readFile( fileStoreID, localPath + ".read" ) ),
+                       ( 0, readFileStream ),
+                       ( 1, lambda: master.fileExists( fileStoreID ) ),
+                       ( 1, lambda: master.deleteFile( fileStoreID + ".missing" ) ),
+                       ( 1, lambda: master.load( batchjob.jobStoreID ) ),
+                       ( 0, lambda: master.fileExists( immutableFileStoreID ) ),
+                       ( 0, lambda: master.getLocalFilePath( immutableFileStoreID ) ) ]
+        for expectedCalls, operation in operations:
+            operation( )
+            with self._countMetadataCalls( ) as counts:
+                operation( )
+            self.assertEquals( sum( counts.values( ) ), expectedCalls, counts )
+        # Deleting a file drops its cached stat
+        master.deleteFile( immutableFileStoreID )
+        self.assertFalse( master.fileExists( immutableFileStoreID ) )
+        self.assertRaises( NoSuchJobException, master.load, batchjob.jobStoreID + "x" )
+        self.assertRaises( NoSuchJobException, master.writeFile, batchjob.jobStoreID + "x", localPath )
+        self.assertRaises( NoSuchFileException, master.readFile, fileStoreID + "x", localPath )
+
+    def testJobIndex( self ):
+        """
+        Tests that the batchjobs are enumerated from the index, which is compacted, and by 
+        listing the directories of stores without an index.
+        """
+        self.master.jobIndex.minCompactionSize = 4096
+        batchjobs = [ self.master.create( "1", 2, 3, 4, 0 ) for i in xrange( 100 ) ]
+        for batchjob in batchjobs[ :90 ]:
+            self.master.delete( batchjob.jobStoreID )
+        self.assertEquals( set( self.master.jobs( ) ), set( batchjobs[ 90: ] ) )
+        # The manifest was compacted, which the other store notices when it next appends
+        worker = self.createJobStore( )
+        self.assertTrue( os.path.getsize( self.master.jobIndex.path ) < 4096 )
+        batchjobs.append( worker.create( "1", 2, 3, 4, 0 ) )
+        self.master.delete( batchjobs[ 90 ].jobStoreID )
+        self.assertEquals( set( worker.jobs( ) ), set( batchjobs[ 91: ] ) )
+        # A name reused after its batchjob was deleted is counted
+        self.assertEquals( self.master.jobIndex._parse( "+a\n-a\n+a\n+b\n-b\n+c" ),
+                           [ "a" ] )
+        # Without an index the directories are listed
+        os.remove( self.master.jobIndex.path )
+        self.assertEquals( set( self.createJobStore( ).jobs( ) ), set( batchjobs[ 91: ] ) )
+
+    def testPackedFiles( self ):
+        """
+        Tests that small files written as streams are packed, that they are promoted to files of
+        their own when they outgrow the limit or are updated from local files, and that the
+        dead space of a pack is compacted.
+        """
+        batchjob = self.master.create( "1", 2, 3, 4, 0 )
+        worker = self.createJobStore( )
+        fileIDs = [ ]
+        for i in xrange( 200 ):
+            with self.master.writeFileStream( batchjob.jobStoreID ) as ( f, fileID ):
+                f.write( "%04i" % i * 100 )
+            fileIDs.append( fileID )
+        emptyFileID = self.master.getEmptyFileStoreID( batchjob.jobStoreID )
+        filesDir = os.path.dirname( self.master._getAbsPath( emptyFileID ) )
+        self.assertEquals( sorted( os.listdir( filesDir ) ), [ "pack0", "packIndex" ] )
+        self.assertTrue( worker.fileExists( emptyFileID ) )
+        self.assertEquals( worker.getLocalFilePath( fileIDs[ 0 ] ), None )
+        with worker.readFileStream( fileIDs[ 1 ], 8, 4 ) as f:
+            self.assertEquals( f.read( ), "0001" )
+        # The pack is shared by the stores of the process and only appended entries are parsed
+        pack = self.master._getPack( emptyFileID )
+        self.assertTrue( pack is worker._getPack( fileIDs[ 0 ] ) )
+        self.assertEquals( pack.cachedIndex[ 2 ], os.path.getsize( pack.indexPath ) )
+        entries = pack.cachedIndex[ 3 ]
+        newFileID = self.master.getEmptyFileStoreID( batchjob.jobStoreID )
+        self.assertTrue( worker.fileExists( newFileID ) )
+        self.assertTrue( pack.cachedIndex[ 3 ] is entries )
+        # A file that outgrows the limit is promoted
+        with worker.updateFileStream( fileIDs[ 0 ] ) as f:
+            f.write( "x" * ( self.master.maxPackedSize + 1 ) )
+        self.assertFalse( self.master._isLivePacked( fileIDs[ 0 ] ) )
+        with self.master.readFileStream( fileIDs[ 0 ] ) as f:
+            self.assertEquals( f.read( ), "x" * ( self.master.maxPackedSize + 1 ) )
+        localPath = os.path.join( self.master.jobStoreDir, "local" )
+        with open( localPath, 'w' ) as f:
+            f.write( "local" )
+        worker.updateFile( fileIDs[ 1 ], localPath )
+        self.assertEquals( self.master.getLocalFilePath( fileIDs[ 1 ] ),
+                           self.master._getAbsPath( fileIDs[ 1 ] ) )
+        # The dead space of deleted files is compacted, in the background
+        self.master.deleteFile( fileIDs[ 0 ] )
+        for fileID in fileIDs[ 2:150 ]:
+            worker.deleteFile( fileID )
+        self.assertFalse( self.master.fileExists( fileIDs[ 2 ] ) )
+        worker.compactionPool.close( )
+        worker.compactionPool.join( )
+        self.assertTrue( "pack0" not in os.listdir( filesDir ) )
+        self.assertTrue( os.path.getsize( os.path.join( filesDir, "packIndex" ) ) < 100 * 64 )
+        for i, fileID in enumerate( fileIDs[ 150: ], 150 ):
+            with self.master.readFileStream( fileID ) as f:
+                self.assertEquals( f.read( ), "%04i" % i * 100 )
+        self.assertTrue( self.master.fileExists( emptyFileID ) )
+        self.master.delete( batchjob.jobStoreID )
+        self.assertFalse( worker.fileExists( fileIDs[ 150 ] ) )
+
+    def testShards( self ):
+        """
+        Tests that the directories of the batchjobs are spread over the shards, are found by
+        other stores, deepen as the store grows and are moved when the shards change.
+        """
+        roots = [ tempfile.mkdtemp( ) for i in xrange( 3 ) ]
+        for root in roots:
+            self.addCleanup( shutil.rmtree, root, True )
+        config = self._dummyConfig( )
+        config.attrib[ "shard_roots" ] = ",".join( roots[ :2 ] )
+        master = FileJobStore( os.path.join( roots[ 2 ], "jobStore" ), config )
+        self.addCleanup( master.deleteJobStore )
+        localPath = os.path.join( roots[ 2 ], "local" )
+        with open( localPath, 'w' ) as f:
+            f.write( "data" )
+        batchjobs = [ master.create( "1", 2, 3, 4, 0 ) for i in xrange( 60 ) ]
+        fileStoreIDs = [ master.writeFile( batchjob.jobStoreID, localPath )
+                         for batchjob in batchjobs ]
+        shardPaths = set( os.path.dirname( master._getShardPath(
+            master._getJobDirName( batchjob.jobStoreID ) ) ) for batchjob in batchjobs )
+        self.assertEquals( shardPaths, set( roots[ :2 ] + [ master.jobStoreDir ] ) )
+        worker = FileJobStore( master.jobStoreDir, None )
+        self.assertEquals( set( worker.jobs( ) ), set( batchjobs ) )
+        worker.readFile( fileStoreIDs[ 0 ], localPath + ".read" )
+        # The hierarchy of directories deepens as the store grows
+        worker.maxJobsPerDir = 1
+        worker.jobIndex.estimatedLineSize = 1
+        deeperJob = worker.create( "1", 2, 3, 4, 0 )
+        self.assertTrue( deeperJob.jobStoreID.count( "/" ) > batchjobs[ 0 ].jobStoreID.count( "/" ) )
+        batchjobs.append( deeperJob )
+        # Replacing a root moves the batchjobs of its shard and those taken over by the new one
+        getShard = lambda batchjob: master.shardRing.get(
+            master._getJobDirName( batchjob.jobStoreID ) )
+        oldShards = map( getShard, batchjobs )
+        removedShard = [ name for name, path in master.shards.iteritems( )
+                         if os.path.dirname( path ) == roots[ 0 ] ][ 0 ]
+        master.config.attrib[ "shard_roots" ] = ",".join( roots[ 1: ] )
+        master.clean( )
+        self.assertEquals( os.listdir( roots[ 0 ] ), [ ] )
+        self.assertEquals( len( master.shards ), 3 )
+        for oldShard, newShard in zip( oldShards, map( getShard, batchjobs ) ):
+            self.assertTrue( oldShard == newShard or oldShard == removedShard or
+                             os.path.dirname( master.shards[ newShard ] ) == roots[ 2 ] )
+        self.assertEquals( set( master.jobs( ) ), set( batchjobs ) )
+        for fileStoreID in fileStoreIDs:
+            master.readFile( fileStoreID, localPath + ".read" )
+        self.assertEquals( set( FileJobStore( master.jobStoreDir, None ).jobs( ) ), 
+                           set( batchjobs ) )
+
+    def testStatsSpool( self ):
+        """
+        Tests that stats/logging strings are read in order, once, from the spool, that missing
+        strings are waited for and then given up on, and that readers are woken by writes.
+        """
+        read = [ ]
+        readFn = lambda f: read.append( f.read( ) )
+        for i in xrange( 5 ):
+            self.master.writeStatsAndLogging( str( i ) )
+        self.assertEquals( self.master.readStatsAndLogging( readFn ), 5 )
+        self.assertEquals( read, map( str, xrange( 5 ) ) )
+        # A string whose writer failed holds the cursor back until it is given up on
+        worker = self.createJobStore( )
+        worker.statsSpool._nextNumber( )
+        worker.writeStatsAndLogging( "6" )
+        self.assertEquals( self.master.readStatsAndLogging( readFn ), 1 )
+        self.assertEquals( self.master.readStatsAndLogging( readFn ), 0 )
+        self.assertEquals( self.master.statsSpool.cursor, 5 )
+        self.master.statsSpool.gapTimeout = 0
+        self.assertEquals( self.master.readStatsAndLogging( readFn ), 0 )
+        self.assertEquals( self.master.statsSpool.cursor, 7 )
+        # Strings before the persisted cursor are not read again by a new reader
+        worker.writeStatsAndLogging( "7" )
+        with open( worker.statsSpool.cursorPath, 'w' ) as f:
+            f.write( "8" )
+        worker.writeStatsAndLogging( "8" )
+        self.assertEquals( self.createJobStore( ).readStatsAndLogging( readFn ), 1 )
+        self.assertEquals( read, map( str, xrange( 5 ) ) + [ "6", "8" ] )
+        self.assertEquals( os.listdir( self.master.statsSpool.path ), [ ] )
+        # Readers are woken by writes
+        if inotify.isAvailable( ):
+            self.assertFalse( self.master.waitForStatsAndLogging( 0.1 ) )
+            writer = Thread( target=worker.writeStatsAndLogging, args=( "9", ) )
+            start = time.time( )
+            writer.start( )
+            self.assertTrue( self.master.waitForStatsAndLogging( 10 ) )
+            self.assertTrue( time.time( ) - start < 5 )
+            writer.join( )
+
+    def testGroupCommit( self ):
+        """
+        Tests that updates and deletions journaled with the "group" durability are replayed on
+        restart, restoring batchjob files that didn't reach the disk, that concurrent updates
+        are journaled, and that records from before a checkpoint are not replayed.
+        """
+        self.master.durability = "group"
+        batchjob = self.master.create( "1", 2, 3, 4, 0 )
+        batchjob.predecessorsFinished = set( map( str, xrange( 1000 ) ) )
+        self.master.update( batchjob )
+        batchjob.command = "2"
+        self.master.update( batchjob )
+        deletedJob = self.master.create( "deleted", 2, 3, 4, 0 )
+        self.master.delete( deletedJob.jobStoreID )
+        # The files of the batchjobs are lost, or come back, as if the changes hadn't reached
+        # the disk before a crash
+        shutil.rmtree( self.master._getAbsPath( batchjob.jobStoreID ) )
+        os.mkdir( self.master._getAbsPath( deletedJob.jobStoreID ) )
+        with open( self.master._getJobFileName( deletedJob.jobStoreID ), 'w' ) as f:
+            f.write( deletedJob.toBytes( ) )
+        restarted = self.createJobStore( )
+        restarted.clean( )
+        self.assertEquals( restarted.load( batchjob.jobStoreID ), batchjob )
+        self.assertFalse( restarted.exists( deletedJob.jobStoreID ) )
+        self.assertEquals( [ j.jobStoreID for j in restarted.jobs( ) ], [ batchjob.jobStoreID ] )
+        self.assertEquals( os.path.getsize( restarted.journal.logPath ), 0 )
+        # Updates from several threads
+        restarted.durability = "group"
+        batchjobs = [ restarted.create( str( i ), 2, 3, 4, 0 ) for i in xrange( 4 ) ]
+
+        def updateJob( batchjob ):
+            for i in xrange( 10 ):
+                batchjob.remainingRetryCount = i
+                restarted.update( batchjob )
+
+        threads = [ Thread( target=updateJob, args=( j, ) ) for j in batchjobs ]
+        for thread in threads:
+            thread.start( )
+        for thread in threads:
+            thread.join( )
+        for j in batchjobs:
+            os.remove( restarted._getJobFileName( j.jobStoreID ) )
+        self.createJobStore( ).clean( )
+        for j in batchjobs:
+            self.assertEquals( restarted.load( j.jobStoreID ), j )
+        # The records of other journals of the log, as of other processes, are replayed in the
+        # order they were appended, and a flush by one covers the records of the others
+        other = _Journal( restarted.journal.path, restarted._syncJobFiles )
+        for i in xrange( 4 ):
+            journal = other if i % 2 else restarted.journal
+            with journal.commit( batchjob.jobStoreID, 0, str( i ) ):
+                pass
+        fdatasync = os.fdatasync
+        os.fdatasync = None
+        try:
+            with other.condition:
+                other.flushed = ( -1, 0 )
+                other._flush( restarted.journal.size )
+        finally:
+            os.fdatasync = fdatasync
+        replayed = [ ]
+        self.assertEquals( other.replay( lambda jobStoreID, changes: replayed.extend( changes ) ),
+                           [ batchjob.jobStoreID ] )
+        self.assertEquals( replayed, [ ( 0, str( i ) ) for i in xrange( 4 ) ] )
+        other.close( )
+        # A checkpoint empties the log, its records are on disk
+        restarted.journal.maxSize = 0
+        batchjob.command = "3"
+        restarted.update( batchjob )
+        self.assertEquals( os.path.getsize( restarted.journal.logPath ), 0 )
+        self.assertEquals( restarted.journal.replay( lambda jobStoreID, changes: None ), [ ] )
+        self.assertEquals( restarted.load( batchjob.jobStoreID ), batchjob )
+
+    @contextmanager
+    def _countMetadataCalls( self ):
+        counts = Counter( )
+        functions = dict( ( name, getattr( os, name ) )
+                          for name in ( 'stat', 'lstat', 'remove', 'rename', 'mkdir', 'listdir', 'link' ) )
+
+        def counter( name, function ):
+            def wrapper( *args, **kwargs ):
+                counts[ name ] += 1
+                return function( *args, **kwargs )
+            return wrapper
+
+        for name, function in functions.iteritems( ):
+            setattr( os, name, counter( name, function ) )
+        try:
+            yield counts
+        finally:
+            for name, function in functions.iteritems( ):
+                setattr( os, name, function )
+
+
+class MemoryJobStoreTest( hidden.AbstractJobStoreTest ):
+    def createJobStore( self, config=None ):
+        return MemoryJobStore( self.namePrefix, config )
+
+
+class SQLiteJobStoreTest( hidden.AbstractJobStoreTest ):
+    def createJobStore( self, config=None ):
+        return SQLiteJobStore( self.namePrefix, config )
+
+    def testBatch( self ):
+        """
+        Tests that the changes made in a batch are made together, or not at all if it fails,
+        and that the files of a batchjob are deleted with it.
+        """
+        worker = self.createJobStore( )
+        jobStoreIDs = lambda batchjobs: sorted( j.jobStoreID for j in batchjobs )
+        with self.master.batch( ):
+            batchjobs = [ self.master.create( str( i ), 2, 3, 4, 0 ) for i in xrange( 3 ) ]
+            fileID = self.master.getEmptyFileStoreID( batchjobs[ 0 ].jobStoreID )
+            # Uncommitted changes are not seen by others, who can write meanwhile, as the
+            # database isn't locked until the batch ends
+            self.assertFalse( worker.exists( batchjobs[ 0 ].jobStoreID ) )
+            worker.delete( worker.create( "other", 2, 3, 4, 0 ).jobStoreID )
+        self.assertEquals( jobStoreIDs( worker.jobs( ) ), jobStoreIDs( batchjobs ) )
+        try:
+            with self.master.batch( ):
+                self.master.delete( batchjobs[ 0 ].jobStoreID )
+                self.master.create( "failed", 2, 3, 4, 0 )
+                with self.master.writeFileStream( batchjobs[ 1 ].jobStoreID ) as ( f, failedID ):
+                    f.write( "failed" )
+                raise RuntimeError( )
+        except RuntimeError:
+            pass
+        self.assertEquals( sorted( worker.jobs( ), key=lambda j: j.jobStoreID ),
+                           sorted( batchjobs, key=lambda j: j.jobStoreID ) )
+        self.assertTrue( worker.fileExists( fileID ) )
+        # The blobs of the files written in the failed batch are removed
+        self.assertFalse( os.path.exists( self.master._getBlobPath( failedID ) ) )
+        localPath = worker.getLocalFilePath( fileID )
+        self.master.delete( batchjobs[ 0 ].jobStoreID )
+        self.assertFalse( worker.fileExists( fileID ) )
+        self.assertFalse( os.path.exists( localPath ) )
+
+    def testStatsQueue( self ):
+        """
+        Tests that stats/logging strings are read once, in the order they were written.
+        """
+        read = [ ]
+        readFn = lambda f: read.append( f.read( ) )
+        worker = self.createJobStore( )
+        worker.pageSize = 3
+        for i in xrange( 10 ):
+            ( worker if i % 2 else self.master ).writeStatsAndLogging( str( i ) )
+        self.assertEquals( worker.readStatsAndLogging( readFn ), 10 )
+        self.assertEquals( self.master.readStatsAndLogging( readFn ), 0 )
+        self.assertEquals( read, map( str, xrange( 10 ) ) )
+
+    def testWorkflow( self ):
+        """
+        Tests running a workflow whose store is given by a "sqlite:" locator.
+        """
+        tempDir = tempfile.mkdtemp( )
+        self.addCleanup( shutil.rmtree, tempDir )
+        outFile = os.path.join( tempDir, "out" )
+        options = Job.Runner.getDefaultOptions( )
+        options.toil = "sqlite:" + os.path.join( tempDir, "toil.db" )
+        self.assertEquals( Job.Runner.startToil( Job.wrapJobFn( fanOut, outFile ), options ), 0 )
+        Job.Runner.cleanup( options )
+        with open( outFile, 'r' ) as f:
+            self.assertEquals( f.read( ), str( sum( i * i for i in xrange( 5 ) ) ) )
+        self.assertEquals( os.listdir( tempDir ), [ "out" ] )
+
 
 class AWSJobStoreTest( hidden.AbstractJobStoreTest ):
     testRegion = "us-west-2"
@@ -380,3 +965,16 @@ class AWSJobStoreTest( hidden.AbstractJobStoreTest ):
         AWSJobStore._s3_part_size = 5 * 1024 * 1024
         return AWSJobStore(self.testRegion, self.namePrefix , config )
 
+
+def fanOut( job, outFile ):
+    values = [ job.addChildFn( square, i ).rv( ) for i in xrange( 5 ) ]
+    job.addFollowOnFn( report, outFile, *values )
+
+
+def square( i ):
+    return i * i
+
+
+def report( outFile, *values ):
+    with open( outFile, 'w' ) as f:
+        f.write( str( sum( values ) ) )
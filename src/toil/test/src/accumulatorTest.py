@@ -0,0 +1,99 @@
+import os
+import operator
+import xml.etree.cElementTree as ET
+from toil.lib.bioio import getTempFile
+from toil.job import Job
+from toil import accumulator
+from toil.accumulator import Accumulator, AccumulatorMerger
+from toil.test import ToilTest
+
+class AccumulatorTest(ToilTest):
+    """
+    Tests accumulators, values aggregated across jobs
+    """
+    def testMerging(self):
+        """
+        Tests that the additions of succeeded jobs are sent in the stats and
+        merged, and that those of failed jobs are discarded.
+        """
+        class JobStore(object):
+            def __init__(self):
+                self.sharedFiles = set()
+            def readSharedFileStream(self, sharedFileName):
+                if sharedFileName not in self.sharedFiles:
+                    raise IOError(2, "No such file")
+                return open(os.devnull)
+            def writeSharedFileStream(self, sharedFileName):
+                self.sharedFiles.add(sharedFileName)
+                return open(os.devnull, 'w')
+        reads = Accumulator("reads", 0, operator.add)
+        names = Accumulator("names", frozenset(), operator.or_)
+        unused = Accumulator("unused", 10, operator.add)
+        jobStore = JobStore()
+        merger = AccumulatorMerger(jobStore)
+        usedCheck = accumulator.UsedCheck(jobStore)
+        self.assertFalse(usedCheck())
+        for i in xrange(3):
+            accumulator.discardJobUpdates()
+            if i == 0:
+                accumulator.declare(unused)
+            reads.add(i)
+            reads.add(1)
+            names.add(frozenset([ "job%i" % i ]))
+            #The second job fails
+            if i != 1:
+                accumulator.commitJobUpdates()
+            if i > 0:
+                stats = ET.Element("worker")
+                accumulator.addUpdatesToStats(stats, jobStore)
+                merger.addStats(stats)
+        self.assertFalse(accumulator.hasUpdates())
+        #The leader is told to wait for the additions
+        self.assertTrue(accumulator.isUsed(jobStore))
+        #The negative result cached by the leader has expired by the time the
+        #worker marking the use has exited
+        self.assertTrue(usedCheck())
+        self.assertEquals(merger.values, { "reads": 4, "names": frozenset([ "job0", "job2" ]),
+                                           "unused": 10 })
+
+    def testAccumulatorWorkflow(self):
+        """
+        Tests that a follow-on reads the additions of the children of its
+        predecessor, including a child that was retried, and that the final
+        values can be read once the toil has finished.
+        """
+        tempDir = self._createTempDir()
+        outFile = getTempFile(rootDir=tempDir)
+        options = Job.Runner.getDefaultOptions()
+        options.toil = os.path.join(tempDir, "jobStore")
+        options.logLevel = "INFO"
+        options.retryCount = 1
+        t = Job.wrapJobFn(countReads, outFile)
+        self.assertEquals(Job.Runner.startToil(t, options), 0)
+        self.assertEquals(Job.Runner.getAccumulatorValues(options),
+                          { "reads": 1100, "longest": 9 })
+        Job.Runner.cleanup(options)
+        with open(outFile, 'r') as fileHandle:
+            self.assertEquals(fileHandle.read(), "1000 9")
+
+def countReads(job, outFile):
+    reads = job.fileStore.accumulator("reads")
+    longest = job.fileStore.accumulator("longest", 0, max)
+    for i in xrange(10):
+        job.addChildJobFn(countChunk, reads, longest, i, outFile)
+    job.addFollowOnJobFn(reportReads, reads, longest, outFile)
+
+def countChunk(job, reads, longest, i, outFile):
+    reads.add(100)
+    longest.add(i)
+    #The first child fails once, after adding to the accumulators
+    if i == 0 and not os.path.exists(outFile + ".failed"):
+        open(outFile + ".failed", 'w').close()
+        raise RuntimeError("Failing the job once")
+
+def reportReads(job, reads, longest, outFile):
+    os.remove(outFile + ".failed")
+    with open(outFile, 'w') as fileHandle:
+        fileHandle.write("%i %i" % (job.fileStore.readAccumulator(reads),
+                                    job.fileStore.readAccumulator(longest)))
+    reads.add(100)
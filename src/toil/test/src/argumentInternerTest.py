@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+from xml.etree.cElementTree import Element
+from toil.lib.bioio import getTempFile
+from toil.job import Job, ArgumentInterner
+from toil.jobStores.fileJobStore import FileJobStore
+from toil.test import ToilTest
+
+class ArgumentInternerTest(ToilTest):
+    """
+    Tests the interning of large arguments shared by jobs
+    """
+    def testInterning(self):
+        """
+        Tests that a large argument shared by jobs, or equal arguments, are
+        stored once, and that each loaded job gets its own copy.
+        """
+        tempDir = tempfile.mkdtemp()
+        try:
+            config = Element("config")
+            config.attrib["try_count"] = "1"
+            jobStore = FileJobStore(os.path.join(tempDir, "jobStore"), config=config)
+            batchjob = jobStore.create("command", 1, 1, 1)
+            interner = ArgumentInterner(jobStore, batchjob.jobStoreID)
+            table = [ str(i) for i in xrange(10000) ]
+            pickles = []
+            for i in xrange(3):
+                pickles.append(StringIO())
+                interner.dump(Job.wrapJobFn(f, table, i, small="x"), pickles[-1])
+            pickles.append(StringIO())
+            interner.dump(Job.wrapJobFn(f, list(table), table, table=list(table)), pickles[-1])
+            #The table and its copies are stored once and not in the job pickles
+            self.assertEquals(len(interner.hashes), 1)
+            for pickle in pickles:
+                self.assertTrue(len(pickle.getvalue()) < ArgumentInterner.minSize)
+            jobs = [ ArgumentInterner.loadJob(StringIO(pickle.getvalue()), jobStore)
+                     for pickle in pickles ]
+            for i, job in enumerate(jobs[:3]):
+                self.assertEquals(job._args, (table, i))
+                self.assertEquals(job._kwargs, { "small": "x" })
+            self.assertEquals(jobs[3]._args, (table, table))
+            self.assertEquals(jobs[3]._kwargs, { "table": table })
+            #Each job has its own copy of the argument
+            self.assertFalse(jobs[0]._args[0] is jobs[1]._args[0])
+            #Distinct arguments with the same pickle are loaded as distinct
+            #objects
+            self.assertFalse(jobs[3]._args[0] is jobs[3]._kwargs["table"])
+            #But an argument used twice by a job is loaded once
+            pickle = StringIO()
+            interner.dump(Job.wrapJobFn(f, table, table), pickle)
+            job = ArgumentInterner.loadJob(StringIO(pickle.getvalue()), jobStore)
+            self.assertTrue(job._args[0] is job._args[1])
+        finally:
+            shutil.rmtree(tempDir)
+
+    def testSharedArgumentWorkflow(self):
+        """
+        Tests a workflow whose jobs share a large argument.
+        """
+        tempDir = self._createTempDir()
+        outFile = getTempFile(rootDir=tempDir)
+        options = Job.Runner.getDefaultOptions()
+        options.toil = os.path.join(tempDir, "jobStore")
+        options.logLevel = "INFO"
+        self.assertEquals(Job.Runner.startToil(Job.wrapJobFn(makeChildren, outFile),
+                                               options), 0)
+        Job.Runner.cleanup(options)
+        with open(outFile, 'r') as fileHandle:
+            self.assertEquals(sorted(fileHandle.read().split()), map(str, range(10)))
+
+def f(*args, **kwargs):
+    pass
+
+def makeChildren(job, outFile):
+    regions = [ ("chr1", i, i + 100) for i in xrange(10000) ]
+    for i in xrange(10):
+        job.addChildJobFn(checkRegions, regions, i, outFile)
+
+def checkRegions(job, regions, i, outFile):
+    assert regions == [ ("chr1", j, j + 100) for j in xrange(10000) ]
+    with open(outFile, 'a') as fileHandle:
+        fileHandle.write("%i\n" % i)
@@ -4,6 +4,7 @@
 
 import unittest
 import os
+import marshal
 from toil.lib.bioio import system
 from optparse import OptionParser
 from toil.common import setupToil
@@ -70,5 +71,42 @@ class JobTest(ToilTest):
         
         ###TODO test other functionality
 
+    def testSetupJobAfterFailure(self):
+        """
+        Tests that memory is escalated geometrically when a batchjob runs out of memory.
+        """
+        config = self.jobStore.config
+        defaultMemory = float(config.attrib["default_memory"])
+        j = BatchJob("command", defaultMemory / 4, 1, 1, 100, 3, 1000, 0)
+        #A failure for another reason only raises the memory to the default
+        j.setupJobAfterFailure(config)
+        self.assertEquals(j.memory, defaultMemory)
+        self.assertEquals(j.remainingRetryCount, 2)
+        #Running out of memory multiplies the memory
+        j.setupJobAfterFailure(config, outOfMemory=True)
+        self.assertEquals(j.memory, defaultMemory * BatchJob.memoryEscalationFactor)
+        j.setupJobAfterFailure(config, outOfMemory=True)
+        self.assertEquals(j.memory, defaultMemory * BatchJob.memoryEscalationFactor ** 2)
+        self.assertEquals(j.remainingRetryCount, 0)
+
+    def testSerialisation(self):
+        """
+        Tests that batchjobs survive being serialised, in the current and the 
+        earlier format.
+        """
+        j = BatchJob("command", 2.5 * 2**30, 0.5, 2**31, "a/b/job", 3, "update", 2,
+                     jobsToDelete=["update2"], predecessorsFinished=set(("p1", "p2")),
+                     stack=[[("c/job", 2**31, 1, 2**31, None), ("d/job", 1, 2, 3, "p3")]],
+                     logJobStoreFileID="log", gangs=[("c/job", ("start",), ("d/job",))])
+        self.assertFalse(hasattr(j, "__dict__"))
+        data = j.toBytes()
+        self.assertEquals(BatchJob.fromBytes(data), j)
+        self.assertTrue(len(data) < len(marshal.dumps(j.toDict())))
+        self.assertEquals(BatchJob.fromBytes(marshal.dumps(j.toDict())), j)
+        self.assertEquals(j.copy(), j)
+        #A batchjob of an unknown version is not read
+        self.assertRaises(RuntimeError, BatchJob.fromBytes,
+                          data[:4] + chr(BatchJob.serialisationVersion + 1) + data[5:])
+
 if __name__ == '__main__':
     unittest.main()
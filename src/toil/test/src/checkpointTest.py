@@ -0,0 +1,78 @@
+import os
+import signal
+import time
+from toil.job import Job, JobTerminatedException, _WorkerTermination
+from toil.test import ToilTest
+
+class CheckpointTest(ToilTest):
+    """
+    Tests jobs resuming from checkpoints when retried
+    """
+    def testRestoreAfterFailure(self):
+        """
+        Tests that a failed job resumes from its last checkpoint, including
+        the files it refers to.
+        """
+        self.assertEquals(self.runJobFn(countWithFailure, retryCount=1).split("\n"),
+                          [ "restored 5 data", "done 10" ])
+
+    def testRestoreAfterKill(self):
+        """
+        Tests that a job killed by the leader for running too long is sent
+        SIGTERM, can checkpoint and then resumes from the checkpoint.
+        """
+        self.assertEquals(self.runJobFn(countUntilKilled, retryCount=1, jobTime=0.1,
+                                        maxJobDuration=1, rescueJobsFrequency=1,
+                                        killGracePeriod=10).split("\n"),
+                          [ "terminated", "restored", "done" ])
+
+    def testDeferredTermination(self):
+        """
+        Tests that SIGTERM received by a worker outside of the code of a job 
+        only raises the exception once the next job starts.
+        """
+        termination = _WorkerTermination()
+        previousHandler = signal.signal(signal.SIGTERM, termination.handleSignal)
+        try:
+            os.kill(os.getpid(), signal.SIGTERM)
+            time.sleep(0.1)
+            self.assertEquals(termination.signalNumber, signal.SIGTERM)
+            with self.assertRaises(JobTerminatedException):
+                with termination.runningJob():
+                    self.fail("The job was run")
+        finally:
+            signal.signal(signal.SIGTERM, previousHandler)
+
+def countWithFailure(job, outFile):
+    checkpoint = job.fileStore.restoreCheckpoint()
+    if checkpoint is None:
+        i = 0
+    else:
+        (i,), (fileStoreID,) = checkpoint
+        with job.fileStore.readGlobalFileStream(fileStoreID) as fileHandle:
+            with open(outFile, 'a') as outFileHandle:
+                outFileHandle.write("restored %i %s\n" % (i, fileHandle.read()))
+    while i < 10:
+        i += 1
+        if i == 5 and checkpoint is None:
+            with job.fileStore.writeGlobalFileStream() as (fileHandle, fileStoreID):
+                fileHandle.write("data")
+            #Replaces an earlier checkpoint
+            job.fileStore.checkpoint((0,))
+            job.fileStore.checkpoint((i,), [ fileStoreID ])
+            raise RuntimeError("Failing after the checkpoint")
+    with open(outFile, 'a') as outFileHandle:
+        outFileHandle.write("done %i" % i)
+
+def countUntilKilled(job, outFile):
+    if job.fileStore.restoreCheckpoint() is not None:
+        with open(outFile, 'a') as fileHandle:
+            fileHandle.write("restored\ndone")
+        return
+    try:
+        time.sleep(600)
+    except JobTerminatedException:
+        job.fileStore.checkpoint("state")
+        with open(outFile, 'a') as fileHandle:
+            fileHandle.write("terminated\n")
+        raise
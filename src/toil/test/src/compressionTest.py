@@ -0,0 +1,109 @@
+import os
+from StringIO import StringIO
+from toil.lib.bioio import getTempFile
+from toil.lib.compression import (CompressingWriter, openDecompressed, getCodec,
+                                  codecNames, decompressFile)
+from toil.job import Job
+from toil.test import ToilTest
+
+class CompressionTest(ToilTest):
+    """
+    Tests the compression of global files and job pickles
+    """
+    def availableCodecs(self):
+        codecs = []
+        for codec in codecNames[1:]:
+            try:
+                codecs.append(getCodec(codec))
+            except ValueError:
+                pass
+        return codecs
+
+    def testRoundTrip(self):
+        """
+        Tests that data compressed with each codec reads back unchanged,
+        whether read in lines, in chunks or all at once.
+        """
+        data = "".join("line %i\n" % i for i in xrange(100000)) + "no newline"
+        for codec in self.availableCodecs():
+            compressed = StringIO()
+            writer = CompressingWriter(compressed, codec)
+            writer.write(data)
+            writer.close()
+            self.assertTrue(len(compressed.getvalue()) < len(data) / 4)
+            compressed.seek(0)
+            self.assertEquals(openDecompressed(compressed).read(), data)
+            compressed.seek(0)
+            self.assertEquals("".join(openDecompressed(compressed)), data)
+            compressed.seek(0)
+            reader = openDecompressed(compressed)
+            self.assertEquals(reader.read(7) + reader.readline() + reader.read(), data)
+        self.assertRaises(ValueError, getCodec, "gzip")
+
+    def testUncompressed(self):
+        """
+        Tests that uncompressed data is passed through, whether or not the
+        file handle can be rewound.
+        """
+        data = "uncompressed data"
+        fileHandle = StringIO(data)
+        self.assertTrue(openDecompressed(fileHandle) is fileHandle)
+        self.assertEquals(fileHandle.read(), data)
+        class UnseekableFile(object):
+            def __init__(self, data):
+                self.fileHandle = StringIO(data)
+            def read(self, size=-1):
+                return self.fileHandle.read(size)
+        self.assertEquals(openDecompressed(UnseekableFile(data)).read(), data)
+        self.assertEquals(openDecompressed(UnseekableFile("")).read(), "")
+        tempDir = self._createTempDir()
+        tempFile = getTempFile(rootDir=tempDir)
+        with open(tempFile, 'w') as fileHandle:
+            fileHandle.write(data)
+        self.assertFalse(decompressFile(tempFile))
+
+    def testCompressedWorkflow(self):
+        """
+        Tests a workflow whose jobs and global files are compressed by
+        default, and with a per-file codec.
+        """
+        tempDir = self._createTempDir()
+        outFile = getTempFile(rootDir=tempDir)
+        options = Job.Runner.getDefaultOptions()
+        options.toil = os.path.join(tempDir, "jobStore")
+        options.logLevel = "INFO"
+        options.compression = "zlib"
+        t = Job.wrapJobFn(writeFiles, outFile)
+        self.assertEquals(Job.Runner.startToil(t, options), 0)
+        Job.Runner.cleanup(options)
+        with open(outFile, 'r') as fileHandle:
+            self.assertEquals(fileHandle.read(), "ok")
+
+data = "".join("chr1\t%i\tA\tT\n" % i for i in xrange(10000))
+
+def writeFiles(job, outFile):
+    localFile = os.path.join(job.fileStore.getLocalTempDir(), "data")
+    with open(localFile, 'w') as fileHandle:
+        fileHandle.write(data)
+    fileStoreIDs = [ job.fileStore.writeGlobalFile(localFile),
+                     job.fileStore.writeGlobalFile(localFile, compression="bz2"),
+                     job.fileStore.writeGlobalFile(localFile, compression="none") ]
+    with job.fileStore.writeGlobalFileStream() as (fileHandle, fileStoreID):
+        fileHandle.write(data)
+    fileStoreIDs.append(fileStoreID)
+    job.addChildJobFn(readFiles, fileStoreIDs, outFile)
+
+def readFiles(job, fileStoreIDs, outFile):
+    sizes = []
+    for fileStoreID in fileStoreIDs:
+        with open(job.fileStore.readGlobalFile(fileStoreID), 'r') as fileHandle:
+            assert fileHandle.read() == data
+        with job.fileStore.readGlobalFileStream(fileStoreID) as fileHandle:
+            assert fileHandle.read() == data
+        with job.fileStore.jobStore.readFileStream(fileStoreID) as fileHandle:
+            sizes.append(len(fileHandle.read()))
+    #Only the file written with compression="none" is stored uncompressed
+    assert sizes[2] == len(data)
+    assert max(sizes[:2] + sizes[3:]) < len(data) / 4
+    with open(outFile, 'w') as fileHandle:
+        fileHandle.write("ok")
@@ -0,0 +1,193 @@
+import os
+import shutil
+import xml.etree.cElementTree as ET
+from toil.job import Job, _getImportHolderID
+from toil.common import loadJobStore
+from toil.broadcast import Broadcasts, getBroadcastDir, markWorkflowFinished, \
+    markWorkflowRunning, removeFinishedBroadcastDirs, _finishedFileName
+from toil.test import ToilTest
+
+class FileStoreTest(ToilTest):
+    """
+    Tests the functions of Job.FileStore for reading global files
+    """
+    def testReadGlobalFileBuffer(self):
+        """
+        Tests reading uncompressed, compressed and empty files with
+        readGlobalFileBuffer.
+        """
+        self.assertEquals(self.runJobFn(readBuffers), "ok")
+    
+    def testRangedReads(self):
+        """
+        Tests reading ranges of uncompressed and compressed files with
+        readGlobalFileStream and readGlobalFile.
+        """
+        self.assertEquals(self.runJobFn(readRanges), "ok")
+    
+    def testBroadcast(self):
+        """
+        Tests that jobs broadcasting a file share a single copy of it, which
+        is removed once the toil has finished.
+        """
+        lines = self.runJobFn(broadcastFile).splitlines(True)
+        #The broadcast directory and one line per child
+        self.assertEquals(len(lines), 6)
+        self.assertFalse(os.path.exists(lines[0][:-1]))
+        #All the children used the same copy
+        self.assertEquals(len(set(lines[1:])), 1)
+    
+    def testRemoveFinishedBroadcastDirs(self):
+        """
+        Tests that the broadcast directories of workflows marked as finished
+        are removed from the node, and those of running workflows are kept.
+        """
+        jobStoreDir = self._createTempDir()
+        class JobStore(object):
+            def writeSharedFileStream(self, sharedFileName):
+                return open(os.path.join(jobStoreDir, sharedFileName), 'w')
+        configs = []
+        for rootJob in ("own", "running", "finished"):
+            config = ET.Element("config")
+            config.attrib["job_store"] = jobStoreDir
+            config.attrib["rootJob"] = rootJob
+            Broadcasts(config)._makeDir()
+            configs.append(config)
+        try:
+            markWorkflowFinished(configs[2], JobStore())
+            removeFinishedBroadcastDirs(configs[0], minInterval=0)
+            self.assertEquals([ os.path.exists(getBroadcastDir(config)) for config in configs ],
+                              [ True, True, False ])
+        finally:
+            for config in configs:
+                shutil.rmtree(getBroadcastDir(config), ignore_errors=True)
+    
+    def testFailedWorkflowMarkedFinished(self):
+        """
+        Tests that a workflow is marked as finished when its leader exits
+        after a failure, and no longer once it is restarted.
+        """
+        tempDir = self._createTempDir()
+        options = Job.Runner.getDefaultOptions()
+        options.toil = os.path.join(tempDir, "jobStore")
+        options.logLevel = "INFO"
+        options.retryCount = 0
+        self.assertEquals(Job.Runner.startToil(Job.wrapFn(fail), options), 1)
+        jobStore = loadJobStore(options.toil)
+        finishedFile = os.path.join(options.toil,
+                                    _finishedFileName(jobStore.config.attrib["rootJob"]))
+        self.assertTrue(os.path.exists(finishedFile))
+        markWorkflowRunning(jobStore.config, jobStore)
+        self.assertFalse(os.path.exists(finishedFile))
+        Job.Runner.cleanup(options)
+    
+    def testImportExportFiles(self):
+        """
+        Tests importing files before the toil starts, exporting files from a
+        job and exporting the imported files once the toil has finished.
+        """
+        tempDir = self._createTempDir()
+        inputFiles = []
+        for i in xrange(3):
+            inputFiles.append(os.path.join(tempDir, "input%i" % i))
+            with open(inputFiles[-1], 'w') as fileHandle:
+                fileHandle.write(data[i:])
+        options = Job.Runner.getDefaultOptions()
+        options.toil = os.path.join(tempDir, "jobStore")
+        options.logLevel = "INFO"
+        fileStoreIDs = Job.Runner.importFiles(inputFiles[:2], options)
+        fileStoreIDs += Job.Runner.importFiles(inputFiles[2:], options)
+        t = Job.wrapJobFn(exportFiles, fileStoreIDs, tempDir)
+        self.assertEquals(Job.Runner.startToil(t, options), 0)
+        for i in xrange(3):
+            with open(os.path.join(tempDir, "output%i" % i), 'r') as fileHandle:
+                self.assertEquals(fileHandle.read(), data[i:][::-1])
+        #The imported files were updated by the job
+        exportedFiles = Job.Runner.exportFiles(fileStoreIDs, "file:" + tempDir, options)
+        for i, exportedFile in enumerate(exportedFiles):
+            with open(exportedFile, 'r') as fileHandle:
+                self.assertEquals(fileHandle.read(), "updated%i" % i)
+        #The imports share the batchjob holding their files, which is removed with them
+        jobStore = loadJobStore(options.toil)
+        self.assertEquals(len(list(jobStore.jobs())), 1)
+        Job.Runner.deleteImportedFiles(options)
+        self.assertEquals(list(jobStore.jobs()), [])
+        self.assertIsNone(_getImportHolderID(jobStore, create=False))
+        self.assertFalse(any(jobStore.fileExists(fileStoreID)
+                             for fileStoreID in fileStoreIDs))
+        Job.Runner.cleanup(options)
+
+data = "".join("%08i\n" % i for i in xrange(100000))
+
+def writeData(job, data, compression=None):
+    with job.fileStore.writeGlobalFileStream(compression) as (fileHandle, fileStoreID):
+        fileHandle.write(data)
+    return fileStoreID
+
+def exportFiles(job, fileStoreIDs, destDir):
+    outputFileStoreIDs = []
+    for i, fileStoreID in enumerate(fileStoreIDs):
+        with job.fileStore.readGlobalFileStream(fileStoreID) as fileHandle:
+            assert fileHandle.read() == data[i:]
+        outputFileStoreIDs.append(writeData(job, data[i:][::-1], compression="none"))
+        with job.fileStore.updateGlobalFileStream(fileStoreID) as fileHandle:
+            fileHandle.write("updated%i" % i)
+    job.fileStore.exportFiles(outputFileStoreIDs, destDir,
+                              [ "output%i" % i for i in xrange(3) ], threads=2)
+
+def broadcastFile(job, outFile):
+    with open(outFile, 'w') as fileHandle:
+        fileHandle.write(getBroadcastDir(job.fileStore.jobStore.config) + "\n")
+    fileStoreID = writeData(job, data, compression="zlib")
+    for i in xrange(5):
+        job.addChildJobFn(readBroadcastFile, fileStoreID, outFile)
+
+def readBroadcastFile(job, fileStoreID, outFile):
+    localFilePath = job.fileStore.broadcast(fileStoreID)
+    with open(localFilePath, 'r') as fileHandle:
+        assert fileHandle.read() == data
+    assert job.fileStore.broadcast(fileStoreID, buffer=True)[:] == data
+    fileStat = os.stat(localFilePath)
+    #The local file is a hard link to the node's read-only copy
+    assert fileStat.st_nlink > 1
+    assert not os.access(localFilePath, os.W_OK) or os.getuid() == 0
+    with open(outFile, 'a') as fileHandle:
+        fileHandle.write("%i\n" % fileStat.st_ino)
+
+def readRanges(job, outFile):
+    for compression in ("none", "zlib"):
+        fileStoreID = writeData(job, data, compression)
+        for offset, length in ((0, None), (9 * 5000, 9), (9 * 99999, None),
+                               (9 * 99999, 100), (len(data) + 10, 10), (10, 0)):
+            end = None if length is None else offset + length
+            with job.fileStore.readGlobalFileStream(fileStoreID, offset, length) as fileHandle:
+                assert fileHandle.read() == data[offset:end]
+            localFilePath = job.fileStore.readGlobalFile(fileStoreID, byteRange=(offset, length))
+            with open(localFilePath, 'r') as fileHandle:
+                assert fileHandle.read() == data[offset:end]
+    with open(outFile, 'w') as fileHandle:
+        fileHandle.write("ok")
+
+def readBuffers(job, outFile):
+    fileStoreID = writeData(job, data)
+    buf = job.fileStore.readGlobalFileBuffer(fileStoreID)
+    assert len(buf) == len(data)
+    assert buf[9 * 5000:9 * 5001] == "00005000\n"
+    #The buffer of a file in a FileJobStore maps the file in the jobStore
+    jobStorePath = job.fileStore.jobStore.getLocalFilePath(fileStoreID)
+    assert not os.listdir(job.fileStore.getLocalTempDir())
+    assert os.path.exists(jobStorePath)
+    try:
+        buf[0] = "x"
+    except TypeError:
+        pass
+    else:
+        assert False, "The buffer is writable"
+    buf = job.fileStore.readGlobalFileBuffer(writeData(job, data, compression="zlib"))
+    assert buf[:] == data
+    assert job.fileStore.readGlobalFileBuffer(writeData(job, "")) == ""
+    with open(outFile, 'w') as fileHandle:
+        fileHandle.write("ok")
+
+def fail():
+    raise RuntimeError("Failing the job")
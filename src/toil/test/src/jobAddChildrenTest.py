@@ -0,0 +1,60 @@
+import os
+from toil.lib.bioio import getTempFile
+from toil.job import Job
+from toil.test import ToilTest
+
+class JobAddChildrenTest(ToilTest):
+    """
+    Tests testing Job.addChildren
+    """
+    def testAddChildren(self):
+        """
+        Tests that children produced by a generator, including their
+        successors and promised return values, are all run.
+        """
+        #Temporary file
+        tempDir = self._createTempDir()
+        outFile = getTempFile(rootDir=tempDir)
+        #Create a job that lazily creates more children than fit in one batch
+        t = GeneratorJob(10, outFile)
+        t.addFollowOnFn(f, "x", outFile)
+        #Create the runner for the workflow.
+        options = Job.Runner.getDefaultOptions()
+        options.toil = os.path.join(tempDir, "jobStore")
+        options.logLevel = "INFO"
+        #Run the workflow, the return value being the number of failed jobs
+        self.assertEquals(Job.Runner.startToil(t, options), 0)
+        Job.Runner.cleanup(options) #This removes the jobStore
+        #Check output, each child's follow-on writes the child's return value
+        #and the follow-on of the generating job runs last
+        output = open(outFile, 'r').readline()
+        self.assertEquals(sorted(output[:-1]), map(str, range(10)))
+        self.assertEquals(output[-1], "x")
+
+class GeneratorJob(Job):
+    #Use a small batch size to exercise the batching
+    lazyChildBatchSize = 3
+
+    def __init__(self, numberOfChildren, outFile):
+        Job.__init__(self)
+        self.numberOfChildren = numberOfChildren
+        self.outFile = outFile
+
+    def run(self, fileStore):
+        self.addChildren(self.children())
+
+    def children(self):
+        for i in xrange(self.numberOfChildren):
+            child = Job.wrapFn(identity, str(i))
+            child.addFollowOnFn(f, child.rv(), self.outFile)
+            yield child
+
+def identity(string):
+    return string
+
+def f(string, outFile):
+    """
+    Function appends string to output file
+    """
+    with open(outFile, 'a') as fH:
+        fH.write(string)
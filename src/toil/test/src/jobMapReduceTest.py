@@ -0,0 +1,57 @@
+import os
+from toil.lib.bioio import getTempFile
+from toil.job import Job
+from toil.test import ToilTest
+
+class JobMapReduceTest(ToilTest):
+    """
+    Tests testing the Job.mapReduce method, which uses the MapReduceJob class
+    """
+    def testMapReduce(self):
+        """
+        Sums the squares of a range of numbers, with and without a combiner, and with all
+        the inputs in a single chunk.
+        """
+        for combineFn, chunkSize in ((None, 1), (add, 3), (None, 10), (None, 20)):
+            tempDir = self._createTempDir()
+            outFile = getTempFile(rootDir=tempDir)
+            root = Job()
+            mapReduce = root.addChild(Job.mapReduce(square, range(10), add, fanIn=3,
+                                                    combineFn=combineFn, chunkSize=chunkSize))
+            root.addFollowOnFn(writeValue, mapReduce.rv(), outFile)
+            options = Job.Runner.getDefaultOptions()
+            options.toil = os.path.join(tempDir, "jobStore")
+            self.assertEquals(Job.Runner.startToil(root, options), 0)
+            Job.Runner.cleanup(options)
+            with open(outFile, 'r') as fH:
+                self.assertEquals(fH.read(), str(sum(i * i for i in xrange(10))))
+
+    def testMapReduceOrdering(self):
+        """
+        Checks the reduction retains the order of the inputs, so non-commutative
+        reduce functions can be used, and that successors added to the
+        MapReduceJob are run after the reduction.
+        """
+        tempDir = self._createTempDir()
+        outFile = getTempFile(rootDir=tempDir)
+        mapReduce = Job.mapReduce(upper, "abcdefghijklm", add, fanIn=2)
+        mapReduce.addChildFn(writeValue, mapReduce.rv(), outFile)
+        options = Job.Runner.getDefaultOptions()
+        options.toil = os.path.join(tempDir, "jobStore")
+        self.assertEquals(Job.Runner.startToil(mapReduce, options), 0)
+        Job.Runner.cleanup(options)
+        with open(outFile, 'r') as fH:
+            self.assertEquals(fH.read(), "ABCDEFGHIJKLM")
+
+def square(i):
+    return i * i
+
+def upper(c):
+    return c.upper()
+
+def add(i, j):
+    return i + j
+
+def writeValue(value, outFile):
+    with open(outFile, 'w') as fH:
+        fH.write(str(value))
@@ -7,30 +7,29 @@ class JobServiceTest(ToilTest):
     """
     Tests testing the Job.Service class
     """
-    if False:
-        def testService(self):
-            """
-            Tests the creation of a Job.Service.
-            """
-            #Temporary file
-            outFile = getTempFile(rootDir=os.getcwd())
-            #Wire up the services/jobs
-            t = Job.wrapFn(f, "1", outFile)
-            t.addChildFn(f, t.addService(TestService("2", "3", outFile)), outFile)
-            #Create the runner for the workflow.
-            options = Job.Runner.getDefaultOptions()
-            options.logLevel = "INFO"
-            #Run the workflow, the return value being the number of failed jobs
-            self.assertEquals(Job.Runner.startToil(t, options), 0)
-            Job.Runner.cleanup(options) #This removes the jobStore
-            #Check output
-            self.assertEquals(open(outFile, 'r').readline(), "123")
-            #Cleanup
-            os.remove(outFile)
-        
+    def testService(self):
+        """
+        Tests the creation of a Job.Service.
+        """
+        #Temporary file
+        tempDir = self._createTempDir()
+        outFile = getTempFile(rootDir=tempDir)
+        #Wire up the services/jobs
+        t = Job.wrapFn(f, "1", outFile)
+        t.addChildFn(f, t.addService(TestService("2", "3", outFile)), outFile)
+        #Create the runner for the workflow.
+        options = Job.Runner.getDefaultOptions()
+        options.toil = os.path.join(tempDir, "jobStore")
+        options.logLevel = "INFO"
+        #Run the workflow, the return value being the number of failed jobs
+        self.assertEquals(Job.Runner.startToil(t, options), 0)
+        Job.Runner.cleanup(options) #This removes the jobStore
+        #Check output
+        self.assertEquals(open(outFile, 'r').readline(), "123")
+
 class TestService(Job.Service):
     def __init__(self, startString, stopString, outFile):
-        Job.Service.__init__(self)
+        Job.Service.__init__(self, cpu=0.1)
         self.startString = startString
         self.stopString = stopString
         self.outFile = outFile
@@ -0,0 +1,130 @@
+import os
+import time
+from toil.lib.bioio import getTempFile
+from toil.job import Job
+from toil.pipe import Pipe
+from toil.test import ToilTest
+
+class PipeTest(ToilTest):
+    """
+    Tests streaming data between jobs with pipes
+    """
+    def runWorkflow(self, timeout, consumerDelay, local=False, producerFn=None,
+                    consumerFn=None, retryCount=None):
+        tempDir = self._createTempDir()
+        outFile = getTempFile(rootDir=tempDir)
+        job = Job.wrapJobFn(addPipe, timeout, consumerDelay, outFile,
+                            producerFn or produce, consumerFn or consume)
+        failing = producerFn is not None or consumerFn is not None
+        options = Job.Runner.getDefaultOptions()
+        if retryCount is not None:
+            options.retryCount = retryCount
+        if local:
+            self.assertEquals(Job.Runner.runLocal(job, threads=2, options=options) != 0, failing)
+        else:
+            options.toil = os.path.join(tempDir, "jobStore")
+            options.logLevel = "INFO"
+            self.assertEquals(Job.Runner.startToil(job, options) != 0, failing)
+            Job.Runner.cleanup(options)
+        with open(outFile, 'r') as fileHandle:
+            lines = fileHandle.read().split("\n")
+        return lines
+
+    def testStreaming(self):
+        """
+        Tests that the consumer reads the stream from the producer directly.
+        """
+        self.assertEquals(self.runWorkflow(60, 0), [ str(sum(xrange(1000))), "streamed" ])
+
+    def testStreamingInProcess(self):
+        """
+        Tests streaming between jobs run in threads by Job.Runner.runLocal.
+        """
+        self.assertEquals(self.runWorkflow(60, 0, local=True),
+                          [ str(sum(xrange(1000))), "streamed" ])
+
+    def testFallback(self):
+        """
+        Tests that the stream is written to a global file if the consumer does
+        not open the pipe in time.
+        """
+        self.assertEquals(self.runWorkflow(0.5, 3), [ str(sum(xrange(1000))), "fallback" ])
+
+    def testFailedProducer(self):
+        """
+        Tests that the consumer fails, rather than reading a truncated stream, if the producer
+        fails while streaming.
+        """
+        self.assertEquals(self.runWorkflow(60, 0, producerFn=produceHalf, retryCount=0),
+                          [ "truncated" ])
+
+    def testConsumerRetry(self):
+        """
+        Tests that a stream sent through the FIFO is not kept, so the retry of a consumer that
+        fails after reading it fails too.
+        """
+        self.assertEquals(self.runWorkflow(60, 0, consumerFn=consumeAndFail, retryCount=1),
+                          [ str(sum(xrange(1000))), "not kept" ])
+
+    def testAddPipe(self):
+        """
+        Tests the checks on the jobs a pipe is added between.
+        """
+        job, pipe = Job(), Pipe()
+        producer, consumer = job.addChild(Job()), job.addChild(Job())
+        self.assertRaises(RuntimeError, job.addPipe, pipe, producer, Job())
+        self.assertRaises(RuntimeError, job.addPipe, pipe, producer, producer)
+        job.addPipe(pipe, producer, consumer)
+        self.assertRaises(RuntimeError, job.addPipe, pipe, producer, consumer)
+        self.assertRaises(RuntimeError, job.addPipe, Pipe(), consumer, job.addChild(Job()))
+
+def addPipe(job, timeout, consumerDelay, outFile, producerFn, consumerFn):
+    pipe = Pipe(timeout)
+    #Small cpu requirements, so that both jobs can run at once
+    producer = job.addChildJobFn(producerFn, pipe, cpu=0.25)
+    consumer = job.addChildJobFn(consumerFn, pipe, consumerDelay, outFile, cpu=0.25)
+    job.addPipe(pipe, producer, consumer)
+    job.addFollowOnJobFn(checkStreamed, pipe, outFile)
+
+def produce(job, pipe):
+    with job.fileStore.openPipe(pipe, 'w') as fileHandle:
+        for i in xrange(1000):
+            fileHandle.write("%i\n" % i)
+
+def consume(job, pipe, consumerDelay, outFile):
+    time.sleep(consumerDelay)
+    try:
+        with job.fileStore.openPipe(pipe) as fileHandle:
+            total = sum(int(line) for line in fileHandle)
+    except RuntimeError:
+        with open(outFile, 'w') as fileHandle:
+            fileHandle.write("truncated")
+        raise
+    with open(outFile, 'w') as fileHandle:
+        fileHandle.write("%i\n" % total)
+
+def produceHalf(job, pipe):
+    with job.fileStore.openPipe(pipe, 'w') as fileHandle:
+        for i in xrange(500):
+            fileHandle.write("%i\n" % i)
+        fileHandle.flush()
+        raise RuntimeError("Failing the producer")
+
+def consumeAndFail(job, pipe, consumerDelay, outFile):
+    if os.path.exists(outFile) and os.path.getsize(outFile) > 0:
+        #The retry of the consumer
+        try:
+            with job.fileStore.openPipe(pipe) as fileHandle:
+                fileHandle.read()
+        except RuntimeError:
+            with open(outFile, 'a') as fileHandle:
+                fileHandle.write("not kept")
+        raise RuntimeError("Failing the retry of the consumer")
+    consume(job, pipe, consumerDelay, outFile)
+    raise RuntimeError("Failing the consumer")
+
+def checkStreamed(job, pipe, outFile):
+    #The ready file of the pipe is only deleted once the fallback file is written
+    streamed = job.fileStore.jobStore.fileExists(pipe.readyFileStoreID)
+    with open(outFile, 'a') as fileHandle:
+        fileHandle.write("streamed" if streamed else "fallback")
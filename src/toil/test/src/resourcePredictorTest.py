@@ -0,0 +1,94 @@
+import math
+import uuid
+import xml.etree.cElementTree as ET
+from StringIO import StringIO
+from contextlib import contextmanager
+
+from toil.job import Job
+from toil.resourcePredictor import ResourcePredictor, getResourcePredictions
+from toil.test import ToilTest
+
+class ResourcePredictorTest(ToilTest):
+    """
+    Tests the prediction of resource requirements from job stats
+    """
+    def testPredictions(self):
+        predictor = ResourcePredictor()
+        stats = ET.Element("worker")
+        #One hundred jobs of class A using 1 to 100 megabytes and one core, and
+        #too few jobs of class B to make a prediction
+        for i in xrange(1, 101):
+            addJob(stats, "A", memory=i * 1024, clock=i, time=i, disk=i * 1000)
+        for i in xrange(ResourcePredictor.minObservations - 1):
+            addJob(stats, "B", memory=1024, clock=2, time=1, disk=0)
+        predictor.addStats(stats)
+        predictions = predictor.getPredictions()
+        self.assertEquals(predictions.keys(), ["A"])
+        memory, cpu, disk = predictions["A"]
+        #The 95th percentile plus 20% headroom
+        self.assertEquals(memory, int(math.ceil(95 * 1024 * 1024 * 1.2)))
+        self.assertEquals(cpu, 1)
+        self.assertEquals(disk, int(math.ceil(95 * 1000 * 1.2)))
+        #Only the most recent observations are used
+        stats = ET.Element("worker")
+        for i in xrange(ResourcePredictor.maxObservations):
+            addJob(stats, "A", memory=1024, clock=4, time=1, disk=0)
+        predictor.addStats(stats)
+        self.assertEquals(predictor.getPredictions()["A"], (int(math.ceil(1024 * 1024 * 1.2)), 4, 0))
+
+    def testPredictionKeys(self):
+        """
+        Tests that jobs wrapping functions are told apart by the function.
+        """
+        predictor = ResourcePredictor()
+        stats = ET.Element("worker")
+        for predictionKey, memory in (("module.f", 1024), ("module.g", 2048)):
+            for i in xrange(ResourcePredictor.minObservations):
+                addJob(stats, "JobFunctionWrappingJob", memory=memory, clock=1, time=1, disk=0,
+                       predictionKey=predictionKey)
+        predictor.addStats(stats)
+        predictions = predictor.getPredictions()
+        self.assertEquals(sorted(predictions.keys()), ["module.f", "module.g"])
+        self.assertEquals(predictions["module.g"][0], int(math.ceil(2048 * 1024 * 1.2)))
+        self.assertEquals(Job.wrapJobFn(addJob)._getPredictionKey(), "%s.addJob" % __name__)
+        self.assertEquals(Job()._getPredictionKey(), "Job")
+
+    def testReload(self):
+        """
+        Tests that the predictions are reread once the leader may have written
+        new ones.
+        """
+        class JobStore(object):
+            def __init__(self):
+                self.config = ET.Element("config", { "job_store": uuid.uuid4().hex })
+                self.sharedFiles = {}
+            @contextmanager
+            def readSharedFileStream(self, sharedFileName):
+                yield StringIO(self.sharedFiles[sharedFileName])
+            @contextmanager
+            def writeSharedFileStream(self, sharedFileName):
+                fileHandle = StringIO()
+                yield fileHandle
+                self.sharedFiles[sharedFileName] = fileHandle.getvalue()
+        jobStore = JobStore()
+        predictor = ResourcePredictor()
+        self.assertEquals(getResourcePredictions(jobStore), {})
+        for jobClass in ("A", "B"):
+            stats = ET.Element("worker")
+            for i in xrange(ResourcePredictor.minObservations):
+                addJob(stats, jobClass, memory=1024, clock=1, time=1, disk=0)
+            predictor.addStats(stats)
+            predictor.writePredictions(jobStore)
+            #The predictions read are kept until the leader writes new ones
+            self.assertEquals(getResourcePredictions(jobStore), {})
+        self.addCleanup(setattr, ResourcePredictor, "writeInterval",
+                        ResourcePredictor.writeInterval)
+        ResourcePredictor.writeInterval = 0
+        self.assertEquals(sorted(getResourcePredictions(jobStore).keys()), ["A", "B"])
+
+def addJob(stats, jobClass, memory, clock, time, disk, predictionKey=None):
+    attributes = { "class": jobClass, "memory": str(memory), "clock": str(clock),
+                   "time": str(time), "disk": str(disk) }
+    if predictionKey is not None:
+        attributes["predictionKey"] = predictionKey
+    ET.SubElement(stats, "job", attributes)
@@ -0,0 +1,105 @@
+import os
+import time
+from toil.lib.bioio import getTempFile
+from toil.job import Job, JobTerminatedException
+from toil.jobStores.memoryJobStore import MemoryJobStore
+from toil.test import ToilTest
+from toil.test.src.jobServiceTest import TestService
+
+class RunLocalTest(ToilTest):
+    """
+    Tests running workflows in process with Job.Runner.runLocal
+    """
+    def testWorkflow(self):
+        """
+        Tests children, follow-ons, promises, global files and accumulators
+        run in threads, and that the in memory jobStore is removed.
+        """
+        for threads in (1, 4):
+            tempDir = self._createTempDir()
+            outFile = getTempFile(rootDir=tempDir)
+            self.assertEquals(Job.Runner.runLocal(Job.wrapJobFn(fanOut, outFile),
+                                                  threads=threads), 0)
+            with open(outFile, 'r') as fileHandle:
+                self.assertEquals(fileHandle.read(), "%i %i" % (sum(range(10)), 10))
+            self.assertEquals(MemoryJobStore._stores, {})
+
+    def testService(self):
+        """
+        Tests a service and the job using it, which must run at the same time.
+        """
+        tempDir = self._createTempDir()
+        outFile = getTempFile(rootDir=tempDir)
+        t = Job.wrapFn(append, "1", outFile)
+        t.addChildFn(append, t.addService(TestService("2", "3", outFile)), outFile)
+        self.assertEquals(Job.Runner.runLocal(t, threads=2), 0)
+        with open(outFile, 'r') as fileHandle:
+            self.assertEquals(fileHandle.read(), "123")
+
+    def testFailedJob(self):
+        """
+        Tests that a failed job is retried and then counted as failed.
+        """
+        options = Job.Runner.getDefaultOptions()
+        options.retryCount = 1
+        self.assertEquals(Job.Runner.runLocal(Job.wrapFn(fail), threads=2,
+                                              options=options), 1)
+
+    def testKilledJob(self):
+        """
+        Tests that a job killed for running too long is interrupted, and only retried once
+        its thread has exited after checkpointing.
+        """
+        tempDir = self._createTempDir()
+        outFile = getTempFile(rootDir=tempDir)
+        options = Job.Runner.getDefaultOptions()
+        options.retryCount = 1
+        options.jobTime = 0.1
+        options.maxJobDuration = 1
+        options.rescueJobsFrequency = 1
+        self.assertEquals(Job.Runner.runLocal(Job.wrapJobFn(countUntilKilled, outFile),
+                                              threads=2, options=options), 0)
+        with open(outFile, 'r') as fileHandle:
+            self.assertEquals(fileHandle.read(), "terminated\nrestored")
+
+def append(string, outFile):
+    with open(outFile, 'a') as fileHandle:
+        fileHandle.write(string)
+
+def fanOut(job, outFile):
+    count = job.fileStore.accumulator("count")
+    values = []
+    for i in xrange(10):
+        with job.fileStore.writeGlobalFileStream() as (fileHandle, fileStoreID):
+            fileHandle.write(str(i))
+        values.append(job.addChildJobFn(readValue, fileStoreID, count).rv())
+    job.addFollowOnJobFn(report, count, outFile, *values)
+
+def readValue(job, fileStoreID, count):
+    count.add(1)
+    with job.fileStore.readGlobalFileStream(fileStoreID) as fileHandle:
+        return int(fileHandle.read())
+
+def report(job, count, outFile, *values):
+    with open(outFile, 'w') as fileHandle:
+        fileHandle.write("%i %i" % (sum(values), job.fileStore.readAccumulator(count)))
+
+def fail():
+    raise RuntimeError("Failing the job")
+
+def countUntilKilled(job, outFile):
+    if job.fileStore.restoreCheckpoint() is not None:
+        with open(outFile, 'a') as fileHandle:
+            fileHandle.write("restored")
+        return
+    try:
+        #The exception is raised in the thread between the sleeps
+        for i in xrange(6000):
+            time.sleep(0.1)
+    except JobTerminatedException:
+        #The retry must not start before the job has finished checkpointing
+        time.sleep(1)
+        job.fileStore.checkpoint("state")
+        with open(outFile, 'a') as fileHandle:
+            fileHandle.write("terminated\n")
+        raise
@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+from xml.etree.cElementTree import Element
+from toil.lib import transfer
+from toil.jobStores.fileJobStore import FileJobStore
+from toil.test import ToilTest
+
+class TransferTest(ToilTest):
+    """
+    Tests copying files with toil.lib.transfer and by the FileJobStore
+    """
+    def setUp(self):
+        super(TransferTest, self).setUp()
+        self.tempDir = tempfile.mkdtemp()
+        self.srcPath = os.path.join(self.tempDir, "src")
+        self.data = os.urandom(3 * 1024 * 1024 + 7)
+        with open(self.srcPath, 'w') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+        super(TransferTest, self).tearDown()
+
+    def read(self, path):
+        with open(path, 'r') as f:
+            return f.read()
+
+    def testCopyFile(self):
+        """
+        Tests that files are linked only if allowed, and copied otherwise,
+        replacing the destination.
+        """
+        dstPath = os.path.join(self.tempDir, "dst")
+        with open(dstPath, 'w') as f:
+            f.write("old contents, which are longer than nothing")
+        self.assertEquals(transfer.copyFile(self.srcPath, dstPath, allowLink=True), transfer.LINK)
+        self.assertEquals(os.stat(dstPath).st_ino, os.stat(self.srcPath).st_ino)
+        #Copying to a link replaces it, rather than writing through it
+        otherPath = os.path.join(self.tempDir, "other")
+        with open(otherPath, 'w') as f:
+            f.write("other")
+        self.assertNotEquals(transfer.copyFile(otherPath, dstPath), transfer.LINK)
+        self.assertEquals(self.read(dstPath), "other")
+        self.assertEquals(self.read(self.srcPath), self.data)
+        self.assertIn(transfer.copyFile(self.srcPath, dstPath), transfer.strategies[1:])
+        self.assertNotEquals(os.stat(dstPath).st_ino, os.stat(self.srcPath).st_ino)
+        self.assertEquals(self.read(dstPath), self.data)
+
+    def testStrategies(self):
+        """
+        Tests each way of copying the rest of a file, where supported.
+        """
+        for strategy, copyFn in ((transfer.REFLINK, transfer._reflink),
+                                 (transfer.COPY_FILE_RANGE, transfer._copyFileRange),
+                                 (transfer.SENDFILE, transfer._sendfile)):
+            for start in (0, 1000):
+                dstPath = os.path.join(self.tempDir, strategy)
+                with open(self.srcPath, 'r') as src:
+                    with open(dstPath, 'w') as dst:
+                        try:
+                            copied = copyFn(src.fileno(), dst.fileno(), start,
+                                            len(self.data) - start)
+                        except EnvironmentError:
+                            copied = False
+                if copied:
+                    self.assertEquals(self.read(dstPath), self.data[start:])
+        dstPath = os.path.join(self.tempDir, "dst")
+        with open(self.srcPath, 'r') as src:
+            src.seek(1000)
+            with open(dstPath, 'w') as dst:
+                transfer.copyFileObject(src, dst)
+        self.assertEquals(self.read(dstPath), self.data[1000:])
+
+    def testFileJobStore(self):
+        """
+        Tests that the FileJobStore links immutable files and reports how it
+        copied files.
+        """
+        config = Element("config")
+        config.attrib["try_count"] = "1"
+        jobStore = FileJobStore(os.path.join(self.tempDir, "jobStore"), config)
+        batchjob = jobStore.create("command", 1, 1, 1)
+        fileStoreID = jobStore.writeFile(batchjob.jobStoreID, self.srcPath, immutable=True)
+        self.assertEquals(jobStore.getTransferStats(), { transfer.LINK: 1 })
+        localPath = os.path.join(self.tempDir, "local")
+        jobStore.readFile(fileStoreID, localPath)
+        self.assertEquals(self.read(localPath), self.data)
+        self.assertNotEquals(os.stat(localPath).st_ino, os.stat(self.srcPath).st_ino)
+        #Updating the file doesn't change the file it was linked to
+        with open(localPath, 'w') as f:
+            f.write("updated")
+        jobStore.updateFile(fileStoreID, localPath)
+        with jobStore.readFileStream(fileStoreID) as f:
+            self.assertEquals(f.read(), "updated")
+        self.assertEquals(self.read(self.srcPath), self.data)
+        self.assertEquals(sum(jobStore.getTransferStats().values()), 3)
+        #Neither does updating a linked file through a stream
+        fileStoreID = jobStore.writeFile(batchjob.jobStoreID, self.srcPath, immutable=True)
+        with jobStore.updateFileStream(fileStoreID) as f:
+            f.write("updated")
+        self.assertEquals(self.read(self.srcPath), self.data)
+        jobStore.deleteJobStore()
@@ -441,6 +441,10 @@ def reportPrettyData(root, worker, job, job_types, options):
         reportTime(get(root, "total_clock"), options),
         reportTime(get(root, "total_run_time"), options),
         ))
+    transfers = root.find("transfers")
+    if transfers is not None and len(transfers.attrib) > 0:
+        out_str += "File Transfers: %s\n" % "  ".join(
+            "%s: %s" % item for item in sorted(transfers.attrib.items()))
     job_types = sortJobs(job_types, options)
     columnWidths = computeColumnWidths(job_types, worker, job, options)
     out_str += "Worker\n"
@@ -594,6 +598,15 @@ def processData(config, stats, options):
     workers = stats.findall("worker")
     buildElement(collatedStatsTag, workers, "worker")
 
+    # Add the numbers of files copied in each way
+    transfers = {}
+    for worker in workers:
+        for transfersTag in worker.findall("transfers"):
+            for strategy, count in transfersTag.attrib.iteritems():
+                transfers[strategy] = transfers.get(strategy, 0) + int(count)
+    ET.SubElement(collatedStatsTag, "transfers",
+                  dict((strategy, str(count)) for strategy, count in transfers.iteritems()))
+
     # Add aggregated job info
     jobs = []
     for worker in workers:
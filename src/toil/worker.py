@@ -36,6 +36,8 @@ import logging
 import xml.etree.cElementTree as ET
 import cPickle
 import shutil
+import subprocess
+import signal
 
 logger = logging.getLogger( __name__ )
 
@@ -81,7 +83,11 @@ def loadJob(command, jobStore):
     else:
         openFileStream = jobStore.readFileStream( pickleFile )
     with openFileStream as fileHandle:
-        return cPickle.load( fileHandle )
+        #The pickle may have been compressed, see the --compression option,
+        #and may refer to interned arguments
+        from toil.lib.compression import openDecompressed
+        from toil.job import ArgumentInterner
+        return ArgumentInterner.loadJob( openDecompressed( fileHandle ), jobStore )
     
 def nextOpenDescriptor():
     """Gets the number of the next available file descriptor.
@@ -90,127 +96,25 @@ def nextOpenDescriptor():
     os.close(descriptor)
     return descriptor
     
-def main():
-    ########################################## 
-    #Import necessary modules 
-    ##########################################
-    
-    # This is assuming that worker.py is at a path ending in "/toil/worker.py".
-    sourcePath = os.path.dirname(os.path.dirname(__file__))
-    if sourcePath not in sys.path:
-        # FIXME: prepending to sys.path should fix #103
-        sys.path.append(sourcePath)
-    
-    #Now we can import all the necessary functions
-    from toil.lib.bioio import setLogLevel
+def runJobs(jobStore, jobStoreID, localWorkerTempDir, errorFile=None):
+    """
+    Runs the batchjob with the given jobStoreID and then, while it can, its
+    successors, see main. The traceback of a failure is printed to the given 
+    file, or to standard error. Returns a tuple of the batchjob, whether the 
+    worker failed and whether the worker was terminated, see 
+    JobTerminatedException.
+    """
     from toil.lib.bioio import getTotalCpuTime
     from toil.lib.bioio import getTotalCpuTimeAndMemoryUsage
-    from toil.lib.bioio import getTempDirectory
     from toil.lib.bioio import makeSubDir
     from toil.lib.bioio import system
-    from toil.common import loadJobStore
+    from toil import accumulator
+    from toil.job import JobTerminatedException
     
-    ########################################## 
-    #Input args
-    ##########################################
-    
-    jobStoreString = sys.argv[1]
-    jobStoreID = sys.argv[2]
-    
-    ##########################################
-    #Load the jobStore/config file
-    ##########################################
-    
-    jobStore = loadJobStore(jobStoreString)
     config = jobStore.config
-
-    ##########################################
-    #Load the environment for the batchjob
-    ##########################################
-    
-    #First load the environment for the batchjob.
-    with jobStore.readSharedFileStream("environment.pickle") as fileHandle:
-        environment = cPickle.load(fileHandle)
-    for i in environment:
-        if i not in ("TMPDIR", "TMP", "HOSTNAME", "HOSTTYPE"):
-            os.environ[i] = environment[i]
-    # sys.path is used by __import__ to find modules
-    if "PYTHONPATH" in environment:
-        for e in environment["PYTHONPATH"].split(':'):
-            if e != '':
-                sys.path.append(e)
-
-    setLogLevel(config.attrib["log_level"])
-
-    ##########################################
-    #Setup the temporary directories.
-    ##########################################
-        
-    #Dir to put all the temp files in.
-    localWorkerTempDir = getTempDirectory()
-    
-    ##########################################
-    #Setup the logging
-    ##########################################
-
-    #This is mildly tricky because we don't just want to
-    #redirect stdout and stderr for this Python process; we want to redirect it
-    #for this process and all children. Consequently, we can't just replace
-    #sys.stdout and sys.stderr; we need to mess with the underlying OS-level
-    #file descriptors. See <http://stackoverflow.com/a/11632982/402891>
-    
-    #When we start, standard input is file descriptor 0, standard output is
-    #file descriptor 1, and standard error is file descriptor 2.
-
-    #What file do we want to point FDs 1 and 2 to?    
-    tempWorkerLogPath = os.path.join(localWorkerTempDir, "worker_log.txt")
-    
-    #Save the original stdout and stderr (by opening new file descriptors to the
-    #same files)
-    origStdOut = os.dup(1)
-    origStdErr = os.dup(2)
-    
-    #Open the file to send stdout/stderr to.
-    logFh = os.open(tempWorkerLogPath, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
-
-    #Replace standard output with a descriptor for the log file
-    os.dup2(logFh, 1)
-    
-    #Replace standard error with a descriptor for the log file
-    os.dup2(logFh, 2)
-    
-    #Since we only opened the file once, all the descriptors duped from the
-    #original will share offset information, and won't clobber each others'
-    #writes. See <http://stackoverflow.com/a/5284108/402891>. This shouldn't
-    #matter, since O_APPEND seeks to the end of the file before every write, but
-    #maybe there's something odd going on...
-    
-    #Close the descriptor we used to open the file
-    os.close(logFh)
-    
-    for handler in list(logger.handlers): #Remove old handlers
-        logger.removeHandler(handler)
-    
-    #Add the new handler. The sys.stderr stream has been redirected by swapping
-    #the file descriptor out from under it.
-    logger.addHandler(logging.StreamHandler(sys.stderr))
-
-    ##########################################
-    #Worker log file trapped from here on in
-    ##########################################
-
     workerFailed = False
+    workerTerminated = False
     try:
-
-        #Put a message at the top of the log, just to make sure it's working.
-        print "---TOIL WORKER OUTPUT LOG---"
-        sys.stdout.flush()
-        
-        #Log the number of open file descriptors so we can tell if we're leaking
-        #them.
-        logger.debug("Next available file descriptor: {}".format(
-            nextOpenDescriptor()))
-    
         ##########################################
         #Load the batchjob
         ##########################################
@@ -243,7 +147,8 @@ def main():
         #Setup the stats, if requested
         ##########################################
         
-        if config.attrib.has_key("stats"):
+        #Stats are also needed to predict the resource requirements of jobs
+        if config.attrib.has_key("stats") or config.attrib.has_key("predict_resources"):
             startTime = time.time()
             startClock = getTotalCpuTime()
             stats = ET.Element("worker")
@@ -365,12 +270,20 @@ def main():
             m = ET.SubElement(stats, "messages")
             for message in messages:
                 ET.SubElement(m, "message").text = message
+            #The ways files were copied between the jobStore and the node
+            transferStats = jobStore.getTransferStats()
+            if len(transferStats) > 0:
+                ET.SubElement(stats, "transfers", dict((strategy, str(count)) for
+                                                       strategy, count in transferStats.iteritems()))
+            accumulator.addUpdatesToStats(stats, jobStore)
             jobStore.writeStatsAndLogging(ET.tostring(stats))
-        elif len(messages) > 0: #No stats, but still need to report log messages
+        elif len(messages) > 0 or accumulator.hasUpdates(): #No stats, but still 
+            #need to report log messages and additions to accumulators
             l = ET.Element("worker")
             m = ET.SubElement(l, "messages")
             for message in messages:
                 ET.SubElement(m, "message").text = message
+            accumulator.addUpdatesToStats(l, jobStore)
             jobStore.writeStatsAndLogging(ET.tostring(l))
         
         logger.info("Finished running the chain of jobs on this node, we ran for a total of %f seconds", time.time() - startTime)
@@ -379,11 +292,193 @@ def main():
     #Trapping where worker goes wrong
     ##########################################
     except: #Case that something goes wrong in worker
-        traceback.print_exc()
-        logger.error("Exiting the worker because of a failed batchjob on host %s", socket.gethostname())
+        traceback.print_exc(file=errorFile)
         batchjob = jobStore.load(jobStoreID)
-        batchjob.setupJobAfterFailure(config)
+        if isinstance(sys.exc_info()[1], JobTerminatedException):
+            #The failure is counted by the leader once the worker has exited
+            logger.error("Exiting the worker because it was terminated on host %s", socket.gethostname())
+            workerTerminated = True
+        else:
+            logger.error("Exiting the worker because of a failed batchjob on host %s", socket.gethostname())
+            batchjob.setupJobAfterFailure(config, outOfMemory=isOutOfMemoryError(sys.exc_info()[1]))
         workerFailed = True
+        #Report the additions to accumulators of the jobs that succeeded
+        #before the failure, those jobs won't be run again
+        if accumulator.hasUpdates():
+            l = ET.Element("worker")
+            ET.SubElement(l, "messages")
+            accumulator.addUpdatesToStats(l, jobStore)
+            jobStore.writeStatsAndLogging(ET.tostring(l))
+
+    return batchjob, workerFailed, workerTerminated
+
+def finishWorker(jobStore, batchjob, workerFailed, tempWorkerLogPath, localWorkerTempDir):
+    """
+    Keeps the worker log of a failed batchjob, removes the temporary directory
+    of the worker and deletes the batchjob if it is finished.
+    """
+    #Copy back the log file to the global dir, if needed
+    if workerFailed:
+        truncateFile(tempWorkerLogPath)
+        batchjob.setLogFile(tempWorkerLogPath, jobStore)
+        os.remove(tempWorkerLogPath)
+        jobStore.update(batchjob)
+
+    #Remove the temp dir
+    shutil.rmtree(localWorkerTempDir)
+    
+    #This must happen after the log file is done with, else there is no place to put the log
+    if (not workerFailed) and batchjob.command == None and len(batchjob.stack) == 0:
+        #We can now safely get rid of the batchjob
+        jobStore.delete(batchjob.jobStoreID)
+
+def runInProcess(jobStore, jobStoreID):
+    """
+    Runs the worker for the batchjob with the given jobStoreID in the calling
+    thread, rather than in a process of its own, see 
+    toil.batchSystems.inProcess. The output of the jobs is not redirected, the
+    worker log of a failed batchjob only holds the traceback of the failure.
+    Returns the exit status the worker process would have had.
+    """
+    from toil.lib.bioio import getTempDirectory
+    localWorkerTempDir = getTempDirectory()
+    tempWorkerLogPath = os.path.join(localWorkerTempDir, "worker_log.txt")
+    with open(tempWorkerLogPath, 'w') as logFile:
+        batchjob, workerFailed, workerTerminated = runJobs(jobStore, jobStoreID, 
+                                                           localWorkerTempDir, logFile)
+    finishWorker(jobStore, batchjob, workerFailed, tempWorkerLogPath, localWorkerTempDir)
+    return 128 + signal.SIGTERM if workerTerminated else 0
+
+def main():
+    ########################################## 
+    #Import necessary modules 
+    ##########################################
+    
+    # This is assuming that worker.py is at a path ending in "/toil/worker.py".
+    sourcePath = os.path.dirname(os.path.dirname(__file__))
+    if sourcePath not in sys.path:
+        # FIXME: prepending to sys.path should fix #103
+        sys.path.append(sourcePath)
+    
+    #Now we can import all the necessary functions
+    from toil.lib.bioio import setLogLevel
+    from toil.lib.bioio import getTempDirectory
+    from toil.common import loadJobStore
+    from toil.job import workerTermination
+    
+    ########################################## 
+    #Input args
+    ##########################################
+    
+    jobStoreString = sys.argv[1]
+    jobStoreID = sys.argv[2]
+    
+    ##########################################
+    #Load the jobStore/config file
+    ##########################################
+    
+    jobStore = loadJobStore(jobStoreString)
+    config = jobStore.config
+
+    ##########################################
+    #Load the environment for the batchjob
+    ##########################################
+    
+    #First load the environment for the batchjob.
+    with jobStore.readSharedFileStream("environment.pickle") as fileHandle:
+        environment = cPickle.load(fileHandle)
+    for i in environment:
+        if i not in ("TMPDIR", "TMP", "HOSTNAME", "HOSTTYPE"):
+            os.environ[i] = environment[i]
+    # sys.path is used by __import__ to find modules
+    if "PYTHONPATH" in environment:
+        for e in environment["PYTHONPATH"].split(':'):
+            if e != '':
+                sys.path.append(e)
+
+    setLogLevel(config.attrib["log_level"])
+
+    ##########################################
+    #Setup the temporary directories.
+    ##########################################
+        
+    #Dir to put all the temp files in.
+    localWorkerTempDir = getTempDirectory()
+    
+    #Remove the broadcast files of finished workflows from the node
+    from toil.broadcast import removeFinishedBroadcastDirs
+    removeFinishedBroadcastDirs(config)
+    
+    ##########################################
+    #Setup the logging
+    ##########################################
+
+    #This is mildly tricky because we don't just want to
+    #redirect stdout and stderr for this Python process; we want to redirect it
+    #for this process and all children. Consequently, we can't just replace
+    #sys.stdout and sys.stderr; we need to mess with the underlying OS-level
+    #file descriptors. See <http://stackoverflow.com/a/11632982/402891>
+    
+    #When we start, standard input is file descriptor 0, standard output is
+    #file descriptor 1, and standard error is file descriptor 2.
+
+    #What file do we want to point FDs 1 and 2 to?    
+    tempWorkerLogPath = os.path.join(localWorkerTempDir, "worker_log.txt")
+    
+    #Save the original stdout and stderr (by opening new file descriptors to the
+    #same files)
+    origStdOut = os.dup(1)
+    origStdErr = os.dup(2)
+    
+    #Open the file to send stdout/stderr to.
+    logFh = os.open(tempWorkerLogPath, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+
+    #Replace standard output with a descriptor for the log file
+    os.dup2(logFh, 1)
+    
+    #Replace standard error with a descriptor for the log file
+    os.dup2(logFh, 2)
+    
+    #Since we only opened the file once, all the descriptors duped from the
+    #original will share offset information, and won't clobber each others'
+    #writes. See <http://stackoverflow.com/a/5284108/402891>. This shouldn't
+    #matter, since O_APPEND seeks to the end of the file before every write, but
+    #maybe there's something odd going on...
+    
+    #Close the descriptor we used to open the file
+    os.close(logFh)
+    
+    for handler in list(logger.handlers): #Remove old handlers
+        logger.removeHandler(handler)
+    
+    #Add the new handler. The sys.stderr stream has been redirected by swapping
+    #the file descriptor out from under it.
+    logger.addHandler(logging.StreamHandler(sys.stderr))
+
+    ##########################################
+    #Worker log file trapped from here on in
+    ##########################################
+
+    ##########################################
+    #Handle being terminated
+    ##########################################
+    
+    #Batch systems send SIGTERM before killing the worker, giving the job the
+    #chance to checkpoint (see Job.FileStore.checkpoint). The exception is 
+    #only raised in the code of a job, so that the updates of the worker to
+    #the jobStore aren't interrupted.
+    signal.signal(signal.SIGTERM, workerTermination.handleSignal)
+
+    #Put a message at the top of the log, just to make sure it's working.
+    print "---TOIL WORKER OUTPUT LOG---"
+    sys.stdout.flush()
+    
+    #Log the number of open file descriptors so we can tell if we're leaking
+    #them.
+    logger.debug("Next available file descriptor: {}".format(
+        nextOpenDescriptor()))
+    
+    batchjob, workerFailed, workerTerminated = runJobs(jobStore, jobStoreID, localWorkerTempDir)
 
     ##########################################
     #Cleanup
@@ -413,21 +508,22 @@ def main():
     
     #Now our file handles are in exactly the state they were in before.
     
-    #Copy back the log file to the global dir, if needed
-    if workerFailed:
-        truncateFile(tempWorkerLogPath)
-        batchjob.setLogFile(tempWorkerLogPath, jobStore)
-        os.remove(tempWorkerLogPath)
-        jobStore.update(batchjob)
-
-    #Remove the temp dir
-    shutil.rmtree(localWorkerTempDir)
+    finishWorker(jobStore, batchjob, workerFailed, tempWorkerLogPath, localWorkerTempDir)
     
-    #This must happen after the log file is done with, else there is no place to put the log
-    if (not workerFailed) and batchjob.command == None and len(batchjob.stack) == 0:
-        #We can now safely get rid of the batchjob
-        jobStore.delete(batchjob.jobStoreID)
+    #Exit as if killed by SIGTERM, so that batch systems report the failure
+    if workerTerminated:
+        sys.exit(128 + signal.SIGTERM)
        
+def isOutOfMemoryError(e):
+    """
+    Returns true if the given exception raised by a job indicates that the job ran
+    out of memory, i.e. it is a MemoryError or a subprocess of the job was killed by
+    SIGKILL.
+    """
+    from toil.batchJob import killedExitStatuses
+    return (isinstance(e, MemoryError) or
+            isinstance(e, subprocess.CalledProcessError) and e.returncode in killedExitStatuses)
+
 if __name__ == '__main__':
     logging.basicConfig()
     main()